@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Benchmark of the ExpireSet of the multi health monitor plugin, compared to
+# the previous implementation, which rebuilt its dictionary on every update.
+#
+# Run from the top of the source tree:
+#
+#     $ python benchmarks/expire_set.py [number-of-ips]
+#
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from vpcrouter.monitor.plugins.multi import ExpireSet   # noqa
+
+
+class DictRebuildExpireSet(object):
+    """
+    The previous implementation: Each update() and get() creates a new
+    dictionary with all the entries that have not expired.
+
+    """
+    def __init__(self, expire_time):
+        self.timed_data  = {}
+        self.expire_time = expire_time
+
+    def _expire_data(self):
+        expire_time_stamp = time.time() - self.expire_time
+        self.timed_data   = {d: t for d, t in self.timed_data.items()
+                             if t > expire_time_stamp}
+
+    def update(self, data_set):
+        now = time.time()
+        for d in data_set:
+            self.timed_data[d] = now
+        self._expire_data()
+
+    def get(self):
+        self._expire_data()
+        return list(self.timed_data.keys())
+
+
+def ips(num, offset=0):
+    return ["10.%d.%d.%d" % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff)
+            for i in range(offset, offset + num)]
+
+
+def run(cls, num_ips, report_size, rounds):
+    """
+    Fill the set with 'num_ips' entries, then measure the average time of an
+    update with a report of 'report_size' IPs, followed by a get(), like the
+    multi plugin does for each sub-plugin report.
+
+    """
+    exp = cls(3600)
+    exp.update(ips(num_ips))
+    reports = [ips(report_size, (i * report_size) % num_ips)
+               for i in range(rounds)]
+    it      = iter(reports)
+
+    def one_round():
+        exp.update(next(it))
+        exp.get()
+
+    return timeit.timeit(one_round, number=rounds) / rounds
+
+
+def main():
+    num_ips = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print("ExpireSet with %d IPs, time per update() + get():" % num_ips)
+    print("%12s %18s %18s %10s" % ("report size", "dict rebuild (ms)",
+                                   "heap (ms)", "speedup"))
+    for report_size in [1, 10, 100, num_ips]:
+        rounds = max(10, min(1000, 100000 // report_size))
+        old    = run(DictRebuildExpireSet, num_ips, report_size, rounds)
+        new    = run(ExpireSet, num_ips, report_size, rounds)
+        print("%12d %18.3f %18.3f %9.1fx" % (report_size, old * 1000,
+                                             new * 1000, old / new))
+
+
+if __name__ == "__main__":
+    main()
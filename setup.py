@@ -47,7 +47,10 @@ setup(
     packages             = find_packages(),
     include_package_data = True,
     entry_points         = {
-        'console_scripts' : ['vpcrouter=vpcrouter.main:main'],
+        'console_scripts' : [
+            'vpcrouter=vpcrouter.main:main',
+            'vpcrouter-spec-convert=vpcrouter.watcher.binspec:main'
+        ],
     },
     install_requires     = [
         'argparse==1.2.1',
@@ -55,7 +58,6 @@ setup(
         'bottle==0.12.13',
         'netaddr==0.7.19',
         'wsgiref==0.1.2',
-        'watchdog==0.8.3',
         'multiping>=1.0.4',
         'ipaddress>=1.0.17'
     ],
@@ -18,8 +18,13 @@ limitations under the License.
 # Global data/state shared between modules. This includes some rendering
 # options, since we produce output via the http module.
 
+import collections
 import datetime
 import json
+import threading
+import time
+
+from vpcrouter import utils
 
 
 class StateError(Exception):
@@ -34,6 +39,20 @@ class _CurrentState(object):
     to render some output of the current system state.
 
     """
+    # Number of recently removed routes we remember in the VPC state history
+    VPC_STATE_HISTORY_SIZE = 100
+
+    # The sections of the state, which are served from published snapshots
+    SNAPSHOT_SECTIONS = ["ips", "route_info", "vpc"]
+
+    # Keys in the content of the snapshot sections, which change with every
+    # publication, even if the state itself didn't change. A change of those
+    # alone doesn't make a new version of a section.
+    VOLATILE_KEYS = ["time"]
+
+    # The formats in which the state can be rendered
+    RENDER_FORMATS = ["json", "text", "html"]
+
     def __init__(self):
         self.starttime        = datetime.datetime.now()
         self.versions         = ""
@@ -43,11 +62,15 @@ class _CurrentState(object):
         self.questionable_ips = []
         self.working_set      = []
         self.route_spec       = {}
+        self.cidr_overlaps    = []
         self.routes           = {}
         self.vpc_state        = {}
+        self.vpc_history      = collections.deque(
+                                        maxlen=self.VPC_STATE_HISTORY_SIZE)
         self.conf             = None
         self.main_param_names = []
         self.ignore_routes    = []
+        self.route_recheck    = {}
         self._vpc_router_http = None
         self._stop_all        = False
 
@@ -55,6 +78,27 @@ class _CurrentState(object):
         # accessed with separate requests.
         self.top_level_links  = ["", "ips", "plugins", "route_info", "vpc"]
 
+        # Readers only ever see complete snapshots of the state, which are
+        # published by the threads that modify the state. The lock only
+        # serializes the publishers, readers just grab the current reference.
+        # Each section in the snapshot is a (version, content) tuple, the
+        # version is incremented whenever the content of the section
+        # changes.
+        self._snapshot        = {}
+        self._snapshot_lock   = threading.Lock()
+        self.publish_snapshot()
+
+        # Representations of the snapshot sections, which are only created
+        # when a version of a section is first requested. Keyed by section,
+        # each a (version, rep) tuple.
+        self._rep_cache       = {}
+
+        # Renderings of the snapshot sections, keyed by (section, format,
+        # gzipped), each a (version, rendering) tuple. The ETag prefix makes
+        # sure that ETags from before a restart don't match anymore.
+        self._render_cache    = {}
+        self._etag_prefix     = "%x" % int(time.time())
+
     def add_plugin(self, plugin):
         """
         Every plugin (watcher and health) is added so we can later get live
@@ -84,31 +128,133 @@ class _CurrentState(object):
         """
         return {n: self.conf[n] for n in self.main_param_names}
 
-    def get_state_repr(self, path):
+    def render_vpc_state(self, content):
         """
-        Returns the current state, or sub-state, depending on the path.
+        Return a rendering of the VPC state from the content of a snapshot.
 
+        The state of each route in the route tables is kept in compact
+        records, which are only rendered here, when they are requested. The
+        most recently removed routes are listed first.
+
+        """
+        rep = dict(content['vpc_state'])
+        if content['time']:
+            rep['time'] = content['time']
+        rep['route_tables'] = {
+            rt_id : {dcidr : rec.as_dict() for dcidr, rec in routes.items()}
+            for rt_id, routes in content['route_tables'].items()
+        }
+        rep['recently_removed'] = [rec.as_dict() for rec in
+                                   reversed(content['recently_removed'])]
+        return rep
+
+    def _section_content(self, section):
         """
-        if path == "ips":
+        Return the content of one of the snapshot sections of the state.
+
+        Only the containers are copied: The values in them (IP addresses,
+        host pools, route records) are never modified, but replaced, so the
+        snapshot can refer to them. This keeps publishing cheap, even for
+        many routes.
+
+        """
+        if section == "ips":
             return {
-                "failed_ips"       : self.failed_ips,
-                "questionable_ips" : self.questionable_ips,
-                "working_set"      : self.working_set,
+                "failed_ips"       : list(self.failed_ips),
+                "questionable_ips" : list(self.questionable_ips),
+                "working_set"      : list(self.working_set),
             }
 
-        if path == "route_info":
+        if section == "route_info":
             return {
-                "route_spec"    : self.route_spec,
-                "routes"        : self.routes,
-                "ignore_routes" : self.ignore_routes
+                "route_spec"        : dict(self.route_spec),
+                "overlapping_cidrs" : list(self.cidr_overlaps),
+                "routes"            : dict(self.routes),
+                "ignore_routes"     : list(self.ignore_routes)
             }
 
+        return {
+            "vpc_state"        : {k : v for k, v in self.vpc_state.items()
+                                  if k not in ["route_tables", "time"]},
+            "time"             : self.vpc_state.get("time"),
+            "route_tables"     : {rt_id : dict(routes) for rt_id, routes in
+                                  self.vpc_state.get('route_tables',
+                                                     {}).items()},
+            "recently_removed" : tuple(self.vpc_history)
+        }
+
+    def publish_snapshot(self, sections=None):
+        """
+        Publish a new snapshot of the state for readers.
+
+        Should be called by the thread that modified the state, once it is
+        done with its modifications. Only the specified sections are copied
+        again (all of them if none are specified). The new snapshot replaces
+        the old one with a single reference assignment.
+
+        A section only gets a new version if its content has changed (apart
+        from the volatile keys), so that clients can keep using their copy
+        of an unchanged section. The volatile values of the section are then
+        the ones of its last change, for example the 'time' of the VPC state
+        is the time of the last run that changed the VPC state.
+
+        """
+        with self._snapshot_lock:
+            snapshot = dict(self._snapshot)
+            for section in sections or self.SNAPSHOT_SECTIONS:
+                content = self._section_content(section)
+                if section in snapshot:
+                    version, old_content = snapshot[section]
+                    if self._same_content(old_content, content):
+                        continue
+                    version += 1
+                else:
+                    version = 1
+                snapshot[section] = (version, content)
+            self._snapshot = snapshot
+
+    def _same_content(self, content_a, content_b):
+        """
+        Return True if the contents of two snapshots of a section are the
+        same, ignoring the volatile keys.
+
+        """
+        def stable(content):
+            return {k : v for k, v in content.items()
+                    if k not in self.VOLATILE_KEYS}
+
+        return stable(content_a) == stable(content_b)
+
+    def _get_section_rep(self, section):
+        """
+        Return version and representation of a snapshot section.
+
+        The representation is created when a version is first requested.
+        Version and representation are taken from the same snapshot.
+
+        """
+        version, content = self._snapshot[section]
+        cached = self._rep_cache.get(section)
+        if cached and cached[0] == version:
+            return cached
+        rep = self.render_vpc_state(content) if section == "vpc" else content
+        self._rep_cache[section] = (version, rep)
+        return version, rep
+
+    def get_state_repr(self, path):
+        """
+        Returns the current state, or sub-state, depending on the path.
+
+        The 'ips', 'route_info' and 'vpc' sections are returned from the most
+        recently published snapshot and must not be modified by the caller.
+
+        """
+        if path in self.SNAPSHOT_SECTIONS:
+            return self._get_section_rep(path)[1]
+
         if path == "plugins":
             return self.get_plugins_info()
 
-        if path == "vpc":
-            return self.vpc_state
-
         if path == "":
             return {
                 "SERVER"           : {
@@ -116,13 +262,71 @@ class _CurrentState(object):
                     "start_time"   : self.starttime.isoformat(),
                     "current_time" : datetime.datetime.now().isoformat()
                 },
-                "params"     : self.render_main_params(),
-                "plugins"    : {"_href" : "/plugins"},
-                "ips"        : {"_href" : "/ips"},
-                "route_info" : {"_href" : "/route_info"},
-                "vpc"        : {"_href" : "/vpc"}
+                "params"        : self.render_main_params(),
+                "route_recheck" : self.route_recheck,
+                "plugins"       : {"_href" : "/plugins"},
+                "ips"           : {"_href" : "/ips"},
+                "route_info"    : {"_href" : "/route_info"},
+                "vpc"           : {"_href" : "/vpc"}
             }
 
+    def get_state_version(self, path):
+        """
+        Return the version of the published snapshot of a state section.
+
+        Returns None for sections that are not served from snapshots.
+
+        """
+        if path in self.SNAPSHOT_SECTIONS:
+            return self._snapshot[path][0]
+        return None
+
+    def render(self, path, fmt, gzipped=False):
+        """
+        Return a rendering of the current state (or sub-state) in the
+        requested format, together with an ETag for the rendering. If
+        'gzipped' is set, the rendering is compressed in gzip format.
+
+        Renderings of sections that are served from snapshots are cached until
+        a new version of the section is published. Other sections contain
+        live data and are rendered each time, their ETag is None.
+
+        """
+        if path not in self.top_level_links:
+            raise StateError("Unknown path")
+        if fmt not in self.RENDER_FORMATS:
+            raise StateError("Unknown format")
+
+        if path not in self.SNAPSHOT_SECTIONS:
+            return self._render_repr(self.get_state_repr(path), fmt,
+                                     gzipped), None
+
+        # Version and representation are taken from the same snapshot, so
+        # that the cached rendering is always labeled with the right version.
+        version, rep = self._get_section_rep(path)
+        etag         = '"%s-%s-%s%s-%d"' % (self._etag_prefix,
+                                            path or "root", fmt,
+                                            "-gzip" if gzipped else "",
+                                            version)
+        cached       = self._render_cache.get((path, fmt, gzipped))
+        if cached and cached[0] == version:
+            return cached[1], etag
+
+        rendering = self._render_repr(rep, fmt, gzipped)
+        self._render_cache[(path, fmt, gzipped)] = (version, rendering)
+        return rendering, etag
+
+    def _render_repr(self, rep, fmt, gzipped=False):
+        """
+        Render a state representation in the specified format.
+
+        """
+        if fmt == "html":
+            rendering = self._html_repr(rep)
+        else:
+            rendering = json.dumps(rep, indent=4 if fmt == "text" else None)
+        return utils.gzip_compress(rendering) if gzipped else rendering
+
     def as_json(self, path="", with_indent=False):
         """
         Return a rendering of the current state in JSON.
@@ -142,6 +346,13 @@ class _CurrentState(object):
         if path not in self.top_level_links:
             raise StateError("Unknown path")
 
+        return self._html_repr(self.get_state_repr(path))
+
+    def _html_repr(self, rep):
+        """
+        Render a state representation in HTML.
+
+        """
         header = """
         <html>
             <head>
@@ -159,19 +370,20 @@ class _CurrentState(object):
         </html>
         """
 
-        rep = self.get_state_repr(path)
-
         def make_links(rep):
-            # Recursively create clickable links for _href elements
+            # Recursively create clickable links for _href elements. This
+            # returns a new dict, since the state representation may be a
+            # shared snapshot.
+            new_rep = {}
             for e, v in rep.items():
                 if e == "_href":
                     v = '<a href=%s>%s</a>' % (v, v)
-                    rep[e] = v
-                else:
-                    if type(v) == dict:
-                        make_links(v)
+                elif type(v) == dict:
+                    v = make_links(v)
+                new_rep[e] = v
+            return new_rep
 
-        make_links(rep)
+        rep = make_links(rep)
 
         rep_str_lines = json.dumps(rep, indent=4).split("\n")
         buf = []
@@ -52,3 +52,28 @@ class PluginError(_Exception):
 
     """
     pass
+
+
+class PayloadTooLargeError(_Exception):
+    """
+    A received payload exceeds the maximum allowed size.
+
+    """
+    pass
+
+
+class KVStoreError(_Exception):
+    """
+    Errors while talking to a key-value store.
+
+    """
+    pass
+
+
+class KVIndexExpiredError(KVStoreError):
+    """
+    The key-value store doesn't have the change history back to the requested
+    index anymore.
+
+    """
+    pass
@@ -0,0 +1,100 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# A log of recent events (route changes, failed and recovered routers, etc.),
+# which can be followed by clients of the built-in HTTP server.
+#
+
+import collections
+import datetime
+import threading
+
+
+class EventType(object):
+    """
+    The types of events we emit.
+
+    """
+    ROUTE_CHANGED      = "route_changed"
+    ROUTER_FAILED      = "router_failed"
+    ROUTER_RECOVERED   = "router_recovered"
+    SPEC_APPLIED       = "spec_applied"
+    RECONCILE_FINISHED = "reconcile_finished"
+
+
+class EventLog(object):
+    """
+    A bounded, in-memory ring buffer of events.
+
+    Each event gets a sequential ID. Readers can wait for events with an ID
+    greater than the last one they have seen. If a reader fell behind so far
+    that some events have already been dropped from the buffer, it just
+    receives all the events that are still available.
+
+    """
+    def __init__(self, maxlen=1000):
+        self._events  = collections.deque(maxlen=maxlen)
+        self._cond    = threading.Condition()
+        self._last_id = 0
+
+    def emit(self, event_type, **data):
+        """
+        Add a new event to the log and wake up all waiting readers.
+
+        Return the ID of the new event.
+
+        """
+        with self._cond:
+            self._last_id += 1
+            self._events.append({
+                "id"   : self._last_id,
+                "type" : event_type,
+                "time" : datetime.datetime.now().isoformat(),
+                "data" : data
+            })
+            self._cond.notify_all()
+            return self._last_id
+
+    def last_id(self):
+        """
+        Return the ID of the most recent event (0 if there are none).
+
+        """
+        return self._last_id
+
+    def get_since(self, last_id, timeout=None):
+        """
+        Return the list of events with an ID greater than last_id.
+
+        If there are no such events, wait for up to 'timeout' seconds for new
+        ones to be emitted. May return an empty list.
+
+        An ID greater than that of the most recent event (the client saw IDs
+        from before a restart) is treated like 0.
+
+        """
+        with self._cond:
+            if last_id > self._last_id:
+                last_id = 0
+            if last_id == self._last_id and timeout:
+                self._cond.wait(timeout)
+            return [e for e in self._events if e['id'] > last_id]
+
+
+# The module doesn't get reloaded, so no need to check, can just initialize
+EVENTS = EventLog()
@@ -76,9 +76,16 @@ def _setup_arg_parser(args_list, watcher_plugin_class, health_plugin_class):
                              "routes which vpc-router should ignore.")
     parser.add_argument('--route_recheck_interval',
                         dest="route_recheck_interval",
-                        required=False, default="30", type=int,
-                        help="time between regular checks of VPC route "
-                             "tables, default: 30")
+                        required=False, default="10", type=int,
+                        help="shortest time between regular checks of VPC "
+                             "route tables, used after drift or errors "
+                             "were detected, default: 10")
+    parser.add_argument('--route_recheck_max_interval',
+                        dest="route_recheck_max_interval",
+                        required=False, default="300", type=int,
+                        help="longest time between regular checks of VPC "
+                             "route tables, reached while no drift is "
+                             "detected, default: 300")
     parser.add_argument('-a', '--address', dest="addr",
                         default="localhost",
                         help="address to listen on for HTTP requests, "
@@ -87,6 +94,15 @@ def _setup_arg_parser(args_list, watcher_plugin_class, health_plugin_class):
                         default="33289", type=int,
                         help="port to listen on for HTTP requests, "
                              "default: 33289")
+    parser.add_argument('--http_threads', dest="http_threads",
+                        default=http_server.HTTP_THREADS_DEFAULT, type=int,
+                        help="number of threads handling HTTP requests, "
+                             "default: %d" % http_server.HTTP_THREADS_DEFAULT)
+    parser.add_argument('--http_backlog', dest="http_backlog",
+                        default=http_server.HTTP_BACKLOG_DEFAULT, type=int,
+                        help="backlog of HTTP connections waiting to be "
+                             "handled, default: %d" %
+                             http_server.HTTP_BACKLOG_DEFAULT)
     parser.add_argument('-m', '--mode', dest='mode', required=True,
                         help="name of the watcher plugin")
     parser.add_argument('-H', '--health', dest='health', required=False,
@@ -95,7 +111,9 @@ def _setup_arg_parser(args_list, watcher_plugin_class, health_plugin_class):
                              "default: %s" % monitor.MONITOR_DEFAULT_PLUGIN)
 
     arglist = ["logfile", "region_name", "vpc_id", "route_recheck_interval",
-               "verbose", "addr", "port", "mode", "health", "ignore_routes"]
+               "route_recheck_max_interval", "verbose", "addr", "port",
+               "http_threads", "http_backlog", "mode", "health",
+               "ignore_routes"]
 
     # Inform the CurrentState object of the main config parameter names, which
     # should be rendered in an overview.
@@ -109,6 +127,27 @@ def _setup_arg_parser(args_list, watcher_plugin_class, health_plugin_class):
     return parser, arglist
 
 
+def _check_http_args(conf):
+    """
+    Sanity check the arguments for the built-in http server.
+
+    """
+    if not 0 < conf['port'] < 65535:
+        raise ArgsError("Invalid listen port '%d' for built-in http server." %
+                        conf['port'])
+
+    if not 1 <= conf['http_threads'] <= 256:
+        raise ArgsError("Number of http threads must be between 1 and 256")
+
+    if not 1 <= conf['http_backlog'] <= 4096:
+        raise ArgsError("Http listen backlog must be between 1 and 4096")
+
+    if not conf['addr'] == "localhost":
+        # Check if a proper address was specified (already raises a suitable
+        # ArgsError if not)
+        utils.ip_check(conf['addr'])
+
+
 def _parse_args(args_list, watcher_plugin_class, health_plugin_class):
     """
     Parse command line arguments and return relevant values in a dict.
@@ -152,14 +191,13 @@ def _parse_args(args_list, watcher_plugin_class, health_plugin_class):
         raise ArgsError("route_recheck_interval argument must be either 0 "
                         "or at least 5")
 
-    if not 0 < conf['port'] < 65535:
-        raise ArgsError("Invalid listen port '%d' for built-in http server." %
-                        conf['port'])
+    if conf['route_recheck_interval'] and \
+            conf['route_recheck_max_interval'] < \
+                                            conf['route_recheck_interval']:
+        raise ArgsError("route_recheck_max_interval argument must not be "
+                        "less than route_recheck_interval")
 
-    if not conf['addr'] == "localhost":
-        # Check if a proper address was specified (already raises a suitable
-        # ArgsError if not)
-        utils.ip_check(conf['addr'])
+    _check_http_args(conf)
 
     if conf['ignore_routes']:
         # Parse the list of addresses and CIDRs
@@ -167,6 +205,7 @@ def _parse_args(args_list, watcher_plugin_class, health_plugin_class):
             a = a.strip()
             a = utils.check_valid_ip_or_cidr(a, return_as_cidr=True)
             CURRENT_STATE.ignore_routes.append(a)
+        CURRENT_STATE.publish_snapshot(["route_info"])
 
     # Store a reference to the config dict in the current state
     CURRENT_STATE.conf = conf
@@ -192,10 +231,8 @@ def _setup_logging(conf):
                         format='%(asctime)s - %(levelname)-8s - '
                                '%(threadName)-15s - %(message)s')
 
-    # Don't want to see all the messages from BOTO and watchdog
+    # Don't want to see all the messages from BOTO
     logging.getLogger('boto').setLevel(logging.CRITICAL)
-    logging.getLogger('watchdog.observers.inotify_buffer'). \
-                                                setLevel(logging.CRITICAL)
 
 
 def main():
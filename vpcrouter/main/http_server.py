@@ -21,14 +21,20 @@ limitations under the License.
 #
 
 import bottle
+import json
 import logging
+import Queue
+import select
 import socket
 import threading
 import time
 
-from functools import wraps
+from functools             import wraps
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, \
+                                  WSGIServer
 
 from vpcrouter.currentstate import CURRENT_STATE, StateError
+from vpcrouter.events       import EVENTS
 
 
 # Need to direct Bottle's logs to our standard logger. In the time honoured
@@ -63,29 +69,277 @@ APP = bottle.Bottle()
 APP.install(log_to_logger)
 
 
+# Defaults for the number of request handler threads and the listen backlog
+HTTP_THREADS_DEFAULT = 8
+HTTP_BACKLOG_DEFAULT = 64
+
+# Idle keep-alive connections are closed after this many seconds
+KEEPALIVE_TIMEOUT    = 5
+
+# While waiting for the next request on an idle keep-alive connection, a
+# handler thread checks this often whether other connections are waiting for
+# a thread.
+KEEPALIVE_CHECK_TIME = 0.1
+
+# Event streams send a heartbeat comment after this many idle seconds, which
+# also lets us notice clients that went away.
+SSE_HEARTBEAT        = 15
+
+# Each event stream client occupies a request handler thread. We only allow
+# half of the threads to be used for this, so that normal requests are still
+# served. The stop event ends all streams when the server is stopped.
+_SSE_SLOTS           = threading.BoundedSemaphore(HTTP_THREADS_DEFAULT // 2)
+_SSE_STOP            = threading.Event()
+
+
+class _KeepAliveServerHandler(ServerHandler):
+    """
+    A WSGI server handler, which responds with HTTP/1.1.
+
+    The connection can only be kept open if the response has a known
+    length. Otherwise, the client is told that the connection will be closed.
+
+    """
+    http_version = "1.1"
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        if "Content-Length" not in self.headers:
+            self.request_handler.close_connection = 1
+        if self.request_handler.close_connection:
+            self.headers["Connection"] = "close"
+
+
+class _KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+    A WSGI request handler, which supports HTTP/1.1 keep-alive.
+
+    The standard wsgiref handler processes a single request per connection.
+    This one processes requests until the client closes the connection, asks
+    for it to be closed, or is idle for too long.
+
+    An idle connection still occupies a thread of the pool. So that a few idle
+    clients can't take all the threads, an idle connection is also closed as
+    soon as other connections are waiting for a thread. Clients simply open a
+    new connection for their next request.
+
+    Connections on which a request body was sent are closed after the
+    response, since we can't be sure that the application consumed the
+    entire body.
+
+    """
+    protocol_version = "HTTP/1.1"
+    timeout          = KEEPALIVE_TIMEOUT
+    quiet            = False
+
+    def handle(self):
+        """
+        Handle requests on the connection until it is closed.
+
+        """
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self._wait_for_next_request():
+                self.close_connection = 1
+                break
+            self.handle_one_request()
+
+    def _has_buffered_input(self):
+        """
+        Return True if the next request (or part of it) has already been read
+        from the socket into the buffer of rfile.
+
+        """
+        rbuf = getattr(self.rfile, "_rbuf", None)
+        return rbuf is not None and rbuf.tell() > 0
+
+    def _wait_for_next_request(self):
+        """
+        Wait until the client sends the next request on an idle connection.
+
+        Returns False if the connection should be closed instead: After the
+        keep-alive timeout, or as soon as other connections are waiting for a
+        handler thread.
+
+        """
+        if self._has_buffered_input():
+            return True
+        deadline = time.time() + KEEPALIVE_TIMEOUT
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                readable, _, _ = select.select(
+                                        [self.connection], [], [],
+                                        min(remaining, KEEPALIVE_CHECK_TIME))
+            except (select.error, socket.error):
+                return False
+            if readable:
+                return True
+            if self.server.connections_waiting():
+                return False
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.error:
+            # Timeout of an idle connection, or the server is shutting down
+            self.close_connection = 1
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline     = ''
+            self.request_version = ''
+            self.command         = ''
+            self.send_error(414)
+            self.close_connection = 1
+            return
+
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+
+        if not self.parse_request():
+            return
+
+        if self.headers.get("Content-Length", "0") != "0" or \
+                            self.headers.get("Transfer-Encoding"):
+            self.close_connection = 1
+
+        handler = _KeepAliveServerHandler(self.rfile, self.wfile,
+                                          self.get_stderr(),
+                                          self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    def log_request(self, *args, **kwargs):
+        if not self.quiet:
+            WSGIRequestHandler.log_request(self, *args, **kwargs)
+
+
+class _ThreadPoolWSGIServer(WSGIServer):
+    """
+    A WSGI server, which hands accepted connections to a fixed pool of
+    request handler threads.
+
+    The backlog is the listen backlog of the server socket, as well as the
+    maximum number of accepted connections, which may wait for a thread.
+    Connections beyond that are closed right away.
+
+    """
+    def __init__(self, server_address, handler_class, num_threads, backlog):
+        # Used as the listen backlog when the server socket is activated
+        self.request_queue_size = backlog
+        WSGIServer.__init__(self, server_address, handler_class)
+
+        self._connections = Queue.Queue(maxsize=backlog)
+        self._active      = set()
+        self._active_lock = threading.Lock()
+        self._workers     = []
+        for i in range(num_threads):
+            t = threading.Thread(target = self._worker,
+                                 name   = "HTTP-%d" % i)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def process_request(self, request, client_address):
+        """
+        Queue an accepted connection for one of the handler threads.
+
+        """
+        try:
+            self._connections.put_nowait((request, client_address))
+        except Queue.Full:
+            logging.warning("HTTP server: Too many waiting connections, "
+                            "closing connection from %s" % client_address[0])
+            self.shutdown_request(request)
+
+    def connections_waiting(self):
+        """
+        Return True if accepted connections are waiting for a handler thread.
+
+        """
+        return not self._connections.empty()
+
+    def _worker(self):
+        """
+        Handle connections until the stop signal (None) is received.
+
+        """
+        while True:
+            conn = self._connections.get()
+            if conn is None:
+                break
+            request, client_address = conn
+            with self._active_lock:
+                self._active.add(request)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                with self._active_lock:
+                    self._active.discard(request)
+                self.shutdown_request(request)
+
+    def server_close(self):
+        """
+        Close the listening socket, as well as all open connections, and
+        stop the handler threads.
+
+        """
+        WSGIServer.server_close(self)
+        with self._active_lock:
+            for request in self._active:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        # Connections that are still waiting won't be handled anymore, which
+        # also makes room for the stop signals.
+        while True:
+            try:
+                conn = self._connections.get_nowait()
+            except Queue.Empty:
+                break
+            if conn is not None:
+                self.shutdown_request(conn[0])
+        for t in self._workers:
+            self._connections.put(None)
+        for t in self._workers:
+            t.join(KEEPALIVE_TIMEOUT)
+
+
 # Need to be able to shut down the bottle server thread, but no stop method was
 # offered. Found this solution: https://stackoverflow.com/a/16056443/7242672
 #
 # Thank you to StackOverflow user 'mike'.
-class MyWSGIRefServer(bottle.ServerAdapter):
+class ThreadPoolServerAdapter(bottle.ServerAdapter):
+    """
+    Bottle server adapter for our thread-pool WSGI server.
+
+    """
     server = None
 
     def __init__(self, *args, **kwargs):
-        if 'romana_http' in kwargs:
-            self.romana_http = kwargs['romana_http']
-            del kwargs['romana_http']
-        super(MyWSGIRefServer, self).__init__(*args, **kwargs)
+        self.romana_http = kwargs.pop('romana_http')
+        self.num_threads = kwargs.pop('num_threads', HTTP_THREADS_DEFAULT)
+        self.backlog     = kwargs.pop('backlog', HTTP_BACKLOG_DEFAULT)
+        super(ThreadPoolServerAdapter, self).__init__(*args, **kwargs)
 
     def run(self, handler):
-        from wsgiref.simple_server import make_server, WSGIRequestHandler
-        if self.quiet:
-            class QuietHandler(WSGIRequestHandler):
-                def log_request(*args, **kw):
-                    pass
-            self.options['handler_class'] = QuietHandler
+        class RequestHandler(_KeepAliveRequestHandler):
+            quiet = self.quiet
+
         try:
-            self.server = make_server(self.host, self.port, handler,
-                                      **self.options)
+            self.server = _ThreadPoolWSGIServer((self.host, self.port),
+                                                RequestHandler,
+                                                self.num_threads,
+                                                self.backlog)
+            self.server.set_app(handler)
             self.romana_http.wsgi_server_started = True
             logging.info("HTTP server: Started to listen...")
             self.server.serve_forever()
@@ -97,6 +351,9 @@ class MyWSGIRefServer(bottle.ServerAdapter):
     def stop(self):
         if self.server:
             self.server.shutdown()
+            # Release the listening socket, so that the port can be used
+            # again, and stop the request handler threads
+            self.server.server_close()
 
 
 def handle_request(path):
@@ -108,29 +365,69 @@ def handle_request(path):
 
     bottle.response.status = 200
 
+    if "text/html" in accept:
+        fmt, content_type = "html", "text/html"
+    elif "application/json" in accept:
+        fmt, content_type = "json", "application/json"
+    elif "text/" in accept or "*/*" in accept:
+        fmt, content_type = "text", "text/plain"
+    else:
+        bottle.response.status = 407
+        return "Cannot render data in acceptable content type"
+
+    gzipped = _accepts_gzip(bottle.request.get_header("Accept-Encoding"))
     try:
-        if "text/html" in accept:
-            ret = CURRENT_STATE.as_html(path=path)
-            bottle.response.content_type = "text/html"
-
-        elif "application/json" in accept:
-            ret = CURRENT_STATE.as_json(path=path)
-            bottle.response.content_type = "application/json"
-
-        elif "text/" in accept or "*/*" in accept:
-            ret = CURRENT_STATE.as_json(path=path, with_indent=True)
-            bottle.response.content_type = "text/plain"
-
-        else:
-            bottle.response.status = 407
-            ret = "Cannot render data in acceptable content type"
+        ret, etag = CURRENT_STATE.render(path, fmt, gzipped)
     except StateError:
         bottle.response.status = 404
-        ret = "Requested state component not found"
+        return "Requested state component not found"
+
+    bottle.response.content_type = content_type
+    bottle.response.set_header("Vary", "Accept, Accept-Encoding")
+    if etag:
+        bottle.response.set_header("ETag", etag)
+        if _etag_matches(etag,
+                         bottle.request.get_header("If-None-Match")):
+            # The client already has the current version
+            bottle.response.status = 304
+            return ""
+
+    if gzipped:
+        bottle.response.set_header("Content-Encoding", "gzip")
 
     return ret
 
 
+def _accepts_gzip(accept_encoding):
+    """
+    Return True if the value of an Accept-Encoding request header allows a
+    gzip encoded response.
+
+    """
+    if not accept_encoding:
+        return False
+    for coding in accept_encoding.split(","):
+        params = [p.strip() for p in coding.split(";")]
+        if params[0].lower() in ["gzip", "x-gzip"]:
+            # A coding may be explicitly refused with 'q=0'
+            return not any(p.replace(" ", "") in ["q=0", "q=0.0", "q=0.00",
+                                                  "q=0.000"]
+                           for p in params[1:])
+    return False
+
+
+def _etag_matches(etag, if_none_match):
+    """
+    Return True if the ETag is matched by the value of an If-None-Match
+    request header.
+
+    """
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or ("W/" + etag) in tags
+
+
 @APP.route('/', method='GET')
 def handle_root_request():
     return handle_request("")
@@ -156,6 +453,63 @@ def handle_route_vpc_request():
     return handle_request("vpc")
 
 
+def _event_stream(last_id, slots):
+    """
+    Generator for a stream of server-sent events, starting after the event
+    with the given ID.
+
+    Releases the acquired slot for event streams when done. Bottle always
+    starts the generator, so that this happens even if the client goes away
+    right away.
+
+    """
+    try:
+        yield "retry: 3000\n\n"
+        idle_since = time.time()
+        while not (CURRENT_STATE._stop_all or _SSE_STOP.is_set()):
+            events = EVENTS.get_since(last_id, timeout=1)
+            for e in events:
+                last_id = e['id']
+                yield "id: %d\nevent: %s\ndata: %s\n\n" % \
+                                        (e['id'], e['type'], json.dumps(e))
+            if events:
+                idle_since = time.time()
+            elif time.time() - idle_since >= SSE_HEARTBEAT:
+                yield ": heartbeat\n\n"
+                idle_since = time.time()
+    finally:
+        slots.release()
+
+
+@APP.route('/events', method='GET')
+def handle_events_request():
+    """
+    Stream events as server-sent events.
+
+    Clients can resume a stream after the last event they have seen, by
+    sending its ID in the 'Last-Event-ID' header (or the 'last_event_id'
+    query parameter). New clients only receive new events, unless they ask
+    for all buffered events with an ID of 0.
+
+    """
+    last_id = bottle.request.get_header("Last-Event-ID") or \
+                                    bottle.request.query.get("last_event_id")
+    try:
+        last_id = int(last_id) if last_id else EVENTS.last_id()
+    except ValueError:
+        bottle.response.status = 400
+        return "Malformed event ID"
+
+    slots = _SSE_SLOTS
+    if not slots.acquire(False):
+        bottle.response.status = 503
+        return "Too many event stream clients"
+
+    bottle.response.content_type = "text/event-stream"
+    bottle.response.set_header("Cache-Control", "no-cache")
+    return _event_stream(last_id, slots)
+
+
 class VpcRouterHttpServer(object):
     """
     Implements a simple HTTP request handler to get information about current
@@ -182,9 +536,18 @@ class VpcRouterHttpServer(object):
                      "Starting to listen for requests on '%s:%s'..." %
                      (self.conf['addr'], self.conf['port']))
 
-        self.my_server = MyWSGIRefServer(host=self.conf['addr'],
-                                         port=self.conf['port'],
-                                         romana_http=self)
+        global _SSE_SLOTS
+        num_threads = self.conf.get('http_threads', HTTP_THREADS_DEFAULT)
+        _SSE_SLOTS  = threading.BoundedSemaphore(max(1, num_threads // 2))
+        _SSE_STOP.clear()
+
+        self.my_server = ThreadPoolServerAdapter(
+                    host        = self.conf['addr'],
+                    port        = self.conf['port'],
+                    num_threads = num_threads,
+                    backlog     = self.conf.get('http_backlog',
+                                                HTTP_BACKLOG_DEFAULT),
+                    romana_http = self)
 
         self.http_thread = threading.Thread(
                     target = APP.run,
@@ -203,6 +566,7 @@ class VpcRouterHttpServer(object):
         Stop the HTTP server thread.
 
         """
+        _SSE_STOP.set()
         self.my_server.stop()
         self.http_thread.join()
         logging.info("HTTP server: Stopped")
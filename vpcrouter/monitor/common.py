@@ -20,9 +20,9 @@ limitations under the License.
 #
 
 import logging
-import Queue
 import time
 
+from vpcrouter              import utils
 from vpcrouter.currentstate import CURRENT_STATE
 
 
@@ -57,19 +57,19 @@ class MonitorPlugin(object):
         This includes all parameters, not just the ones specific to the
         plugin.
 
-        Also creates three queues:
-        * A queue to receive updated sets of IP addresses.
-        * A queue to send out notices of failed IP addresses.
-        * A queue to inform about questionable or failing IPs (still
+        Also creates three mailboxes (see utils.Mailbox):
+        * A mailbox to receive updated sets of IP addresses.
+        * A mailbox to send out notices of failed IP addresses.
+        * A mailbox to inform about questionable or failing IPs (still
           operational, but with some indication that it will soon change).
 
         """
         self.conf               = conf
         self.thread_name        = thread_name
 
-        self.q_monitor_ips      = Queue.Queue()
-        self.q_failed_ips       = Queue.Queue()
-        self.q_questionable_ips = Queue.Queue()
+        self.q_monitor_ips      = utils.Mailbox()
+        self.q_failed_ips       = utils.Mailbox()
+        self.q_questionable_ips = utils.Mailbox()
 
     def get_plugin_name(self):
         return type(self).__name__.lower()
@@ -99,31 +99,23 @@ class MonitorPlugin(object):
 
     def get_new_working_set(self):
         """
-        Get a new list of IPs to work with from the queue.
+        Get a new list of IPs to work with from the mailbox.
 
         This returns None if there is no update.
 
-        Read all the messages from the queue on which we get the IP addresses
-        that we have to monitor. We will ignore all of them, except the last
-        one, since maybe we received two updates in a row, but each update
-        is a full state, so only the last one matters.
+        Each update is a full state and a new update replaces an unread one
+        in the mailbox, so we only ever see the latest list of IPs.
 
-        Raises the StopReceived exception if the stop signal ("None") was
-        received on the notification queue.
+        Raises the StopReceived exception if the stop signal was received in
+        the mailbox.
 
         """
-        new_list_of_ips = None
-        while True:
-            try:
-                new_list_of_ips = self.q_monitor_ips.get_nowait()
-                self.q_monitor_ips.task_done()
-                if type(new_list_of_ips) is MonitorPluginStopSignal:
-                    raise StopReceived()
-            except Queue.Empty:
-                # No more messages, all done reading monitor list for now
-                break
+        new_list_of_ips = utils.read_last_msg_from_queue(self.q_monitor_ips)
+        if type(new_list_of_ips) is MonitorPluginStopSignal:
+            raise StopReceived()
         if new_list_of_ips is not None:
             CURRENT_STATE.working_set = new_list_of_ips
+            CURRENT_STATE.publish_snapshot(["ips"])
         return new_list_of_ips
 
     def get_monitor_interval(self):
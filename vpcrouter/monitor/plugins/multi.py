@@ -22,10 +22,13 @@ limitations under the License.
 # This allows plugin authors to combine multiple, simple or specialized
 # health monitor plugins into more complex health monitors.
 #
-# The multi-plugin reports an instance as 'failed' if ANY of the sub-plugins
-# report it as failed.
+# By default, the multi-plugin reports an instance as 'failed' if ANY of the
+# sub-plugins report it as failed. Other combination policies (all, k-of-n,
+# weighted) can be configured, separately for failed and questionable IPs.
 #
 
+import heapq
+import itertools
 import logging
 import threading
 import time
@@ -43,6 +46,15 @@ class ExpireSet(object):
     If an entry has not received an update within a certain time, it is removed
     from the list.
 
+    The time of the last update of each entry is kept in a dictionary. In
+    addition, a min-heap tells us which entries are the next to expire. All
+    entries of an update share the same time, so the heap holds one (time,
+    sequence number, entries) tuple per update. The older tuples of updated
+    entries are not removed from the heap, those entries are simply skipped
+    when the tuple reaches the top. Updates therefore take O(log n) (plus the
+    size of the update) and only expired tuples are looked at when expiring
+    data.
+
     """
     def __init__(self, expire_time):
         """
@@ -54,6 +66,9 @@ class ExpireSet(object):
         """
         self.timed_data  = {}
         self.expire_time = expire_time
+        self._heap       = []
+        self._heap_size  = 0     # Number of entries in all tuples of the heap
+        self._seq        = itertools.count()
 
     def _expire_data(self):
         """
@@ -61,19 +76,47 @@ class ExpireSet(object):
 
         """
         expire_time_stamp = time.time() - self.expire_time
-        self.timed_data   = {d: t for d, t in self.timed_data.items()
-                             if t > expire_time_stamp}
+        heap              = self._heap
+        timed_data        = self.timed_data
+        while heap and heap[0][0] <= expire_time_stamp:
+            t, _, entries    = heapq.heappop(heap)
+            self._heap_size -= len(entries)
+            for d in entries:
+                # Skip entries, which were updated since
+                if timed_data.get(d) == t:
+                    del timed_data[d]
+
+    def _rebuild_heap(self):
+        """
+        Create the heap from the current entries, without outdated ones.
+
+        """
+        by_time = {}
+        for d, t in self.timed_data.items():
+            by_time.setdefault(t, []).append(d)
+        self._heap = [(t, next(self._seq), entries)
+                      for t, entries in by_time.items()]
+        heapq.heapify(self._heap)
+        self._heap_size = len(self.timed_data)
 
     def update(self, data_set):
         """
         Refresh the time of all specified elements in the supplied data set.
 
         """
-        now = time.time()
-        for d in data_set:
+        now     = time.time()
+        entries = list(data_set)
+        for d in entries:
             self.timed_data[d] = now
+        heapq.heappush(self._heap, (now, next(self._seq), entries))
+        self._heap_size += len(entries)
         self._expire_data()
 
+        # Entries that are updated all the time leave many outdated entries in
+        # the heap. Rebuild it once most of them are outdated.
+        if self._heap_size > 4 * len(self.timed_data) + 64:
+            self._rebuild_heap()
+
     def get(self):
         """
         Return the current data set.
@@ -83,6 +126,130 @@ class ExpireSet(object):
         return list(self.timed_data.keys())
 
 
+def parse_weights(weights_str, plugin_names):
+    """
+    Parse a list of sub-plugin weights ('name=weight:name=weight...').
+
+    Returns a dictionary with the weight of each sub-plugin, plugins which are
+    not listed have a weight of 1.
+
+    Raises ArgsError in case of problems.
+
+    """
+    weights = {name : 1.0 for name in plugin_names}
+    if weights_str:
+        for elem in weights_str.split(":"):
+            name, _, weight = elem.partition("=")
+            if name not in weights:
+                raise ArgsError("Weight for unknown health monitor plugin "
+                                "'%s'" % name)
+            try:
+                weights[name] = float(weight)
+            except ValueError:
+                weights[name] = -1
+            if weights[name] <= 0:
+                raise ArgsError("Weight of plugin '%s' must be a number "
+                                "greater than 0" % name)
+    return weights
+
+
+class CombinationPolicy(object):
+    """
+    Decides which of the IPs reported by the sub-plugins are reported by the
+    multi plugin.
+
+    Each sub-plugin that reports an IP contributes its weight to the score of
+    the IP. An IP is reported if its score reaches the threshold. The policies
+    are specified as:
+
+    any:          Reported by at least one sub-plugin.
+    all:          Reported by all sub-plugins.
+    quorum:<k>:   Reported by at least k sub-plugins.
+    weighted:<t>: The sum of the weights of the reporting sub-plugins is at
+                  least t.
+
+    Except for the weighted policy, all sub-plugins have a weight of 1.
+
+    Keeps counts of how often the policy changed its decision about an IP:
+    An IP, which is reported by at least one sub-plugin, becomes 'accepted' or
+    'suppressed' when it is first reported or when the policy decides
+    differently than in the previous pass. An IP, which stays failed, is
+    counted just once, no matter how often the sub-plugins report it. The
+    IPs, which are currently suppressed, are kept as well.
+
+    """
+    def __init__(self, spec, weights):
+        """
+        Create a policy from its specification, for sub-plugins with the
+        given weights (a dictionary keyed by plugin name).
+
+        Raises ArgsError if the specification is not valid.
+
+        """
+        self.spec    = spec
+        name, _, arg = spec.partition(":")
+        num_plugins  = len(weights)
+        try:
+            if name in ["any", "all"] and not arg:
+                threshold = 1 if name == "any" else num_plugins
+            elif name == "quorum":
+                threshold = int(arg)
+                if not 1 <= threshold <= num_plugins:
+                    raise ValueError()
+            elif name == "weighted":
+                threshold = float(arg)
+                if threshold <= 0:
+                    raise ValueError()
+            else:
+                raise ArgsError("Unknown combination policy '%s'" % spec)
+        except ValueError:
+            raise ArgsError("Invalid combination policy '%s': Quorum must be "
+                            "between 1 and %d, weighted threshold greater "
+                            "than 0" % (spec, num_plugins))
+
+        self.threshold = threshold
+        self.weights   = weights if name == "weighted" else \
+                                    {pname : 1 for pname in weights}
+        self.stats     = {
+            "decisions"  : 0,
+            "accepted"   : 0,
+            "suppressed" : 0
+        }
+        # The last decision for each IP with votes: True if accepted
+        self._accepted = {}
+
+    def decide(self, votes):
+        """
+        Return the sorted list of IPs, which are reported according to the
+        policy.
+
+        The votes are a dictionary with the list of reporting plugin names
+        for each IP.
+
+        """
+        accepted = {ip : sum(self.weights[p] for p in pnames) >=
+                         self.threshold
+                    for ip, pnames in votes.items()}
+        for ip, is_accepted in accepted.items():
+            if self._accepted.get(ip) != is_accepted:
+                self.stats['accepted' if is_accepted else 'suppressed'] += 1
+        self._accepted           = accepted
+        self.stats['decisions'] += 1
+        return sorted(ip for ip, is_accepted in accepted.items()
+                      if is_accepted)
+
+    def get_stats(self):
+        """
+        Return the decision counts and the currently suppressed IPs.
+
+        """
+        stats = dict(self.stats)
+        stats['suppressed_ips'] = sorted(ip for ip, is_accepted in
+                                         self._accepted.items()
+                                         if not is_accepted)
+        return stats
+
+
 class Multi(common.MonitorPlugin):
     """
     A health monitor plugin, which uses multiple simpler health monitor
@@ -96,7 +263,8 @@ class Multi(common.MonitorPlugin):
     sub-plugins.
 
     Any reports about failed IP addresses from any of those plugins are
-    combined and sent to the VPC router as a single message.
+    combined according to the configured policy (see CombinationPolicy) and
+    sent to the VPC router as a single message.
 
     """
     def __init__(self, conf, **kwargs):
@@ -105,6 +273,11 @@ class Multi(common.MonitorPlugin):
 
         self.my_wait_interval       = 0
         self.plugins                = []
+
+        # Set whenever a sub-plugin publishes a report, or we receive new IPs
+        # or the stop signal, so that we can act on it right away.
+        self._wakeup                = threading.Event()
+        self.q_monitor_ips.add_listener(self._wakeup.set)
         self.monitor_ip_queues      = {}
         self.failed_ip_queues       = {}
         self.questionable_ip_queues = {}
@@ -158,28 +331,44 @@ class Multi(common.MonitorPlugin):
             self.monitor_ip_queues[pname]         = q_monitor_ips
             self.failed_queue_lookup[pname]       = q_failed_ips
             self.questionable_queue_lookup[pname] = q_questionable_ips
+            q_failed_ips.add_listener(self._wakeup.set)
+            q_questionable_ips.add_listener(self._wakeup.set)
 
-            # Also calculate our waiting interval: Double the max of each
-            # plugin's interval. That's sufficient to make sure we get updates
-            # if there are any.
+            # Also calculate our interval: Double the max of each plugin's
+            # interval. Reported IPs expire after ten of those.
             self.my_wait_interval = max(self.my_wait_interval,
                                         plugin.get_monitor_interval())
         self.my_wait_interval *= 2
 
-        # We will keep the reportedly failed and questionable IP addresses in
-        # accumulating buffers. This is important, since otherwise, an update
-        # from one plugin may wipe out the update provided just before from
-        # another plugin.
-        self.report_failed_acc       = ExpireSet(self.my_wait_interval * 10)
-        self.report_questionable_acc = ExpireSet(self.my_wait_interval * 10)
+        # We will keep the reportedly failed and questionable IP addresses of
+        # each plugin in accumulating buffers. This is important, since
+        # otherwise, an update from one plugin may wipe out the update
+        # provided just before from another plugin.
+        self.report_failed_acc       = {
+            pname : ExpireSet(self.my_wait_interval * 10)
+            for pname in self.failed_queue_lookup}
+        self.report_questionable_acc = {
+            pname : ExpireSet(self.my_wait_interval * 10)
+            for pname in self.questionable_queue_lookup}
+
+        weights = parse_weights(self.conf.get('multi_weights'),
+                                self.failed_queue_lookup.keys())
+        self.failed_policy           = CombinationPolicy(
+                                self.conf.get('multi_failed_policy', "any"),
+                                weights)
+        self.questionable_policy     = CombinationPolicy(
+                                self.conf.get('multi_questionable_policy',
+                                              "any"),
+                                weights)
 
     def get_monitor_interval(self):
         """
         Return the sleep time between monitoring intervals.
 
-        For the multi plugin the sleep time is double of the max monitoring
-        interval of each sub-plugin. That should give us plenty of time to
-        receive updates.
+        For the multi plugin this is double of the max monitoring interval of
+        each sub-plugin. It doesn't wait that long for reports, though: It's
+        woken up as soon as any sub-plugin reports. The interval is only the
+        longest time between two passes.
 
         """
         return self.my_wait_interval
@@ -197,13 +386,22 @@ class Multi(common.MonitorPlugin):
                 "version"     : self.get_version(),
                 "sub-plugins" : plugin_infos,
                 "params" : {
-                    "multi_plugins" : self.conf['multi_plugins']
+                    "multi_plugins"       : self.conf['multi_plugins'],
+                    "multi_failed_policy" : self.failed_policy.spec,
+                    "multi_weights"       : self.conf.get('multi_weights'),
+                    "multi_questionable_policy" :
+                        self.questionable_policy.spec
+                },
+                "stats" : {
+                    "failed_policy"       : self.failed_policy.get_stats(),
+                    "questionable_policy" :
+                        self.questionable_policy.get_stats()
                 },
             }
         }
 
     def _accumulate_ips_from_plugins(self, ip_type_name, plugin_queue_lookup,
-                                     ip_accumulator):
+                                     ip_accumulators, policy):
         """
         Retrieve all IPs of a given type from all sub-plugins.
 
@@ -212,13 +410,17 @@ class Multi(common.MonitorPlugin):
                              'questionable'.
         plugin_queue_lookup: Dictionary to lookup the queues (of a given type)
                              for a plugins, by plugin name.
-        ip_accumulator:      An expiring data set for this type of IP address.
+        ip_accumulators:     The expiring data sets of each plugin for this
+                             type of IP address.
+        policy:              The CombinationPolicy for this type of IP
+                             address.
 
-        Returns either a set of addresses to send out on our own reporting
-        queues, or None.
+        Returns either a list of addresses to send out on our own reporting
+        queues (which may be empty, if the policy suppressed all of them), or
+        None.
 
         """
-        all_reported_ips  = set()
+        any_reported = False
         for pname, q in plugin_queue_lookup.items():
             # Get all the IPs of the specified type from all the plugins.
             ips = utils.read_last_msg_from_queue(q)
@@ -227,7 +429,8 @@ class Multi(common.MonitorPlugin):
                               "%s IPs: %s" %
                               (pname, len(ips), ip_type_name,
                                ",".join(ips)))
-                all_reported_ips.update(ips)  # merge all the lists
+                ip_accumulators[pname].update(ips)
+                any_reported = True
             else:
                 logging.debug("Sub-plugin '%s' reported no "
                               "%s IPs." % (pname, ip_type_name))
@@ -241,17 +444,21 @@ class Multi(common.MonitorPlugin):
         # times (and not always at the same time), we need to accumulate those
         # IPs that are recorded by different sub-plugins over time.
         #
-        # We use an 'expiring data set' to store those: If any plugin refreshes
-        # an IP as failed then the entry remains, otherwise, it will expire
-        # after some time. The expiring data set therefore, is an accumulation
-        # of recently reported IPs. We always report this set, whenever we send
-        # out an update of IPs.
+        # We use an 'expiring data set' for each plugin to store those: If the
+        # plugin refreshes an IP as failed then the entry remains, otherwise,
+        # it will expire after some time. The expiring data set therefore, is
+        # an accumulation of recently reported IPs. Whenever we send out an
+        # update of IPs, the policy decides which of the IPs in those sets are
+        # reported, based on which plugins reported them.
         #
         # Each type of IP (for example, 'failed' or 'questionable') has its own
-        # accumulator, which was passed in to this function.
-        if all_reported_ips:
-            ip_accumulator.update(all_reported_ips)
-            current_ips = ip_accumulator.get()
+        # accumulators and policy, which were passed in to this function.
+        if any_reported:
+            votes = {}
+            for pname, acc in ip_accumulators.items():
+                for ip in acc.get():
+                    votes.setdefault(ip, []).append(pname)
+            current_ips = policy.decide(votes)
             logging.info("Multi-plugin health monitor: "
                          "Reporting combined list of %s "
                          "IPs: %s" %
@@ -273,7 +480,10 @@ class Multi(common.MonitorPlugin):
 
         Note that we don't have to push any updates about failed IPs if nothing
         new was detected. Therefore, our own updates can be entirely driven by
-        updates from the sub-plugin, which keeps our architecture simple.
+        updates from the sub-plugin, which keeps our architecture simple. We
+        wait until any of the sub-plugins publishes a report (or we receive a
+        new list of IPs) and then forward the combined reports right away, so
+        that we don't add any latency of our own.
 
         """
         logging.info("Multi-plugin health monitor: Started in thread.")
@@ -292,18 +502,24 @@ class Multi(common.MonitorPlugin):
                 all_failed_ips = self._accumulate_ips_from_plugins(
                                             "failed",
                                             self.failed_queue_lookup,
-                                            self.report_failed_acc)
-                if all_failed_ips:
+                                            self.report_failed_acc,
+                                            self.failed_policy)
+                if all_failed_ips is not None:
                     self.q_failed_ips.put(all_failed_ips)
 
                 all_questionable_ips = self._accumulate_ips_from_plugins(
                                             "questionable",
                                             self.questionable_queue_lookup,
-                                            self.report_questionable_acc)
-                if all_questionable_ips:
+                                            self.report_questionable_acc,
+                                            self.questionable_policy)
+                if all_questionable_ips is not None:
                     self.q_questionable_ips.put(all_questionable_ips)
 
-                time.sleep(self.get_monitor_interval())
+                # The event is cleared before the queues are read in the next
+                # pass, so reports, which arrive while we're busy, wake us up
+                # again.
+                self._wakeup.wait(self.get_monitor_interval())
+                self._wakeup.clear()
 
         except common.StopReceived:
             # Received the stop signal, just exiting the thread function
@@ -368,7 +584,27 @@ class Multi(common.MonitorPlugin):
                                  "plugins (only for 'multi' health monitor "
                                  "plugin)")
 
-        arglist = ["multi_plugins"]
+        parser.add_argument('--multi_failed_policy',
+                            dest='multi_failed_policy', default="any",
+                            help="policy for combining the failed IPs of "
+                                 "the plugins: any, all, quorum:<k> or "
+                                 "weighted:<threshold>, default: any "
+                                 "(only for 'multi' health monitor plugin)")
+        parser.add_argument('--multi_questionable_policy',
+                            dest='multi_questionable_policy', default="any",
+                            help="policy for combining the questionable IPs "
+                                 "of the plugins, same choices as for "
+                                 "failed IPs, default: any "
+                                 "(only for 'multi' health monitor plugin)")
+        parser.add_argument('--multi_weights',
+                            dest='multi_weights', default=None,
+                            help="weights of the plugins for weighted "
+                                 "policies, as 'name=weight:...', default "
+                                 "weight: 1 (only for 'multi' health monitor "
+                                 "plugin)")
+
+        arglist = ["multi_plugins", "multi_failed_policy",
+                   "multi_questionable_policy", "multi_weights"]
 
         # Read the list of the specified sub-plugins ahead of time, so we can
         # get their classes and add their parameters.
@@ -399,6 +635,13 @@ class Multi(common.MonitorPlugin):
             raise ArgsError("A specification of health monitor plugins "
                             "is required (--multi_plugins).")
 
+        # The combination policies need to be valid for these plugins
+        weights = parse_weights(conf.get('multi_weights'),
+                                conf['multi_plugins'].split(":"))
+        for policy_param in ["multi_failed_policy",
+                             "multi_questionable_policy"]:
+            CombinationPolicy(conf.get(policy_param, "any"), weights)
+
         # Now check parameters for all sub-plugins. We use the list of classes
         # for sub-plugins that we discovered earlier while adding parameters
         # for those sub-plugins.
@@ -0,0 +1,62 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Unit tests for the events module
+#
+
+import threading
+import time
+import unittest
+
+from vpcrouter.events import EventLog, EventType
+
+
+class TestEventLog(unittest.TestCase):
+
+    def test_ring_buffer(self):
+        log = EventLog(maxlen=3)
+        self.assertEqual(log.get_since(0), [])
+        for i in range(5):
+            log.emit(EventType.ROUTER_FAILED, ip="10.0.0.%d" % i)
+        self.assertEqual(log.last_id(), 5)
+
+        # Only the most recent events are kept
+        self.assertEqual([e['id'] for e in log.get_since(0)], [3, 4, 5])
+        self.assertEqual([e['id'] for e in log.get_since(4)], [5])
+        self.assertEqual(log.get_since(4)[0]['data'], {"ip" : "10.0.0.4"})
+        self.assertEqual(log.get_since(5), [])
+
+        # IDs from before a restart start the client from the beginning
+        self.assertEqual([e['id'] for e in log.get_since(99)], [3, 4, 5])
+
+    def test_wait(self):
+        log = EventLog()
+        start = time.time()
+        self.assertEqual(log.get_since(0, timeout=0.2), [])
+        self.assertTrue(time.time() - start >= 0.2)
+
+        t = threading.Timer(0.2, log.emit, [EventType.SPEC_APPLIED])
+        t.start()
+        events = log.get_since(0, timeout=5)
+        t.join()
+        self.assertEqual([e['type'] for e in events],
+                         [EventType.SPEC_APPLIED])
+
+
+if __name__ == '__main__':
+    unittest.main()
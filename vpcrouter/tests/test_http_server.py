@@ -21,9 +21,14 @@ limitations under the License.
 
 import json
 import requests
+import socket
+import threading
+import time
 import unittest
 
-from vpcrouter.main import http_server
+from vpcrouter.currentstate import CURRENT_STATE
+from vpcrouter.events       import EVENTS, EventType
+from vpcrouter.main         import http_server
 
 
 class TestHttpServer(unittest.TestCase):
@@ -47,3 +52,234 @@ class TestHttpServer(unittest.TestCase):
         self.assertEqual(d['plugins'], {'_href': '/plugins'})
         self.assertEqual(d['route_info'], {'_href': '/route_info'})
         self.assertEqual(d['ips'], {'_href': '/ips'})
+
+    def test_snapshot(self):
+        CURRENT_STATE.route_spec = {"10.1.0.0/16" : ["10.0.0.1"]}
+        CURRENT_STATE.publish_snapshot(["route_info"])
+        self.addCleanup(CURRENT_STATE.publish_snapshot)
+        self.addCleanup(setattr, CURRENT_STATE, "route_spec", {})
+
+        # Changes to the live state are not visible until they are published
+        CURRENT_STATE.route_spec["10.2.0.0/16"] = ["10.0.0.2"]
+        r = requests.get("http://localhost:33445/route_info",
+                         headers={"Accept" : "application/json"})
+        d = json.loads(r.content)
+        self.assertEqual(d['route_spec'], {"10.1.0.0/16" : ["10.0.0.1"]})
+
+        CURRENT_STATE.publish_snapshot(["route_info"])
+        r = requests.get("http://localhost:33445/route_info",
+                         headers={"Accept" : "application/json"})
+        d = json.loads(r.content)
+        self.assertEqual(sorted(d['route_spec']),
+                         ["10.1.0.0/16", "10.2.0.0/16"])
+
+        # Rendering as HTML doesn't modify the snapshot
+        snapshot = CURRENT_STATE.get_state_repr("route_info")
+        CURRENT_STATE.as_html("route_info")
+        self.assertTrue(snapshot is CURRENT_STATE.get_state_repr("route_info"))
+
+    def test_lazy_rendering(self):
+        class Record(object):
+            renderings = 0
+
+            def as_dict(self):
+                Record.renderings += 1
+                return {"status" : "unchanged"}
+
+        rec = Record()
+        CURRENT_STATE.vpc_state['route_tables'] = {"rt-1" : {"10.1.0.0/16" :
+                                                             rec}}
+        self.addCleanup(CURRENT_STATE.publish_snapshot)
+        self.addCleanup(CURRENT_STATE.vpc_state.pop, 'route_tables')
+
+        # Publishing only refers to the records, they are rendered when the
+        # state is first requested, once per version.
+        CURRENT_STATE.publish_snapshot(["vpc"])
+        CURRENT_STATE.vpc_state['route_tables']["rt-1"]["10.2.0.0/16"] = rec
+        self.assertEqual(Record.renderings, 0)
+        for _ in range(2):
+            rep = CURRENT_STATE.get_state_repr("vpc")
+            self.assertEqual(rep['route_tables'],
+                             {"rt-1" : {"10.1.0.0/16" :
+                                        {"status" : "unchanged"}}})
+        self.assertEqual(Record.renderings, 1)
+
+    def test_etag(self):
+        self.addCleanup(CURRENT_STATE.publish_snapshot)
+        url = "http://localhost:33445/vpc"
+        r   = requests.get(url, headers={"Accept" : "application/json"})
+        self.assertEqual(r.status_code, 200)
+        etag = r.headers['ETag']
+
+        # Unchanged state, the client's copy is still current
+        r = requests.get(url, headers={"Accept"        : "application/json",
+                                       "If-None-Match" : etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.content, "")
+
+        # Different content type, different ETag
+        r = requests.get(url, headers={"Accept"        : "text/html",
+                                       "If-None-Match" : etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r.headers['ETag'], etag)
+
+        # Publishing a state, which only differs in its volatile values,
+        # doesn't make a new version
+        CURRENT_STATE.vpc_state['time'] = "2017-01-01T00:00:00"
+        self.addCleanup(CURRENT_STATE.vpc_state.pop, 'time', None)
+        CURRENT_STATE.publish_snapshot(["vpc"])
+        r = requests.get(url, headers={"Accept"        : "application/json",
+                                       "If-None-Match" : etag})
+        self.assertEqual(r.status_code, 304)
+
+        # A new version of the state is rendered again
+        CURRENT_STATE.vpc_state['route_tables'] = {"rt-1" : {}}
+        self.addCleanup(CURRENT_STATE.vpc_state.pop, 'route_tables', None)
+        CURRENT_STATE.publish_snapshot(["vpc"])
+        r = requests.get(url, headers={"Accept"        : "application/json",
+                                       "If-None-Match" : etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r.headers['ETag'], etag)
+        self.assertEqual(json.loads(r.content)['time'], "2017-01-01T00:00:00")
+
+        # The top level contains live data and isn't cached
+        r = requests.get("http://localhost:33445")
+        self.assertFalse("ETag" in r.headers)
+
+    def test_keep_alive_and_concurrency(self):
+        # Several requests on the same connection
+        session = requests.Session()
+        for i in range(3):
+            r = session.get("http://localhost:33445/ips")
+            self.assertEqual(r.status_code, 200)
+            self.assertNotEqual(r.headers.get("Connection"), "close")
+        self.assertEqual(len(session.adapters['http://'].poolmanager.pools),
+                         1)
+
+        # While an idle client holds on to a connection, other clients are
+        # still served.
+        results = []
+
+        def get():
+            results.append(
+                    requests.get("http://localhost:33445/route_info").
+                    status_code)
+
+        threads = [threading.Thread(target=get) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [200] * 4)
+        session.close()
+
+    def _get_on_socket(self, sock, path="/ips"):
+        # A request on an open connection, returns the status line
+        sock.sendall("GET %s HTTP/1.1\r\nHost: localhost\r\n"
+                     "Accept: application/json\r\n\r\n" % path)
+        f = sock.makefile("rb")
+        status = f.readline()
+        length = 0
+        while True:
+            line = f.readline()
+            if line.lower().startswith("content-length:"):
+                length = int(line.split(":")[1])
+            if line in ["\r\n", ""]:
+                break
+        f.read(length)
+        f.close()
+        return status.strip()
+
+    def test_idle_connections_released(self):
+        # Idle keep-alive connections occupy all the handler threads
+        idle = []
+        for i in range(http_server.HTTP_THREADS_DEFAULT):
+            sock = socket.create_connection(("127.0.0.1", 33445))
+            self.addCleanup(sock.close)
+            self.assertEqual(self._get_on_socket(sock), "HTTP/1.1 200 OK")
+            idle.append(sock)
+
+        # The connection stays open for the next request
+        self.assertEqual(self._get_on_socket(idle[0]), "HTTP/1.1 200 OK")
+
+        # Another client is still served right away, since an idle connection
+        # is closed for it.
+        start = time.time()
+        r = requests.get("http://localhost:33445/route_info")
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(time.time() - start <
+                        http_server.KEEPALIVE_TIMEOUT / 2.0)
+        closed = 0
+        for sock in idle:
+            sock.settimeout(0.5)
+            try:
+                if sock.recv(1) == "":
+                    closed += 1
+            except socket.timeout:
+                pass
+        self.assertTrue(closed >= 1)
+
+    def test_connection_backlog(self):
+        # Without handler threads, connections wait in the queue, until the
+        # backlog is full.
+        server = http_server._ThreadPoolWSGIServer(
+                            ("127.0.0.1", 0),
+                            http_server._KeepAliveRequestHandler, 0, 2)
+        self.addCleanup(server.server_close)
+        clients = []
+        for i in range(3):
+            a, b = socket.socketpair()
+            self.addCleanup(b.close)
+            server.process_request(a, ("127.0.0.1", 1000 + i))
+            clients.append(b)
+        self.assertTrue(server.connections_waiting())
+
+        # The last connection was closed
+        clients[2].settimeout(1)
+        self.assertEqual(clients[2].recv(1), "")
+        clients[0].setblocking(0)
+        self.assertRaises(socket.error, clients[0].recv, 1)
+
+    def test_gzip(self):
+        url = "http://localhost:33445/route_info"
+        r   = requests.get(url, headers={"Accept-Encoding" : "gzip"})
+        self.assertEqual(r.headers['Content-Encoding'], "gzip")
+        self.assertTrue("route_spec" in json.loads(r.content))
+        gzip_etag = r.headers['ETag']
+
+        for accept_encoding in ["identity", "gzip;q=0"]:
+            r = requests.get(url,
+                             headers={"Accept-Encoding" : accept_encoding})
+            self.assertFalse("Content-Encoding" in r.headers)
+            self.assertTrue("route_spec" in json.loads(r.content))
+            self.assertNotEqual(r.headers['ETag'], gzip_etag)
+
+    def _read_events(self, headers, num):
+        r = requests.get("http://localhost:33445/events", headers=headers,
+                         stream=True)
+        self.assertEqual(r.headers['Content-Type'], "text/event-stream")
+        events = []
+        for line in r.iter_lines(chunk_size=1):
+            if line.startswith("data: "):
+                events.append(json.loads(line[6:]))
+                if len(events) == num:
+                    break
+        r.close()
+        return events
+
+    def test_events(self):
+        first_id = EVENTS.emit(EventType.ROUTER_FAILED, ip="10.0.0.1")
+        EVENTS.emit(EventType.ROUTER_RECOVERED, ip="10.0.0.1")
+
+        events = self._read_events({"Last-Event-ID" : str(first_id - 1)}, 2)
+        self.assertEqual([(e['type'], e['data']['ip']) for e in events],
+                         [(EventType.ROUTER_FAILED, "10.0.0.1"),
+                          (EventType.ROUTER_RECOVERED, "10.0.0.1")])
+
+        # Resuming after the first event
+        events = self._read_events({"Last-Event-ID" : str(first_id)}, 1)
+        self.assertEqual(events[0]['type'], EventType.ROUTER_RECOVERED)
+
+        r = requests.get("http://localhost:33445/events",
+                         headers={"Last-Event-ID" : "foo"})
+        self.assertEqual(r.status_code, 400)
@@ -69,8 +69,20 @@ class TestArgs(unittest.TestCase):
                  'verbose': False, 'addr': 'localhost', 'mode': 'http',
                  'vpc_id': '123', 'logfile': 'foo', 'health' : 'icmpecho',
                  'icmp_check_interval' : 2.0, 'port': 33289,
-                 'route_recheck_interval' : 30, 'ignore_routes' : None,
+                 'http_threads' : 8, 'http_backlog' : 64,
+                 'http_max_route_spec_size' : 16777216,
+                 'route_recheck_interval' : 10,
+                 'route_recheck_max_interval' : 300, 'ignore_routes' : None,
                  'region_name': 'foo'}},
+            {"args" : ['-l', 'foo', '-v', '123', '-r', 'foo', '-m', 'http',
+                       '--route_recheck_interval', '3'],
+             "exc" : ArgsError, "watcher_plugin" : "http",
+             "out" : "route_recheck_interval argument must be"},
+            {"args" : ['-l', 'foo', '-v', '123', '-r', 'foo', '-m', 'http',
+                       '--route_recheck_interval', '60',
+                       '--route_recheck_max_interval', '30'],
+             "exc" : ArgsError, "watcher_plugin" : "http",
+             "out" : "route_recheck_max_interval argument must not be"},
             {"args" : ['-l', 'foo', '-v', '123', '-r', 'foo',
                        '-m', 'configfile'],
              "watcher_plugin" : "configfile",
@@ -80,6 +92,11 @@ class TestArgs(unittest.TestCase):
                        '-f', "/_does_not_exists"],
              "exc" : ArgsError, "watcher_plugin" : "configfile",
              "out" : "Cannot open config file"},
+            {"args" : ['-l', 'foo', '-v', '123', '-r', 'foo',
+                       '-m', 'configfile', '-f', "/dev/null",
+                       '--file_poll_interval', '0'],
+             "exc" : ArgsError, "watcher_plugin" : "configfile",
+             "out" : "File poll interval must be greater than 0"},
             {"args" : ['-l', 'foo', '-v', '123', '-r', 'foo',
                        '-m', 'configfile', '-p', '99999'],
              "exc" : SystemExit, "watcher_plugin" : "configfile",
@@ -88,6 +105,14 @@ class TestArgs(unittest.TestCase):
                        '-p', '99999'],
              "exc" : ArgsError, "watcher_plugin" : "http",
              "out" : "Invalid listen port"},
+            {"args" : ['-l', 'foo', '-v', '123', '-r', 'foo', '-m', 'http',
+                       '--http_threads', '0'],
+             "exc" : ArgsError, "watcher_plugin" : "http",
+             "out" : "Number of http threads must be"},
+            {"args" : ['-l', 'foo', '-v', '123', '-r', 'foo', '-m', 'http',
+                       '--http_backlog', '0'],
+             "exc" : ArgsError, "watcher_plugin" : "http",
+             "out" : "Http listen backlog must be"},
             {"args" : ['-l', 'foo', '-v', '123', '-r', 'foo', '-m', 'http',
                        '-a', '999.9'],
              "exc" : ArgsError, "watcher_plugin" : "http",
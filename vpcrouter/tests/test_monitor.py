@@ -25,6 +25,7 @@ import Queue
 import time
 
 from vpcrouter                 import utils
+from vpcrouter.errors          import ArgsError
 from vpcrouter.monitor         import common
 from vpcrouter.monitor.plugins import icmpecho, tcp, multi
 
@@ -147,7 +148,7 @@ class TestQueues(unittest.TestCase):
                 while True:
                     # Read messages until we are at the last one
                     try:
-                        res = self.q_failed_ips.get(timeout=0.5)
+                        res = self.q_failed_ips.get(timeout=0.5).payload
                         self.q_failed_ips.task_done()
                         self.assertEqual(sorted(res),
                                          sorted(expected_out))
@@ -179,14 +180,14 @@ class TestQueues(unittest.TestCase):
 
         # Only check the last one, since all above messages should be read at
         # once and all but the last one should have been ignored.
-        res = self.q_failed_ips.get()
+        res = self.q_failed_ips.get().payload
         self.q_failed_ips.task_done()
         self.assertEqual(sorted(res), sorted(expected_out))
 
         # Since the monitor will keep checking the IPs, we should keep getting
         # results without encountering an empty queue
-        res = self.q_failed_ips.get(timeout=1.5)
-        res = self.q_failed_ips.get(timeout=1.5)
+        res = self.q_failed_ips.get(timeout=1.5).payload
+        res = self.q_failed_ips.get(timeout=1.5).payload
 
     def test_monitor_state_change(self):
         #
@@ -208,13 +209,13 @@ class TestQueues(unittest.TestCase):
         _FAILED_PREFIX = "12."
 
         # Now after a little while we should receive a message for a failed IP.
-        res = self.q_failed_ips.get(timeout=2)
+        res = self.q_failed_ips.get(timeout=2).payload
         self.assertEqual(["12.0.0.0"], res)
 
         # We should continue to get notifications about that failed IP...
-        res = self.q_failed_ips.get(timeout=2)
+        res = self.q_failed_ips.get(timeout=2).payload
         self.assertEqual(["12.0.0.0"], res)
-        res = self.q_failed_ips.get(timeout=2)
+        res = self.q_failed_ips.get(timeout=2).payload
         self.assertEqual(["12.0.0.0"], res)
 
         time.sleep(1.5)  # wait and let monitor send a few more messages for 12
@@ -227,7 +228,7 @@ class TestQueues(unittest.TestCase):
         # definitely only should get messages about 13.
         seen_12 = False
         while True:
-            res = self.q_failed_ips.get(timeout=1)
+            res = self.q_failed_ips.get(timeout=1).payload
             self.assertTrue(1 <= len(res) <= 2)  # latest and currently failed
             if not seen_12:
                 # Make sure we see at least one more message for 12.
@@ -310,6 +311,16 @@ class TestMulti(unittest.TestCase):
         time.sleep(0.11)                        # now a little more expires
         self.assertEqual(exp.get(), [3])
 
+        # Entries, which are updated all the time, don't make the heap grow
+        # without bounds.
+        exp = multi.ExpireSet(100)
+        for i in range(1000):
+            exp.update(range(50))
+        self.assertEqual(sorted(exp.get()), range(50))
+        self.assertTrue(exp._heap_size <= 4 * 50 + 64)
+        self.assertEqual(exp._heap_size,
+                         sum(len(e) for _, _, e in exp._heap))
+
     def test_multi_plugin(self):
 
         class Testplugin(common.MonitorPlugin):
@@ -350,9 +361,9 @@ class TestMulti(unittest.TestCase):
         # Test that new monitor IPs are passed on.
         time.sleep(1)
         qm.put(["10.1.1.1", "10.1.1.2", "10.1.1.2"])
-        self.assertEqual(sorted(t1.q_monitor_ips.get()),
+        self.assertEqual(sorted(t1.q_monitor_ips.get().payload),
                          ["10.1.1.1", "10.1.1.2", "10.1.1.2"])
-        self.assertEqual(sorted(t2.q_monitor_ips.get()),
+        self.assertEqual(sorted(t2.q_monitor_ips.get().payload),
                          ["10.1.1.1", "10.1.1.2", "10.1.1.2"])
 
         # Sending various failed IPs through the two plugins. We should get
@@ -372,7 +383,9 @@ class TestMulti(unittest.TestCase):
                          ["10.1.1.1", "10.1.1.2", "10.1.1.3"])
         time.sleep(1)
         t1.send_failed(["10.1.1.1"])
-        time.sleep(2)
+        # Reports are accumulated as soon as they arrive, the report of
+        # 10.1.1.3 needs to be a little more than 4 seconds old to expire.
+        time.sleep(2.1)
         self.assertEqual(sorted(utils.read_last_msg_from_queue(qf)),
                          ["10.1.1.1", "10.1.1.2", "10.1.1.3"])
         t1.send_failed(["10.1.1.2"])
@@ -395,6 +408,161 @@ class TestMulti(unittest.TestCase):
                          ["10.1.2.3", "10.2.2.2", "10.2.3.4",
                           "10.3.3.3", "10.9.9.9"])
 
+    def test_multi_plugin_latency(self):
+
+        class Slowplugin(common.MonitorPlugin):
+            # A plugin with a long monitoring interval, which reports right
+            # after the multi plugin started to wait.
+            def get_monitor_interval(self):
+                return 5
+
+            def start(self):
+                pass
+
+        t1 = Slowplugin({}, "t1")
+        t2 = Slowplugin({}, "t2")
+        mp = multi.Multi({}, TEST_PLUGINS=[("t1", t1), ("t2", t2)])
+        self.mp = mp
+        mp.start()
+        qm, qf, qq = mp.get_queues()
+        self.assertEqual(mp.get_monitor_interval(), 10)
+
+        # Reports are forwarded as soon as they arrive, not after the
+        # monitoring interval.
+        time.sleep(0.2)
+        start = time.time()
+        t2.q_failed_ips.put(["10.1.1.1"])
+        self.assertEqual(qf.get(timeout=1).payload, ["10.1.1.1"])
+        t1.q_questionable_ips.put(["10.1.1.2"])
+        self.assertEqual(qq.get(timeout=1).payload, ["10.1.1.2"])
+
+        # Same for new IPs to monitor
+        qm.put(["10.1.1.1", "10.1.1.2"])
+        self.assertEqual(t1.q_monitor_ips.get(timeout=1).payload,
+                         ["10.1.1.1", "10.1.1.2"])
+        self.assertTrue(time.time() - start < 1)
+
+        # The stop signal doesn't have to wait for the interval either
+        start = time.time()
+        mp.stop()
+        self.mp = None
+        self.assertTrue(time.time() - start < 1)
+
+    def test_combination_policy(self):
+        weights = multi.parse_weights("t1=2:t3=0.5", ["t1", "t2", "t3"])
+        self.assertEqual(weights, {"t1" : 2, "t2" : 1, "t3" : 0.5})
+        votes = {"10.0.0.1" : ["t1"],
+                 "10.0.0.2" : ["t2", "t3"],
+                 "10.0.0.3" : ["t1", "t2", "t3"],
+                 "10.0.0.4" : ["t3"]}
+        for spec, expected in [
+                ("any",        ["10.0.0.1", "10.0.0.2", "10.0.0.3",
+                                "10.0.0.4"]),
+                ("all",        ["10.0.0.3"]),
+                ("quorum:2",   ["10.0.0.2", "10.0.0.3"]),
+                ("weighted:2", ["10.0.0.1", "10.0.0.3"])]:
+            policy = multi.CombinationPolicy(spec, weights)
+            self.assertEqual(policy.decide(votes), expected)
+            self.assertEqual(policy.stats,
+                             {"decisions"  : 1,
+                              "accepted"   : len(expected),
+                              "suppressed" : 4 - len(expected)})
+
+        # Only changes of the decision about an IP are counted, not IPs that
+        # are reported again and again.
+        policy = multi.CombinationPolicy("quorum:2", weights)
+        policy.decide(votes)
+        policy.decide(votes)
+        self.assertEqual(policy.get_stats(),
+                         {"decisions"      : 2,
+                          "accepted"       : 2,
+                          "suppressed"     : 2,
+                          "suppressed_ips" : ["10.0.0.1", "10.0.0.4"]})
+        self.assertEqual(policy.decide({"10.0.0.1" : ["t1", "t2"],
+                                        "10.0.0.2" : ["t2"],
+                                        "10.0.0.4" : ["t3"]}),
+                         ["10.0.0.1"])
+        self.assertEqual(policy.get_stats(),
+                         {"decisions"      : 3,
+                          "accepted"       : 3,
+                          "suppressed"     : 3,
+                          "suppressed_ips" : ["10.0.0.2", "10.0.0.4"]})
+
+        for spec, msg in [
+                ("some", "Unknown combination policy 'some'"),
+                ("any:2", "Unknown combination policy 'any:2'"),
+                ("quorum:4", "Invalid combination policy 'quorum:4': Quorum "
+                             "must be between 1 and 3, weighted threshold "
+                             "greater than 0"),
+                ("weighted:x", "Invalid combination policy 'weighted:x': "
+                               "Quorum must be between 1 and 3, weighted "
+                               "threshold greater than 0")]:
+            with self.assertRaises(ArgsError) as ex:
+                multi.CombinationPolicy(spec, weights)
+            self.assertEqual(str(ex.exception), msg)
+
+        for weights_str, msg in [
+                ("t4=1", "Weight for unknown health monitor plugin 't4'"),
+                ("t1=0", "Weight of plugin 't1' must be a number greater "
+                         "than 0"),
+                ("t1",   "Weight of plugin 't1' must be a number greater "
+                         "than 0")]:
+            with self.assertRaises(ArgsError) as ex:
+                multi.parse_weights(weights_str, ["t1", "t2"])
+            self.assertEqual(str(ex.exception), msg)
+
+        conf = {"multi_plugins"       : "icmpecho:tcp",
+                "multi_failed_policy" : "quorum:3"}
+
+        # Without sub-plugin classes, which are only found while adding the
+        # arguments, and without changing the Multi class for other tests.
+        class NoSubPlugins(multi.Multi):
+            multi_plugin_classes = []
+
+        self.assertRaises(ArgsError, NoSubPlugins.check_arguments, conf)
+
+    def test_multi_plugin_policy(self):
+
+        class Testplugin(common.MonitorPlugin):
+            def get_monitor_interval(self):
+                return 1
+
+            def start(self):
+                pass
+
+        plugins = [(name, Testplugin({}, name)) for name in ["t1", "t2", "t3"]]
+        t1, t2, t3 = [p for _, p in plugins]
+        conf = {"multi_plugins"             : "t1:t2:t3",
+                "multi_failed_policy"       : "quorum:2",
+                "multi_questionable_policy" : "weighted:2",
+                "multi_weights"             : "t1=2"}
+        mp = multi.Multi(conf, TEST_PLUGINS=plugins)
+        self.mp = mp
+        mp.start()
+        qm, qf, qq = mp.get_queues()
+
+        # A failure reported by just one plugin is suppressed...
+        t1.q_failed_ips.put(["10.1.1.1"])
+        self.assertEqual(qf.get(timeout=1).payload, [])
+        # ... until a second plugin agrees.
+        t2.q_failed_ips.put(["10.1.1.1", "10.1.1.2"])
+        self.assertEqual(qf.get(timeout=1).payload, ["10.1.1.1"])
+
+        # Questionable IPs need a weight of at least 2
+        t2.q_questionable_ips.put(["10.1.1.3"])
+        self.assertEqual(qq.get(timeout=1).payload, [])
+        t1.q_questionable_ips.put(["10.1.1.4"])
+        self.assertEqual(qq.get(timeout=1).payload, ["10.1.1.4"])
+
+        info = mp.get_info()['multi']
+        self.assertEqual(info['params']['multi_failed_policy'], "quorum:2")
+        self.assertEqual(info['stats']['failed_policy'],
+                         {"decisions" : 2, "accepted" : 1, "suppressed" : 2,
+                          "suppressed_ips" : ["10.1.1.2"]})
+        self.assertEqual(info['stats']['questionable_policy'],
+                         {"decisions" : 2, "accepted" : 1, "suppressed" : 1,
+                          "suppressed_ips" : ["10.1.1.3"]})
+
 
 if __name__ == '__main__':
     unittest.main()
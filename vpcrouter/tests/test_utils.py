@@ -19,12 +19,23 @@ limitations under the License.
 # Unit tests for the utils module
 #
 
+import Queue
+import threading
 import unittest
 
+from StringIO import StringIO
+
 from vpcrouter.utils  import ip_check, \
                              check_valid_ip_or_cidr, \
-                             is_cidr_in_cidr
-from vpcrouter.errors import ArgsError
+                             is_cidr_in_cidr, \
+                             gzip_compress, \
+                             read_stream, \
+                             ipv4_to_int, \
+                             ipv4_cidr_to_int, \
+                             Mailbox, \
+                             read_last_envelope_from_queue, \
+                             read_last_msg_from_queue
+from vpcrouter.errors import ArgsError, PayloadTooLargeError
 
 
 class TestIpCheck(unittest.TestCase):
@@ -124,5 +135,110 @@ class TestIpCheck(unittest.TestCase):
             self.assertEqual(is_cidr_in_cidr(**kwargs), res)
 
 
+class TestIpv4ToInt(unittest.TestCase):
+
+    def test_addresses(self):
+        self.assertEqual(ipv4_to_int("0.0.0.0"), 0)
+        self.assertEqual(ipv4_to_int("10.1.2.3"), 0x0a010203)
+        self.assertEqual(ipv4_to_int(u"255.255.255.255"), 0xffffffff)
+        for ip in ["1.1.1.", "1.1.1", "1.1.1.256", "1.1.1.1.1", "a.b.c.d",
+                   "-1.1.1.1", "1.1.1.0001", "::1", "", None, 123]:
+            self.assertRaises(ArgsError, ipv4_to_int, ip)
+
+    def test_cidrs(self):
+        self.assertEqual(ipv4_cidr_to_int("0.0.0.0/0"), (0, 0))
+        self.assertEqual(ipv4_cidr_to_int("10.1.0.0/16"), (0x0a010000, 16))
+        # Host bits are cleared
+        self.assertEqual(ipv4_cidr_to_int("10.1.2.3/16"), (0x0a010000, 16))
+        self.assertEqual(ipv4_cidr_to_int("10.1.2.3/32"), (0x0a010203, 32))
+        for cidr in ["10.1.0.0", "10.1.0.0/33", "10.1.0.0/", "10.1.0.0/1/2",
+                     "10.1.0/16", "10.1.0.0/-1", None]:
+            self.assertRaises(ArgsError, ipv4_cidr_to_int, cidr)
+
+
+class TestReadStream(unittest.TestCase):
+
+    def test_read_stream(self):
+        data = "0123456789" * 10000
+        self.assertEqual(read_stream(StringIO(data), 100000, chunk_size=999),
+                         data)
+        self.assertEqual(read_stream(StringIO(gzip_compress(data)), 100000,
+                                     gzipped=True, chunk_size=999),
+                         data)
+
+    def test_read_stream_limit(self):
+        data = "0" * 100001
+        with self.assertRaises(PayloadTooLargeError):
+            read_stream(StringIO(data), 100000)
+        # Highly compressible data is stopped while decompressing, even if
+        # all of it arrives in a single small chunk.
+        with self.assertRaises(PayloadTooLargeError):
+            read_stream(StringIO(gzip_compress(data * 100)), 100000,
+                        gzipped=True)
+
+    def test_read_stream_malformed(self):
+        with self.assertRaises(ValueError):
+            read_stream(StringIO("not gzipped"), 100000, gzipped=True)
+
+
+class TestMailbox(unittest.TestCase):
+
+    def test_envelopes(self):
+        q = Mailbox()
+        self.assertEqual(q.put({"a" : 1, "b" : 2}), 1)
+        e1 = q.get()
+        self.assertEqual(q.put({"b" : 2, "a" : 1}), 2)
+        e2 = q.get()
+        self.assertEqual(q.put({"a" : 1}), 3)
+        e3 = q.get()
+
+        self.assertEqual((e1.payload, e1.generation), ({"a" : 1, "b" : 2}, 1))
+        self.assertEqual(e2.generation, 2)
+        self.assertTrue(e1.timestamp <= e2.timestamp <= e3.timestamp)
+        # Same content, same hash
+        self.assertEqual(e1.content_hash, e2.content_hash)
+        self.assertNotEqual(e1.content_hash, e3.content_hash)
+
+        # The hash is only computed when it's asked for, unless the sender
+        # passed one in.
+        q.put({"a" : 1})
+        e4 = q.get()
+        self.assertEqual(e4._content_hash, None)
+        self.assertEqual(e4.content_hash, e3.content_hash)
+        self.assertEqual(e4._content_hash, e3.content_hash)
+        q.put({"a" : 1}, content_hash="abc")
+        self.assertEqual(q.get().content_hash, "abc")
+
+    def test_latest_value(self):
+        q = Mailbox()
+        self.assertTrue(q.empty())
+        self.assertRaises(Queue.Empty, q.get_nowait)
+        self.assertRaises(Queue.Empty, q.get, **{"timeout" : 0.1})
+
+        # A new message replaces the unread one
+        q.put(["10.0.0.1"])
+        q.put(["10.0.0.2"])
+        self.assertEqual(q.version, 2)
+        e = read_last_envelope_from_queue(q)
+        self.assertEqual((e.payload, e.generation), (["10.0.0.2"], 2))
+        self.assertTrue(q.empty())
+        self.assertEqual(read_last_msg_from_queue(q), None)
+        q.put(["10.0.0.3"])
+        self.assertEqual(read_last_msg_from_queue(q), ["10.0.0.3"])
+
+        # A blocking get is woken up by a new message
+        t = threading.Timer(0.2, q.put, [["10.0.0.4"]])
+        t.start()
+        self.assertEqual(q.get(timeout=5).payload, ["10.0.0.4"])
+        t.join()
+
+        # Listeners are called for every new message
+        events = threading.Event()
+        q.add_listener(events.set)
+        self.assertFalse(events.is_set())
+        q.put(["10.0.0.5"])
+        self.assertTrue(events.is_set())
+
+
 if __name__ == '__main__':
     unittest.main()
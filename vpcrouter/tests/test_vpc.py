@@ -28,6 +28,7 @@ from testfixtures  import LogCapture
 
 from vpcrouter              import vpc
 from vpcrouter.currentstate import CURRENT_STATE
+from vpcrouter.events       import EVENTS, EventType
 from vpcrouter.errors       import VpcRouteSetError
 
 from . import test_common
@@ -195,7 +196,9 @@ class TestVpcBotoInteractions(unittest.TestCase):
 
         # Process a simple route spec, a route should have been added
         self.lc.clear()
-        vpc.process_route_spec_config(con, d, route_spec, [], [])
+        summary = vpc.process_route_spec_config(con, d, route_spec, [], [])
+        self.assertEqual(summary['added'], 1)
+        self.assertEqual(summary['errors'], 0)
         # One of the hosts is randomly chosen. We seeded the random number
         # generator at in this module, so we know that it will choose the
         # second host in this case.
@@ -261,8 +264,9 @@ class TestVpcBotoInteractions(unittest.TestCase):
         # Now all IPs for a route have failed
         d = vpc.get_vpc_overview(con, self.new_vpc.id, "ap-southeast-2")
         self.lc.clear()
-        vpc.process_route_spec_config(con, d, route_spec,
-                                      [self.i1ip, self.i2ip], [])
+        summary = vpc.process_route_spec_config(con, d, route_spec,
+                                                [self.i1ip, self.i2ip], [])
+        self.assertEqual(summary['no_target'], 1)
         self.lc.check(
             ('root', 'DEBUG',
              'Route spec processing. Failed IPs: %s,%s' %
@@ -316,6 +320,20 @@ class TestVpcBotoInteractions(unittest.TestCase):
              "10.3.0.0/16 -> %s (%s, %s)" %
              (rt_id, self.i1ip, i1.id, eni1.id)))
 
+        # Once nothing changes anymore, the route records are kept and the
+        # published VPC state stays the same.
+        for _ in range(2):
+            d = vpc.get_vpc_overview(con, self.new_vpc.id, "ap-southeast-2")
+            vpc.process_route_spec_config(con, d, route_spec, [], [])
+            version = CURRENT_STATE.get_state_version("vpc")
+            routes  = CURRENT_STATE.vpc_state['route_tables'][rt_id]
+            rec     = routes["10.3.0.0/16"]
+        d = vpc.get_vpc_overview(con, self.new_vpc.id, "ap-southeast-2")
+        vpc.process_route_spec_config(con, d, route_spec, [], [])
+        self.assertEqual(CURRENT_STATE.get_state_version("vpc"), version)
+        routes = CURRENT_STATE.vpc_state['route_tables'][rt_id]
+        self.assertTrue(routes["10.3.0.0/16"] is rec)
+
     @mock_ec2_deprecated
     def test_add_new_route(self):
         con, d, i1, eni1, i2, eni2, rt_id = self._prepare_mock_env()
@@ -352,6 +370,13 @@ class TestVpcBotoInteractions(unittest.TestCase):
              "10.9.0.0/16 -> %s (%s, %s) "
              "(old IP: %s, reason: foobar)" %
              (rt_id, self.i2ip, i2.id, eni2.id, self.i1ip)))
+        rec = CURRENT_STATE.vpc_state['route_tables'][rt_id]["10.9.0.0/16"]
+        self.assertEqual((rec.status, rec.router_ip, rec.old_router_ip),
+                         (vpc.RouteStatus.UPDATED, self.i2ip, self.i1ip))
+        e = EVENTS.get_since(EVENTS.last_id() - 1)[0]
+        self.assertEqual((e['type'], e['data']['dcidr'],
+                          e['data']['router_ip']),
+                         (EventType.ROUTE_CHANGED, "10.9.0.0/16", self.i2ip))
 
         self.lc.clear()
         vpc._update_route("10.9.0.0/16", "9.9.9.9", self.i2ip, d, con, rt_id,
@@ -362,6 +387,9 @@ class TestVpcBotoInteractions(unittest.TestCase):
              "10.9.0.0/16 -> %s (Could not find instance/eni "
              "for '9.9.9.9' in VPC '%s'.)" %
              (rt_id, self.i2ip, self.new_vpc.id)))
+        rec = CURRENT_STATE.vpc_state['route_tables'][rt_id]["10.9.0.0/16"]
+        self.assertEqual(rec.status, vpc.RouteStatus.FAILED)
+        self.assertTrue("Could not find instance/eni" in rec.detail)
 
         # Trying to update a non-existent route
         self.lc.clear()
@@ -378,6 +406,46 @@ class TestVpcBotoInteractions(unittest.TestCase):
              (rt_id, self.i2ip, rt_id))
         )
 
+    def test_prune_rt_state(self):
+        CURRENT_STATE.vpc_history.clear()
+        rec = vpc.RouteState(vpc.RouteStatus.CURRENT,
+                             vpc.RouteReason.UP_TO_DATE,
+                             "10.1.0.1", "i-1", "eni-1", None, None, 1.0)
+        deleted = rec._replace(status=vpc.RouteStatus.DELETED,
+                               reason=vpc.RouteReason.NOT_IN_SPEC)
+        old_state = {
+            "rt-1" : {"10.1.0.0/16" : rec, "10.2.0.0/16" : rec,
+                      "10.3.0.0/16" : deleted},
+            "rt-2" : {"10.1.0.0/16" : rec}
+        }
+        new_state = {
+            "rt-1" : {"10.1.0.0/16" : rec, "10.4.0.0/16" : deleted}
+        }
+        vpc._prune_rt_state(old_state, new_state)
+
+        # Deleted routes are moved out of the state, routes and route tables
+        # we don't see anymore end up in the history as well. Routes that had
+        # been deleted in an earlier run are not recorded again.
+        self.assertEqual(new_state, {"rt-1" : {"10.1.0.0/16" : rec}})
+        self.assertEqual(
+            sorted((r.route_table_id, r.dcidr, r.reason)
+                   for r in CURRENT_STATE.vpc_history),
+            [("rt-1", "10.2.0.0/16", vpc.RouteReason.ROUTE_GONE),
+             ("rt-1", "10.4.0.0/16", vpc.RouteReason.NOT_IN_SPEC),
+             ("rt-2", "10.1.0.0/16", vpc.RouteReason.ROUTE_TABLE_GONE)])
+
+        CURRENT_STATE.publish_snapshot()
+        rendered = CURRENT_STATE.get_state_repr("vpc")['recently_removed']
+        self.assertEqual(len(rendered), 3)
+        self.assertEqual(rendered[0]['last_state']['router_ip'], "10.1.0.1")
+
+        # The history is bounded
+        for i in range(CURRENT_STATE.VPC_STATE_HISTORY_SIZE + 10):
+            vpc._prune_rt_state({"rt-1" : {"10.2.0.0/16" : rec}}, {})
+        self.assertEqual(len(CURRENT_STATE.vpc_history),
+                         CURRENT_STATE.VPC_STATE_HISTORY_SIZE)
+        CURRENT_STATE.vpc_history.clear()
+
     @mock_ec2_deprecated
     def test_get_real_instance_if_mismatched(self):
         con, d, i1, eni1, i2, eni2, rt_id = self._prepare_mock_env()
@@ -452,10 +520,9 @@ class TestVpcBotoInteractions(unittest.TestCase):
         self.assertTrue(rt_id in CURRENT_STATE.vpc_state['route_tables'])
         self.assertTrue("10.0.0.0/16" in
                         CURRENT_STATE.vpc_state['route_tables'][rt_id])
-        self.assertTrue("Ignored: Protected CIDR" in
-                        CURRENT_STATE.vpc_state['route_tables']
-                                               [rt_id]
-                                               ["10.0.0.0/16"])
+        rec = CURRENT_STATE.vpc_state['route_tables'][rt_id]["10.0.0.0/16"]
+        self.assertEqual(rec.status, vpc.RouteStatus.IGNORED)
+        self.assertEqual(rec.reason, vpc.RouteReason.PROTECTED_CIDR)
         self.lc.check()
 
         # Now we un-protect the route and try again. Moto doesn't manage the
@@ -463,12 +530,20 @@ class TestVpcBotoInteractions(unittest.TestCase):
         # route doesn't look like it's pointing to an instance
         CURRENT_STATE.ignore_routes = []
         vpc._update_existing_routes(route_spec, [], [], d, con, routes_in_rts)
-        self.assertTrue("Ignored: Not a route to an instance" in
-                        CURRENT_STATE.vpc_state['route_tables']
-                                               [rt_id]
-                                               ["10.0.0.0/16"])
+        rec = CURRENT_STATE.vpc_state['route_tables'][rt_id]["10.0.0.0/16"]
+        self.assertEqual(rec.status, vpc.RouteStatus.IGNORED)
+        self.assertEqual(rec.reason, vpc.RouteReason.NOT_INSTANCE_ROUTE)
         self.lc.check()
 
+        # The records are only rendered when the published state is
+        # requested
+        CURRENT_STATE.publish_snapshot()
+        rendered = CURRENT_STATE.get_state_repr("vpc")
+        rendered = rendered['route_tables'][rt_id]["10.0.0.0/16"]
+        self.assertEqual(rendered['status'], "ignored")
+        self.assertEqual(rendered['msg'], "not a route to an instance")
+        self.assertTrue(rendered['time'])
+
         # Now we manually set the instance and eni id in the route, so that the
         # test can proceed.
         rt = d['route_tables'][0]
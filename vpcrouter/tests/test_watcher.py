@@ -19,23 +19,39 @@ limitations under the License.
 # Unit tests for the watcher module
 #
 
+import argparse
+import BaseHTTPServer
+import copy
 import json
 import logging
 import os
+import Queue
 import requests
 import shutil
+import SocketServer
 import tempfile
+import threading
 import time
 import unittest
+import urllib
+import urlparse
 
 from testfixtures       import LogCapture
-from watchdog.observers import Observer
 
 from vpcrouter                 import main
+from vpcrouter                 import utils
 from vpcrouter                 import watcher
 from vpcrouter                 import vpc
+from vpcrouter.currentstate    import CURRENT_STATE
+from vpcrouter.errors          import ArgsError
+from vpcrouter.events          import EVENTS, EventType
 from vpcrouter.main            import http_server
+from vpcrouter.watcher         import binspec
+from vpcrouter.watcher         import filewatch
 from vpcrouter.watcher.plugins import configfile
+from vpcrouter.watcher.plugins import kvstore
+from vpcrouter.watcher.plugins import multi as watcher_multi
+from vpcrouter.watcher.plugins import url
 
 from . import test_common
 
@@ -80,6 +96,8 @@ class TestRouteSpec(TestBase):
         abs_fname = self.temp_dir + "/r.spec"
 
         class MyQueue(object):
+            msg = None
+
             def put(self, msg):
                 self.msg = msg
 
@@ -90,10 +108,13 @@ class TestRouteSpec(TestBase):
                                               route_spec_abspath = abs_fname,
                                               q_route_spec       = myq,
                                               plugin             = None)
-            # Install the file observer on the directory
-            observer_thread = Observer()
-            observer_thread.schedule(handler, self.temp_dir)
-            observer_thread.start()
+            # Install the file watcher on the file
+            file_watcher = filewatch.FileWatcher(abs_fname,
+                                                 handler.file_changed,
+                                                 poll_interval=0.5)
+            file_watcher.start()
+            self.addCleanup(file_watcher.join)
+            self.addCleanup(file_watcher.stop)
 
             # A write event to the file should be detected
             f.write("blah")
@@ -119,6 +140,182 @@ class TestRouteSpec(TestBase):
                  "Config ignored: Cannot open file: [Errno 2] "
                  "No such file or directory: 'r.spec'"))
 
+    def test_file_event_debounce(self):
+        #
+        # Several events in a row only cause the file to be read once, and
+        # the route spec is only sent out if the content changed.
+        #
+        abs_fname = self.temp_dir + "/r.spec"
+
+        class MyQueue(object):
+            def __init__(self):
+                self.msgs = []
+
+            def put(self, msg, content_hash=None):
+                self.msgs.append(msg)
+
+        myq     = MyQueue()
+        handler = configfile.RouteSpecChangeEventHandler(
+                                          route_spec_fname   = abs_fname,
+                                          route_spec_abspath = abs_fname,
+                                          q_route_spec       = myq,
+                                          plugin             = None,
+                                          debounce_time      = 0.3)
+        file_watcher = filewatch.FileWatcher(abs_fname, handler.file_changed,
+                                             poll_interval=0.5)
+        file_watcher.start()
+        self.addCleanup(file_watcher.join)
+        self.addCleanup(file_watcher.stop)
+
+        # A file that's written in several steps is only read when it's
+        # complete.
+        with open(abs_fname, "w+") as f:
+            for c in json.dumps({"10.1.0.0/16" : ["1.1.1.1"]}):
+                f.write(c)
+                f.flush()
+        time.sleep(1)
+        self.assertEqual(myq.msgs, [{"10.1.0.0/16" : ("1.1.1.1",)}])
+
+        # Writing the same content again doesn't send out the route spec
+        with open(abs_fname, "w+") as f:
+            f.write(json.dumps({"10.1.0.0/16" : ["1.1.1.1"]}))
+        time.sleep(1)
+        self.assertEqual(len(myq.msgs), 1)
+
+        # A new file renamed into place is detected
+        with open(self.temp_dir + "/r.spec.tmp", "w+") as f:
+            f.write(json.dumps({"10.2.0.0/16" : ["2.2.2.2"]}))
+        os.rename(self.temp_dir + "/r.spec.tmp", abs_fname)
+        time.sleep(1)
+        self.assertEqual(myq.msgs[1:], [{"10.2.0.0/16" : ("2.2.2.2",)}])
+
+    def test_file_written_while_loading(self):
+        #
+        # The hash of the content that was parsed is remembered, even if the
+        # file changes while it's being loaded.
+        #
+        abs_fname = self.temp_dir + "/r.spec"
+        with open(abs_fname, "w+") as f:
+            f.write(json.dumps({"10.1.0.0/16" : ["1.1.1.1"]}))
+
+        orig_parse = configfile.common.parse_route_spec_config
+
+        def parse_and_write(data):
+            with open(abs_fname, "w+") as f:
+                f.write(json.dumps({"10.2.0.0/16" : ["2.2.2.2"]}))
+            return orig_parse(data)
+
+        q       = utils.Mailbox()
+        handler = configfile.RouteSpecChangeEventHandler(
+                                          route_spec_fname   = abs_fname,
+                                          route_spec_abspath = abs_fname,
+                                          q_route_spec       = q,
+                                          plugin             = None)
+        configfile.common.parse_route_spec_config = parse_and_write
+        try:
+            handler.load_route_spec()
+        finally:
+            configfile.common.parse_route_spec_config = orig_parse
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.1.0.0/16" : ("1.1.1.1",)})
+
+        # The content written meanwhile is a change
+        handler.load_route_spec()
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.2.0.0/16" : ("2.2.2.2",)})
+
+    def test_jsonl_file_written_while_loading(self):
+        #
+        # JSON Lines files are hashed line by line while they are parsed. The
+        # hash of the lines that were parsed is remembered, even if the file
+        # changes while it's being read.
+        #
+        abs_fname = self.temp_dir + "/r.jsonl"
+        with open(abs_fname, "w+") as f:
+            f.write('{"10.1.0.0/16" : ["1.1.1.1"]}\n'
+                    '{"10.3.0.0/16" : ["3.3.3.3"]}\n')
+
+        orig_parse = configfile.common.parse_route_spec_lines
+
+        def write_after_first_line(lines):
+            yield next(lines)
+            with open(abs_fname, "w+") as f:
+                f.write('{"10.2.0.0/16" : ["2.2.2.2"]}\n')
+            for line in lines:
+                yield line
+
+        q       = utils.Mailbox()
+        handler = configfile.RouteSpecChangeEventHandler(
+                                          route_spec_fname   = abs_fname,
+                                          route_spec_abspath = abs_fname,
+                                          q_route_spec       = q,
+                                          plugin             = None)
+        configfile.common.parse_route_spec_lines = \
+                    lambda lines: orig_parse(write_after_first_line(lines))
+        try:
+            handler.load_route_spec()
+        finally:
+            configfile.common.parse_route_spec_lines = orig_parse
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.1.0.0/16" : ("1.1.1.1",),
+                          "10.3.0.0/16" : ("3.3.3.3",)})
+
+        # The content written meanwhile is a change
+        handler.load_route_spec()
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.2.0.0/16" : ("2.2.2.2",)})
+
+        # Unchanged content is not sent again
+        handler.load_route_spec()
+        self.assertRaises(Queue.Empty, q.get, timeout=0.1)
+
+    def test_file_watcher(self):
+        abs_fname = self.temp_dir + "/r.spec"
+        with open(abs_fname, "w+") as f:
+            f.write("{}")
+
+        for use_inotify, poll_interval in [(True, 60), (False, 0.2)]:
+            changes = []
+            file_watcher = filewatch.FileWatcher(
+                                    abs_fname, lambda: changes.append(1),
+                                    poll_interval=poll_interval,
+                                    use_inotify=use_inotify)
+            self.assertEqual(file_watcher.uses_inotify, use_inotify)
+            file_watcher.start()
+
+            # Changes to other files in the directory are ignored
+            with open(self.temp_dir + "/foo", "w+") as f:
+                f.write("foo")
+            time.sleep(0.5)
+            self.assertEqual(changes, [])
+
+            # Changing the file
+            with open(abs_fname, "a") as f:
+                f.write(" ")
+            time.sleep(0.5)
+            self.assertTrue(changes)
+
+            # Deleting the file and renaming a new file into place
+            os.remove(abs_fname)
+            time.sleep(0.5)
+            del changes[:]
+            with open(self.temp_dir + "/r.spec.tmp", "w+") as f:
+                f.write("{ }")
+            os.rename(self.temp_dir + "/r.spec.tmp", abs_fname)
+            time.sleep(0.5)
+            self.assertTrue(changes)
+
+            # The file is still watched after it was replaced
+            del changes[:]
+            with open(abs_fname, "a") as f:
+                f.write(" ")
+            time.sleep(0.5)
+            self.assertTrue(changes)
+
+            file_watcher.stop()
+            file_watcher.join(1)
+            self.assertFalse(file_watcher.is_alive())
+
     def test_route_spec_parser(self):
         #
         # Test the spec parsing function with a number of different inputs,
@@ -130,17 +327,27 @@ class TestRouteSpec(TestBase):
                             "10.1.0.0/16" : ["1.1.1.1", "2.2.2.2"],
                             "10.2.0.0/16" : ["3.3.3.3"]
                         },
-                "res" : "IDENT"
+                "res" : {
+                            "10.1.0.0/16" : ("1.1.1.1", "2.2.2.2"),
+                            "10.2.0.0/16" : ("3.3.3.3",)
+                        },
             },
             {
                 "inp" : {
-                            "10.1.0.0/16" : ["1.1.1.1", "2.2.2.2", "2.2.2.2"],
+                            "10.1.0.0/16" : ["2.2.2.2", "1.1.1.1", "2.2.2.2"],
                             "10.2.0.0/16" : ["3.3.3.3"]
                         },
                 "res" : {
-                            "10.1.0.0/16" : ["1.1.1.1", "2.2.2.2"],
-                            "10.2.0.0/16" : ["3.3.3.3"]
+                            "10.1.0.0/16" : ("1.1.1.1", "2.2.2.2"),
+                            "10.2.0.0/16" : ("3.3.3.3",)
+                        },
+            },
+            {
+                # malformed CIDR
+                "inp" : {
+                            "10.1.0.0/33" : ["1.1.1.1"],
                         },
+                "res" : None
             },
             {
                 # malformed list of IPs
@@ -169,13 +376,273 @@ class TestRouteSpec(TestBase):
                                   watcher.common.parse_route_spec_config,
                                   test_data['inp'])
             else:
-                if test_data['res'] == 'IDENT':
-                    expected_out = test_data['inp']
-                else:
-                    expected_out = test_data['res']
+                inp = copy.deepcopy(test_data['inp'])
+                res = watcher.common.parse_route_spec_config(inp)
+                self.assertEqual(test_data['res'], res)
+                # The input isn't modified
+                self.assertEqual(test_data['inp'], inp)
+                # Validating the same spec again gives the same result
+                self.assertEqual(res,
+                                 watcher.common.parse_route_spec_config(inp))
+
+    def test_route_spec_lines(self):
+        lines = [
+            '# Generated route spec',
+            '{"10.1.0.0/16" : ["1.1.1.1", "2.2.2.2"]}',
+            '',
+            '{"10.2.0.0/16" : ["2.2.2.2", "1.1.1.1"], '
+            '"10.3.0.0/16" : ["3.3.3.3"]}'
+        ]
+        spec = watcher.common.parse_route_spec_lines(lines)
+        self.assertEqual(spec, {"10.1.0.0/16" : ("1.1.1.1", "2.2.2.2"),
+                                "10.2.0.0/16" : ("1.1.1.1", "2.2.2.2"),
+                                "10.3.0.0/16" : ("3.3.3.3",)})
+        self.assertTrue(type(spec) is watcher.common.RouteSpec)
+
+        for bad_line, msg in [
+                ('{"10.4.0.0/16" : ["1.1.1."]}',
+                 "Line 5: Not a valid IP address (1.1.1.)"),
+                ('{"10.1.0.0/16" : ["1.1.1.1"]}',
+                 "Line 5: Duplicate CIDR '10.1.0.0/16'"),
+                ('["10.4.0.0/16"]', "Line 5: Expected dictionary"),
+                ('{"10.4.0.0/16" : ', "Line 5: ")]:
+            with self.assertRaises(ValueError) as ex:
+                watcher.common.parse_route_spec_lines(lines + [bad_line])
+            self.assertTrue(str(ex.exception).startswith(msg))
+
+        # Route spec files with a .jsonl extension are in JSON Lines format
+        fname = self.temp_dir + "/r.jsonl"
+        with open(fname, "w") as f:
+            f.write("\n".join(lines))
+        self.assertEqual(configfile.read_route_spec_config(fname), spec)
+        with open(fname, "a") as f:
+            f.write('\n{"10.4.0.0/33" : []}\n')
+        self.assertEqual(configfile.read_route_spec_config(fname), None)
+        self.lc.check(('root', 'ERROR',
+                       "Config ignored: Line 5: "
+                       "Not a valid CIDR (10.4.0.0/33)"))
+
+    def test_binary_spec(self):
+        spec = watcher.common.parse_route_spec_config({
+            "10.1.0.0/16" : ["1.1.1.1", "2.2.2.2"],
+            "10.2.0.0/16" : ["2.2.2.2", "1.1.1.1"],
+            "10.1.5.7/24" : ["255.255.255.255"],
+            "0.0.0.0/0"   : []
+        })
+        data = binspec.dump_binary_spec(spec)
+        # Three distinct host pools, shared by four routes
+        self.assertEqual(len(data), 24 + 4 * (2 * 3 + 3 + 3 * 4))
+        new_spec = binspec.parse_binary_spec(data)
+        self.assertEqual(new_spec, spec)
+        self.assertTrue(type(new_spec) is watcher.common.RouteSpec)
+        self.assertTrue(new_spec["10.1.0.0/16"] is new_spec["10.2.0.0/16"])
+
+        for bad_data, msg in [
+                (data[:10], "Truncated header"),
+                ("X" + data[1:], "Invalid magic bytes"),
+                (data[:8] + "\x02" + data[9:], "Unsupported version 2"),
+                (data[:-4], "Expected 108 bytes, got 104"),
+                (data[:-4] + "\x07\x00\x00\x00", "Invalid route 3")]:
+            with self.assertRaises(ValueError) as ex:
+                binspec.parse_binary_spec(bad_data)
+            self.assertEqual(str(ex.exception),
+                             "Binary route spec: " + msg)
+
+        # The converter tool writes a file, which the configfile plugin
+        # recognizes by its magic bytes.
+        json_fname = self.temp_dir + "/r.json"
+        bin_fname  = self.temp_dir + "/r.conf"
+        with open(json_fname, "w") as f:
+            f.write(json.dumps(spec))
+        self.assertEqual(binspec.main([json_fname, bin_fname]), 0)
+        self.assertFalse(os.path.exists(bin_fname + ".tmp%d" % os.getpid()))
+        with open(bin_fname, "rb") as f:
+            self.assertTrue(binspec.is_binary_spec(f))
+            self.assertEqual(f.tell(), 0)
+        with open(json_fname, "rb") as f:
+            self.assertFalse(binspec.is_binary_spec(f))
+        self.assertEqual(configfile.read_route_spec_config(bin_fname), spec)
+
+        # The plugin maps the file, hashes the mapped buffer and parses it,
+        # and doesn't send the same content twice.
+        q       = utils.Mailbox()
+        handler = configfile.RouteSpecChangeEventHandler(
+                                          route_spec_fname   = bin_fname,
+                                          route_spec_abspath = bin_fname,
+                                          q_route_spec       = q,
+                                          plugin             = None)
+        handler.load_route_spec()
+        self.assertEqual(q.get(timeout=1).payload, spec)
+        handler.load_route_spec()
+        self.assertRaises(Queue.Empty, q.get, timeout=0.1)
+        self.lc.check(('root', 'DEBUG',
+                       "Route spec file content unchanged, ignoring it"))
+        self.lc.clear()
 
-                res = watcher.common.parse_route_spec_config(test_data['inp'])
-                self.assertEqual(expected_out, res)
+        with open(bin_fname, "a") as f:
+            f.write("X")
+        self.assertEqual(configfile.read_route_spec_config(bin_fname), None)
+        self.lc.check(('root', 'ERROR',
+                       "Config ignored: Binary route spec: "
+                       "Expected 108 bytes, got 109"))
+
+    def test_find_overlapping_cidrs(self):
+        spec = watcher.common.parse_route_spec_config({
+            "10.1.0.0/16"  : ["1.1.1.1"],
+            "10.1.2.0/24"  : ["2.2.2.2"],
+            "10.1.2.3/32"  : ["1.1.1.1"],
+            "10.1.5.7/16"  : ["1.1.1.1"],
+            "10.2.0.0/16"  : ["1.1.1.1"],
+            "10.3.0.0/24"  : ["1.1.1.1"],
+            "10.3.1.0/24"  : ["1.1.1.1"],
+            "0.0.0.0/0"    : ["3.3.3.3"],
+        })
+        res = watcher.common.find_overlapping_cidrs(spec)
+        self.assertEqual(
+            [(o['cidr'], o['overlaps_with'], o['same_network'],
+              o['same_hosts']) for o in res],
+            [("10.1.0.0/16", "0.0.0.0/0", False, False),
+             ("10.1.2.0/24", "10.1.5.7/16", False, False),
+             ("10.1.2.3/32", "10.1.2.0/24", False, False),
+             ("10.1.5.7/16", "10.1.0.0/16", True, True),
+             ("10.2.0.0/16", "0.0.0.0/0", False, False),
+             ("10.3.0.0/24", "0.0.0.0/0", False, False),
+             ("10.3.1.0/24", "0.0.0.0/0", False, False)])
+
+        spec = watcher.common.parse_route_spec_config({
+            "10.1.0.0/16" : ["1.1.1.1"],
+            "10.2.0.0/16" : ["1.1.1.1"],
+        })
+        self.assertEqual(watcher.common.find_overlapping_cidrs(spec), [])
+
+        # Overlaps are shown in the route info
+        self.addCleanup(CURRENT_STATE.publish_snapshot)
+        self.addCleanup(setattr, CURRENT_STATE, "cidr_overlaps", [])
+        self.addCleanup(setattr, CURRENT_STATE, "route_spec", {})
+        watcher._store_new_input(None, None,
+                                 watcher.common.parse_route_spec_config({
+                                     "10.1.0.0/16" : ["1.1.1.1"],
+                                     "10.1.0.0/24" : ["2.2.2.2"]}))
+        self.assertEqual(
+            CURRENT_STATE.get_state_repr("route_info")['overlapping_cidrs'],
+            [{"cidr" : "10.1.0.0/24", "overlaps_with" : "10.1.0.0/16",
+              "same_network" : False, "same_hosts" : False}])
+
+        # Overlaps are logged in one line, only if they changed
+        self.lc.clear()
+        watcher._store_new_input(None, None,
+                                 watcher.common.parse_route_spec_config({
+                                     "10.1.0.0/16" : ["1.1.1.1"],
+                                     "10.1.0.0/24" : ["2.2.2.2"]}))
+        self.lc.check()
+        spec = {"10.1.0.0/16" : ["1.1.1.1"]}
+        for i in range(5):
+            spec["10.1.%d.0/24" % i] = ["1.1.1.1"]
+        watcher._store_new_input(None, None,
+                                 watcher.common.parse_route_spec_config(spec))
+        self.assertEqual(len(CURRENT_STATE.cidr_overlaps), 5)
+        self.lc.check(('root', 'WARNING',
+                       "Route spec has 5 overlapping CIDRs: "
+                       "10.1.0.0/24 overlaps with 10.1.0.0/16, "
+                       "10.1.1.0/24 overlaps with 10.1.0.0/16, "
+                       "10.1.2.0/24 overlaps with 10.1.0.0/16 "
+                       "and 2 more (see /route_info)"))
+        self.lc.clear()
+        watcher._store_new_input(None, None,
+                                 watcher.common.parse_route_spec_config({
+                                     "10.1.0.0/16" : ["1.1.1.1"]}))
+        self.lc.check(('root', 'INFO',
+                       "Route spec has no more overlapping CIDRs"))
+
+    def test_host_pools(self):
+        spec = watcher.common.parse_route_spec_config({
+            u"10.1.0.0/16" : [u"1.1.1.1", u"2.2.2.2"],
+            u"10.2.0.0/16" : [u"2.2.2.2", u"1.1.1.1", u"1.1.1.1"],
+            u"10.3.0.0/16" : [u"3.3.3.3", u"1.1.1.1"]
+        })
+        # Identical pools are shared, IP strings are interned
+        self.assertTrue(spec["10.1.0.0/16"] is spec["10.2.0.0/16"])
+        self.assertTrue(spec["10.1.0.0/16"][0] is spec["10.3.0.0/16"][0])
+        self.assertEqual(spec["10.3.0.0/16"].ip_set,
+                         frozenset(["1.1.1.1", "3.3.3.3"]))
+
+        q = utils.Mailbox()
+        all_ips = watcher._update_health_monitor_with_new_ips(spec, [], q)
+        self.assertEqual(all_ips, ["1.1.1.1", "2.2.2.2", "3.3.3.3"])
+        self.assertEqual(q.get_nowait().payload, all_ips)
+
+    def test_route_spec_frozen(self):
+        spec = watcher.common.parse_route_spec_config(
+                                        {"10.1.0.0/16" : ["1.1.1.1"]})
+        self.assertRaises(TypeError, spec.__setitem__, "10.2.0.0/16", ())
+        self.assertRaises(TypeError, spec.update, {})
+        self.assertRaises(TypeError, spec.pop, "10.1.0.0/16")
+        self.assertTrue(copy.deepcopy(spec) is spec)
+        self.assertTrue(watcher.common.parse_route_spec_config(spec) is spec)
+        self.assertEqual(json.loads(json.dumps(spec)),
+                         {"10.1.0.0/16" : ["1.1.1.1"]})
+
+    def test_router_events(self):
+        def emitted(failed_ips, reported_failed_ips):
+            last_id  = EVENTS.last_id()
+            reported = watcher._emit_events(None, failed_ips, None,
+                                            reported_failed_ips)
+            return reported, [(e['type'], e['data']['ip'])
+                              for e in EVENTS.get_since(last_id)]
+
+        reported, events = emitted(["10.0.0.1", "10.0.0.2"], set())
+        self.assertEqual(events, [(EventType.ROUTER_FAILED, "10.0.0.1"),
+                                  (EventType.ROUTER_FAILED, "10.0.0.2")])
+
+        # A regular route check without a new message from the health
+        # monitor doesn't mean that the routers have recovered.
+        reported, events = emitted(None, reported)
+        self.assertEqual((reported, events),
+                         (set(["10.0.0.1", "10.0.0.2"]), []))
+
+        reported, events = emitted(["10.0.0.2"], reported)
+        self.assertEqual(events, [(EventType.ROUTER_RECOVERED, "10.0.0.1")])
+        reported, events = emitted([], reported)
+        self.assertEqual((reported, events),
+                         (set(), [(EventType.ROUTER_RECOVERED, "10.0.0.2")]))
+
+
+class TestRouteCheckScheduler(unittest.TestCase):
+
+    def test_backoff_and_snap_back(self):
+        no_drift = vpc._new_reconcile_summary()
+        drift    = vpc._new_reconcile_summary()
+        drift['updated'] = 1
+        api_err  = vpc._new_reconcile_summary()
+        api_err['api_error'] = True
+
+        sched = watcher._RouteCheckScheduler(10, 60)
+        now   = sched.last_check
+        self.assertFalse(sched.is_due(now + 5))
+        self.assertTrue(sched.is_due(now + 11))
+
+        # Without drift the interval doubles, up to the maximum
+        for expected in [20, 40, 60, 60]:
+            sched.checked(now, no_drift)
+            self.assertEqual(sched.interval, expected)
+        self.assertEqual(CURRENT_STATE.route_recheck['current_interval'], 60)
+        self.assertFalse(sched.is_due(now + 59))
+        self.assertTrue(sched.is_due(now + 61))
+
+        # Drift or errors snap back to the shortest interval
+        sched.checked(now, drift)
+        self.assertEqual(sched.interval, 10)
+        sched.checked(now, None)
+        self.assertEqual(sched.interval, 20)
+        sched.checked(now, api_err)
+        self.assertEqual(sched.interval, 10)
+
+        # Without a maximum the interval stays fixed, 0 disables the checks
+        sched = watcher._RouteCheckScheduler(10)
+        sched.checked(now, no_drift)
+        self.assertEqual(sched.interval, 10)
+        sched = watcher._RouteCheckScheduler(0, 60)
+        self.assertFalse(sched.is_due(now + 1000))
 
 
 class TestWatcherConfigfile(TestBase):
@@ -200,6 +667,11 @@ class TestWatcherConfigfile(TestBase):
         # start, even if there's nothing in it
         self.write_config({})
 
+        # The tests expect change events to be processed right away
+        self.old_debounce_time = \
+                    configfile.RouteSpecChangeEventHandler.DEBOUNCE_TIME
+        configfile.RouteSpecChangeEventHandler.DEBOUNCE_TIME = 0.05
+
     def setUp(self):
         self.lc = LogCapture()
         self.lc.setLevel(logging.DEBUG)
@@ -223,6 +695,8 @@ class TestWatcherConfigfile(TestBase):
 
     def additional_cleanup(self):
         shutil.rmtree(self.temp_dir)
+        configfile.RouteSpecChangeEventHandler.DEBOUNCE_TIME = \
+                                                    self.old_debounce_time
 
     def cleanup(self):
         self.lc.uninstall()
@@ -452,6 +926,195 @@ class TestWatcherHttp(TestWatcherConfigfile):
     def change_event_log_tuple(self):
         return ('root', 'INFO', "New route spec posted")
 
+    def test_gzip_route_spec(self):
+        self.conf['http_max_route_spec_size'] = 1000
+        self.watcher_plugin, self.health_plugin = \
+                watcher.start_plugins(
+                        self.conf,
+                        self.watcher_plugin_class, self.health_plugin_class,
+                        2)
+        self.addCleanup(watcher.stop_plugins,
+                        self.watcher_plugin, self.health_plugin)
+        url     = "http://%s:%s/route_spec" % \
+                            (self.conf['addr'], self.conf['port'])
+        headers = {"Content-Encoding" : "gzip"}
+
+        data = json.dumps({"10.1.0.0/16" : ["10.0.0.1"]})
+        r = requests.post(url, data=utils.gzip_compress(data),
+                          headers=headers)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(
+            self.watcher_plugin.get_route_spec_queue().get(timeout=1).payload,
+            {"10.1.0.0/16" : ("10.0.0.1",)})
+
+        # Too large after decompression
+        data = json.dumps({"10.1.0.0/16" : ["10.0.0.1"] * 100})
+        r = requests.post(url, data=utils.gzip_compress(data),
+                          headers=headers)
+        self.assertEqual(r.status_code, 413)
+
+        r = requests.post(url, data="not gzipped", headers=headers)
+        self.assertEqual(r.status_code, 400)
+
+    def test_patch_route_spec(self):
+        self.watcher_plugin, self.health_plugin = \
+                watcher.start_plugins(
+                        self.conf,
+                        self.watcher_plugin_class, self.health_plugin_class,
+                        2)
+        self.addCleanup(watcher.stop_plugins,
+                        self.watcher_plugin, self.health_plugin)
+        url = "http://%s:%s/route_spec" % \
+                            (self.conf['addr'], self.conf['port'])
+        q   = self.watcher_plugin.get_route_spec_queue()
+
+        r = requests.post(url, data=json.dumps({"10.1.0.0/16" : ["10.0.0.1"],
+                                                "10.2.0.0/16" : ["10.0.0.2"]}))
+        self.assertEqual(r.headers['X-Route-Spec-Version'], "1")
+        q.get(timeout=1)
+
+        patch = {
+            "expected_version" : 1,
+            "ops" : [
+                {"op" : "add", "cidr" : "10.1.0.0/16",
+                 "hosts" : ["10.0.0.3", "10.0.0.1"]},
+                {"op" : "remove", "cidr" : "10.2.0.0/16"},
+                {"op" : "replace", "cidr" : "10.3.0.0/16",
+                 "hosts" : ["10.0.0.4"]}
+            ]
+        }
+        r = requests.patch(url, data=json.dumps(patch))
+        self.assertEqual((r.status_code, json.loads(r.content)),
+                         (200, {"version" : 2}))
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.1.0.0/16" : ("10.0.0.1", "10.0.0.3"),
+                          "10.3.0.0/16" : ("10.0.0.4",)})
+
+        # Outdated version
+        r = requests.patch(url, data=json.dumps(patch))
+        self.assertEqual(r.status_code, 412)
+
+        # Invalid operations don't change anything
+        for op in [{"op" : "remove", "cidr" : "10.2.0.0/16"},
+                   {"op" : "add", "cidr" : "10.1.0.0/16",
+                    "hosts" : ["999.0.0.1"]},
+                   {"op" : "foo", "cidr" : "10.1.0.0/16"}]:
+            r = requests.patch(url, data=json.dumps(
+                                        {"ops" : [{"op" : "remove",
+                                                   "cidr" : "10.3.0.0/16"},
+                                                  op]}))
+            self.assertEqual(r.status_code, 400)
+        self.assertTrue(q.empty())
+
+        r = requests.patch(url, data=json.dumps(
+                                    {"ops" : [{"op" : "remove",
+                                               "cidr" : "10.1.0.0/16",
+                                               "hosts" : ["10.0.0.1"]}]}))
+        self.assertEqual(json.loads(r.content), {"version" : 3})
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.1.0.0/16" : ("10.0.0.3",),
+                          "10.3.0.0/16" : ("10.0.0.4",)})
+
+    def test_wait_for_route_spec(self):
+        def new_handle_spec(*args, **kwargs):
+            summary = vpc._new_reconcile_summary()
+            summary['added'] = 1
+            return summary
+        watcher.handle_spec = vpc.handle_spec = new_handle_spec
+
+        self.watcher_plugin, self.health_plugin = \
+                watcher.start_plugins(
+                        self.conf,
+                        self.watcher_plugin_class, self.health_plugin_class,
+                        2)
+        self.addCleanup(watcher.stop_plugins,
+                        self.watcher_plugin, self.health_plugin)
+        url = "http://%s:%s/route_spec" % \
+                            (self.conf['addr'], self.conf['port'])
+
+        # Nobody processes the route spec, so we give up waiting
+        r = requests.post(url + "?wait=0.5",
+                          data=json.dumps({"10.1.0.0/16" : ["10.0.0.1"]}))
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(json.loads(r.content)['version'], 1)
+
+        loop = threading.Thread(target=watcher._event_monitor_loop,
+                                args=("dummy-region", "dummy-vpc",
+                                      self.watcher_plugin, self.health_plugin,
+                                      4, 0.5))
+        loop.start()
+        r = requests.post(url + "?wait=10",
+                          data=json.dumps({"10.1.0.0/16" : ["10.0.0.2"]}))
+        loop.join()
+        self.assertEqual(r.status_code, 200)
+        res = json.loads(r.content)
+        self.assertEqual((res['version'], res['applied_version'],
+                          res['applied'], res['summary']['added']),
+                         (2, 2, True, 1))
+        self.assertTrue(res['latency'] >= 0)
+
+        # An identical route spec is not processed again, but is reported as
+        # applied.
+        def fail_handle_spec(*args, **kwargs):
+            raise Exception("route spec should not be processed")
+        watcher.handle_spec = vpc.handle_spec = fail_handle_spec
+        last_spec_msg = utils.Envelope({"10.1.0.0/16" : ["10.0.0.2"]}, 2,
+                                       time.time(),
+                                       utils.content_hash(
+                                            {"10.1.0.0/16" : ["10.0.0.2"]}))
+        r = requests.post(url, data=json.dumps({"10.1.0.0/16" : ["10.0.0.2"]}))
+        self.assertEqual(r.headers['X-Route-Spec-Version'], "3")
+        self.assertEqual(
+            watcher._read_new_route_spec(
+                        self.watcher_plugin.get_route_spec_queue(),
+                        last_spec_msg),
+            None)
+        e = EVENTS.get_since(EVENTS.last_id() - 1)[0]
+        self.assertEqual((e['data']['version'], e['data']['unchanged']),
+                         (3, True))
+
+        r = requests.post(url + "?wait=foo", data=json.dumps({}))
+        self.assertEqual(r.status_code, 400)
+
+    def test_multi_sub_plugin(self):
+        # As a sub-plugin of the multi plugin, the versions of the http
+        # plugin are not the versions that are applied.
+        plugin = self.watcher_plugin_class(self.conf)
+        mp     = watcher_multi.Multi(self.conf,
+                                     TEST_PLUGINS=[("http", plugin)])
+        mp.start()
+        self.addCleanup(mp.stop)
+        url = "http://%s:%s/route_spec" % \
+                            (self.conf['addr'], self.conf['port'])
+
+        r = requests.post(url + "?wait=1",
+                          data=json.dumps({"10.1.0.0/16" : ["10.0.0.1"]}))
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r.content,
+                         "Config ignored: Cannot wait for the route spec to "
+                         "be applied when used with the multi watcher "
+                         "plugin")
+
+        r = requests.post(url,
+                          data=json.dumps({"10.1.0.0/16" : ["10.0.0.1"]}))
+        self.assertEqual(r.status_code, 200)
+        self.assertFalse("X-Route-Spec-Version" in r.headers)
+        self.assertEqual(
+            mp.get_route_spec_queue().get(timeout=1).payload,
+            {"10.1.0.0/16" : ("10.0.0.1",)})
+
+        # Patches can still refer to the version of the http plugin
+        r = requests.patch(url, data=json.dumps(
+                            {"expected_version" : 1,
+                             "ops" : [{"op" : "add", "cidr" : "10.1.0.0/16",
+                                       "hosts" : ["10.0.0.2"]}]}))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.content)['version'], 2)
+        self.assertFalse("X-Route-Spec-Version" in r.headers)
+        self.assertEqual(
+            mp.get_route_spec_queue().get(timeout=1).payload,
+            {"10.1.0.0/16" : ("10.0.0.1", "10.0.0.2")})
+
     def test_watcher_thread_no_config(self):
         self.watcher_plugin, self.health_plugin = \
                 watcher.start_plugins(
@@ -472,5 +1135,593 @@ class TestWatcherHttp(TestWatcherConfigfile):
         watcher.stop_plugins(self.watcher_plugin, self.health_plugin)
 
 
+class _RouteSpecServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    """
+    A local stand-in for a server, which publishes the route spec.
+
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        self.body        = ""
+        self.etag        = None
+        self.status      = 200
+        self.drop        = 0      # Number of requests to drop
+        self.requests    = []
+        self.connections = 0
+        BaseHTTPServer.HTTPServer.__init__(self, ("localhost", 0),
+                                           _RouteSpecHandler)
+
+
+class _RouteSpecHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        srv = self.server
+        srv.requests.append((self.path, self.headers.get("If-None-Match")))
+        if srv.drop:
+            srv.drop -= 1
+            self.close_connection = 1
+            return
+        if srv.status == 200 and srv.etag and \
+                            self.headers.get("If-None-Match") == srv.etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(srv.status)
+        if srv.etag:
+            self.send_header("ETag", srv.etag)
+        self.send_header("Content-Length", str(len(srv.body)))
+        self.end_headers()
+        self.wfile.write(srv.body)
+
+
+class TestWatcherUrl(unittest.TestCase):
+
+    def setUp(self):
+        self.lc = LogCapture()
+        self.lc.addFilter(test_common.MyLogCaptureFilter())
+        self.server = _RouteSpecServer()
+        self.server_thread = threading.Thread(
+                                    target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.url = "http://localhost:%d/spec.json?zone=a" % \
+                                                self.server.server_address[1]
+        self.addCleanup(self.cleanup)
+
+    def cleanup(self):
+        self.lc.uninstall()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch(self):
+        q       = utils.Mailbox()
+        fetcher = url.RouteSpecFetcher(self.url, q)
+        self.addCleanup(fetcher.close)
+        self.server.body = json.dumps({"10.1.0.0/16" : ["1.1.1.1"]})
+        self.server.etag = '"v1"'
+
+        fetcher.fetch()
+        self.assertEqual(q.get_nowait().payload,
+                         {"10.1.0.0/16" : ("1.1.1.1",)})
+        self.assertEqual(self.server.requests, [("/spec.json?zone=a", None)])
+
+        # Not modified, nothing is sent out
+        fetcher.fetch()
+        self.assertEqual(self.server.requests[-1][1], '"v1"')
+        self.assertTrue(q.empty())
+
+        # New content with a new ETag
+        self.server.body = json.dumps({"10.2.0.0/16" : ["2.2.2.2"]})
+        self.server.etag = '"v2"'
+        fetcher.fetch()
+        self.assertEqual(q.get_nowait().payload,
+                         {"10.2.0.0/16" : ("2.2.2.2",)})
+
+        # New ETag, but same content
+        self.server.etag = '"v3"'
+        fetcher.fetch()
+        self.assertTrue(q.empty())
+
+        # Errors are logged and don't send out anything
+        self.server.status = 500
+        fetcher.fetch()
+        self.server.status = 200
+        self.server.etag   = None
+        self.server.body   = "{ broken"
+        fetcher.fetch()
+        self.assertTrue(q.empty())
+        self.lc.check(
+            ('root', 'INFO', "Url watcher plugin: New route spec fetched"),
+            ('root', 'INFO', "Url watcher plugin: New route spec fetched"),
+            ('root', 'DEBUG',
+             "Url watcher plugin: Route spec content unchanged, ignoring it"),
+            ('root', 'ERROR',
+             "Url watcher plugin: Cannot fetch route spec from '%s': "
+             "HTTP status 500" % self.url),
+            ('root', 'ERROR',
+             "Url watcher plugin: Config ignored: Expecting property name: "
+             "line 1 column 3 (char 2)"))
+
+        # All requests were sent over the same connection
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(fetcher.stats['connections'], 1)
+        self.assertEqual(
+            [fetcher.stats[k] for k in ["requests", "not_modified",
+                                        "unchanged", "updates", "errors"]],
+            [6, 1, 1, 2, 2])
+
+        # A binary route spec is recognized by its magic bytes
+        self.server.body = binspec.dump_binary_spec(
+                watcher.common.parse_route_spec_config(
+                        {"10.3.0.0/16" : ["3.3.3.3"]}))
+        fetcher.fetch()
+        self.assertEqual(q.get_nowait().payload,
+                         {"10.3.0.0/16" : ("3.3.3.3",)})
+
+    def test_dropped_connection(self):
+        q       = utils.Mailbox()
+        fetcher = url.RouteSpecFetcher(self.url, q)
+        self.addCleanup(fetcher.close)
+        self.server.body = json.dumps({"10.1.0.0/16" : ["1.1.1.1"]})
+        fetcher.fetch()
+        self.assertFalse(q.empty())
+
+        # The server closes the kept-alive connection without a response. The
+        # request is sent again on a new connection, that's not an error.
+        self.server.drop = 1
+        self.server.body = json.dumps({"10.2.0.0/16" : ["1.1.1.1"]})
+        fetcher.fetch()
+        self.assertEqual(q.get_nowait().payload,
+                         {"10.2.0.0/16" : ("1.1.1.1",)})
+        self.assertEqual(fetcher.stats['errors'], 0)
+        self.assertEqual(fetcher.stats['connections'], 2)
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.requests), 3)
+
+        # If the request fails on the new connection as well, it's an error
+        # and there is no further retry.
+        self.server.drop = 3
+        fetcher.fetch()
+        self.assertEqual(fetcher.stats['errors'], 1)
+        self.assertTrue(fetcher.stats['last_error'].startswith(
+                            "Cannot fetch route spec from '%s': " % self.url))
+        self.assertEqual(fetcher.stats['connections'], 3)
+        self.assertEqual(len(self.server.requests), 5)
+
+        # A request on a new connection is not retried
+        fetcher.fetch()
+        self.assertEqual(fetcher.stats['errors'], 2)
+        self.assertEqual(fetcher.stats['connections'], 4)
+        self.assertEqual(len(self.server.requests), 6)
+
+        # A new connection is opened for the next request
+        self.server.drop = 0
+        self.server.body = json.dumps({"10.3.0.0/16" : ["1.1.1.1"]})
+        fetcher.fetch()
+        self.assertEqual(q.get_nowait().payload,
+                         {"10.3.0.0/16" : ("1.1.1.1",)})
+        self.assertEqual(fetcher.stats['connections'], 5)
+        self.assertEqual(self.server.connections, 5)
+
+    def test_plugin(self):
+        conf = {"url" : self.url, "url_poll_interval" : 0.05,
+                "url_timeout" : 1}
+        url.Url.check_arguments(conf)
+        for bad_conf, msg in [
+                ({"url" : "ftp://localhost/spec"},
+                 "Not a valid http or https URL: 'ftp://localhost/spec'"),
+                ({"url_poll_interval" : 0},
+                 "URL poll interval must be greater than 0")]:
+            c = dict(conf)
+            c.update(bad_conf)
+            with self.assertRaises(ArgsError) as ex:
+                url.Url.check_arguments(c)
+            self.assertEqual(str(ex.exception), msg)
+
+        self.server.body = json.dumps({"10.1.0.0/16" : ["1.1.1.1"]})
+        self.server.etag = '"v1"'
+        plugin = url.Url(conf)
+        plugin.start()
+        self.addCleanup(plugin.stop)
+        q = plugin.get_route_spec_queue()
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.1.0.0/16" : ("1.1.1.1",)})
+
+        self.server.body = json.dumps({"10.2.0.0/16" : ["1.1.1.1"]})
+        self.server.etag = '"v2"'
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.2.0.0/16" : ("1.1.1.1",)})
+        info = plugin.get_info()['url']
+        self.assertEqual(info['params']['url'], self.url)
+        self.assertEqual(info['stats']['updates'], 2)
+        self.assertEqual(info['stats']['connections'], 1)
+
+
+class _EtcdServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local stand-in for an etcd server, with just enough of the v2 keys API
+    for the kvstore plugin.
+
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        self.index         = 10
+        self.keys          = {}
+        self.history       = []
+        self.cleared_index = 0
+        self.drop          = False
+        self.stopping      = False
+        self.list_requests = 0
+        self.cond          = threading.Condition()
+        BaseHTTPServer.HTTPServer.__init__(self, ("localhost", 0),
+                                           _EtcdHandler)
+
+    def change(self, key, value=None, action="set", is_dir=False):
+        with self.cond:
+            self.index += 1
+            if value is None:
+                for k in list(self.keys):
+                    if k == key or k.startswith(key + "/"):
+                        del self.keys[k]
+            else:
+                self.keys[key] = value
+            node = {"key" : key, "modifiedIndex" : self.index}
+            if value is not None:
+                node["value"] = value
+            if is_dir:
+                node["dir"] = True
+            self.history.append({"action" : action, "node" : node})
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.shutdown()
+        self.server_close()
+
+
+class _EtcdHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header("X-Etcd-Index", str(self.server.index))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _list(self, prefix):
+        srv  = self.server
+        keys = {k : v for k, v in srv.keys.items()
+                if k.startswith(prefix + "/")}
+        if not keys:
+            return self._send(404, {"errorCode" : 100,
+                                    "message"   : "Key not found",
+                                    "index"     : srv.index})
+        # Nested directories, like etcd creates them for keys with '/'
+        root = {"key" : prefix, "dir" : True, "nodes" : {}}
+        for k, v in keys.items():
+            d = root
+            for part in k[len(prefix) + 1:].split("/")[:-1]:
+                dkey = d['key'] + "/" + part
+                d = d['nodes'].setdefault(dkey, {"key" : dkey, "dir" : True,
+                                                 "nodes" : {}})
+            d['nodes'][k] = {"key" : k, "value" : v}
+
+        def as_lists(d):
+            if d.get("dir"):
+                d['nodes'] = [as_lists(n) for n in d['nodes'].values()]
+            return d
+
+        self._send(200, {"action" : "get", "node" : as_lists(root)})
+
+    def _watch(self, prefix, wait_index):
+        srv = self.server
+        with srv.cond:
+            while not srv.stopping:
+                # Also for pending watches, like a store that had to drop
+                # the events they were waiting for.
+                if wait_index <= srv.cleared_index:
+                    return self._send(400, {"errorCode" : 401,
+                                            "message"   : "The event in "
+                                                          "requested index is "
+                                                          "outdated and "
+                                                          "cleared"})
+                for event in srv.history:
+                    key = event['node']['key']
+                    if event['node']['modifiedIndex'] >= wait_index and \
+                            (key == prefix or key.startswith(prefix + "/")):
+                        return self._send(200, event)
+                srv.cond.wait(0.1)
+
+    def do_GET(self):
+        srv = self.server
+        if srv.drop:
+            srv.drop = False
+            self.close_connection = 1
+            return
+        path, _, query = self.path.partition("?")
+        params = urlparse.parse_qs(query)
+        prefix = urllib.unquote(path[len("/v2/keys"):])
+        if "wait" in params:
+            self._watch(prefix, int(params['waitIndex'][0]))
+        else:
+            srv.list_requests += 1
+            self._list(prefix)
+
+
+class TestWatcherKvstore(unittest.TestCase):
+
+    def setUp(self):
+        self.lc = LogCapture()
+        self.lc.addFilter(test_common.MyLogCaptureFilter())
+        self.server = _EtcdServer()
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.conf = {
+            "kv_url"            : "http://localhost:%d" %
+                                  self.server.server_address[1],
+            "kv_prefix"         : "/vpcrouter/routes/",
+            "kv_watch_timeout"  : 0.5,
+            "kv_retry_interval" : 0.05
+        }
+        self.addCleanup(self.cleanup)
+
+    def cleanup(self):
+        self.lc.uninstall()
+        self.server.stop()
+
+    def test_kv_route_spec(self):
+        spec = kvstore.KVRouteSpec()
+        self.assertTrue(spec.load({"10.1.0.0/16" : '["1.1.1.1"]',
+                                   "10.2.0.0/16" : '["1.1.1.1"]',
+                                   "10.3.0.0/16" : '["1.1.1."]'}))
+        self.assertEqual(spec.route_spec(),
+                         {"10.1.0.0/16" : ("1.1.1.1",),
+                          "10.2.0.0/16" : ("1.1.1.1",)})
+        self.assertFalse(spec.load({"10.1.0.0/16" : '["1.1.1.1"]',
+                                    "10.2.0.0/16" : '["1.1.1.1"]'}))
+
+        change = kvstore.KVChange
+        self.assertFalse(spec.apply(change("10.1.0.0/16", '["1.1.1.1"]',
+                                           11, False)))
+        self.assertTrue(spec.apply(change("10.1.0.0/16", '["2.2.2.2"]',
+                                          12, False)))
+        # Invalid entries are ignored, the previous hosts remain in effect
+        self.assertFalse(spec.apply(change("10.1.0.0/16", 'foo', 13, False)))
+        self.assertFalse(spec.apply(change("10.4.0.0/33", '[]', 14, False)))
+        self.assertEqual(spec.entries["10.1.0.0/16"], ("2.2.2.2",))
+        self.assertFalse(spec.apply(change("10.9.0.0/16", None, 15, False)))
+        self.assertTrue(spec.apply(change("10.2.0.0", None, 16, True)))
+        self.assertEqual(spec.route_spec(), {"10.1.0.0/16" : ("2.2.2.2",)})
+        self.assertTrue(spec.apply(change("", None, 17, True)))
+        self.assertEqual(spec.route_spec(), {})
+        self.lc.check(
+            ('root', 'ERROR',
+             "Kvstore watcher plugin: Ignoring invalid entry '10.3.0.0/16': "
+             "Not a valid IP address (1.1.1.)"),
+            ('root', 'ERROR',
+             "Kvstore watcher plugin: Ignoring invalid entry '10.1.0.0/16': "
+             "No JSON object could be decoded"),
+            ('root', 'ERROR',
+             "Kvstore watcher plugin: Ignoring invalid entry '10.4.0.0/33': "
+             "Not a valid CIDR (10.4.0.0/33)"))
+
+    def test_check_arguments(self):
+        conf = dict(self.conf)
+        kvstore.Kvstore.check_arguments(conf)
+        for bad_conf, msg in [
+                ({"kv_url" : "localhost:2379"},
+                 "Not a valid http or https URL: 'localhost:2379'"),
+                ({"kv_prefix" : "/"}, "The key prefix cannot be empty"),
+                ({"kv_watch_timeout" : 0},
+                 "Watch timeout must be greater than 0")]:
+            c = dict(conf)
+            c.update(bad_conf)
+            with self.assertRaises(ArgsError) as ex:
+                kvstore.Kvstore.check_arguments(c)
+            self.assertEqual(str(ex.exception), msg)
+
+    def test_watch(self):
+        prefix = "/vpcrouter/routes"
+        self.server.change(prefix + "/10.1.0.0/16", '["1.1.1.1"]')
+        plugin = kvstore.Kvstore(self.conf)
+        plugin.start()
+        self.addCleanup(plugin.stop)
+        q = plugin.get_route_spec_queue()
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.1.0.0/16" : ("1.1.1.1",)})
+
+        # Changes are applied one at a time
+        self.server.change(prefix + "/10.2.0.0/16", '["2.2.2.2"]')
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.1.0.0/16" : ("1.1.1.1",),
+                          "10.2.0.0/16" : ("2.2.2.2",)})
+        self.server.change(prefix + "/10.1.0.0/16", action="delete")
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.2.0.0/16" : ("2.2.2.2",)})
+
+        # Keys outside of the prefix don't matter
+        self.server.change("/other/10.3.0.0/16", '["3.3.3.3"]')
+
+        # After a lost connection, the watch resumes where it left off,
+        # including the changes made in the meantime.
+        self.server.drop = True
+        self.server.change(prefix + "/10.3.0.0/16", '["3.3.3.3"]')
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.2.0.0/16" : ("2.2.2.2",),
+                          "10.3.0.0/16" : ("3.3.3.3",)})
+        self.assertEqual(self.server.list_requests, 1)
+
+        # The store doesn't remember the changes after our last index
+        # anymore (the change of 10.4.0.0/16 is lost): All keys are read
+        # again.
+        with self.server.cond:
+            self.server.index += 1
+            self.server.keys[prefix + "/10.4.0.0/16"] = '["4.4.4.4"]'
+            self.server.cleared_index = self.server.index
+            self.server.change(prefix + "/10.5.0.0/16", '["5.5.5.5"]')
+        spec = q.get(timeout=2).payload
+        self.assertEqual(sorted(spec),
+                         ["10.2.0.0/16", "10.3.0.0/16", "10.4.0.0/16",
+                          "10.5.0.0/16"])
+        self.assertEqual(self.server.list_requests, 2)
+
+        stats = plugin.get_info()['kvstore']['stats']
+        self.assertEqual(stats['full_reads'], 2)
+        self.assertEqual(stats['entries'], 4)
+        self.assertEqual(stats['index'], self.server.index)
+        self.assertTrue(stats['errors'] >= 1)
+
+
+class _TestWatcherPlugin(watcher.common.WatcherPlugin):
+    """
+    A watcher plugin for tests, whose route specs are sent by the test.
+
+    """
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def get_info(self):
+        return {"test" : {}}
+
+    def send(self, route_spec):
+        self.q_route_spec.put(
+                watcher.common.parse_route_spec_config(route_spec))
+
+
+class TestWatcherMulti(unittest.TestCase):
+
+    def setUp(self):
+        self.lc = LogCapture()
+        self.lc.setLevel(logging.DEBUG)
+        self.lc.addFilter(test_common.MyLogCaptureFilter())
+        self.addCleanup(self.lc.uninstall)
+
+    def test_merger(self):
+        merger = watcher_multi.RouteSpecMerger(["static", "dynamic"])
+        parse  = watcher.common.parse_route_spec_config
+        self.assertTrue(merger.update("dynamic", parse({
+                                "10.1.0.0/16" : ["1.1.1.1"],
+                                "10.2.0.0/16" : ["2.2.2.2"]})))
+        self.assertTrue(merger.update("static", parse({
+                                "10.1.0.0/16" : ["3.3.3.3"],
+                                "10.3.0.0/16" : ["3.3.3.3"]})))
+        # The first source wins in case of conflicts
+        self.assertEqual(merger.route_spec(),
+                         {"10.1.0.0/16" : ("3.3.3.3",),
+                          "10.2.0.0/16" : ("2.2.2.2",),
+                          "10.3.0.0/16" : ("3.3.3.3",)})
+        self.assertEqual(merger.conflicts, set(["10.1.0.0/16"]))
+
+        # Changes of the losing source in a conflict don't change anything
+        self.assertFalse(merger.update("dynamic", parse({
+                                "10.1.0.0/16" : ["4.4.4.4"],
+                                "10.2.0.0/16" : ["2.2.2.2"]})))
+        self.assertTrue(merger.update("static", parse({
+                                "10.3.0.0/16" : ["3.3.3.3"]})))
+        self.assertEqual(merger.route_spec(),
+                         {"10.1.0.0/16" : ("4.4.4.4",),
+                          "10.2.0.0/16" : ("2.2.2.2",),
+                          "10.3.0.0/16" : ("3.3.3.3",)})
+        self.assertEqual(merger.conflicts, set())
+        self.assertTrue(merger.update("dynamic", parse({})))
+        self.assertEqual(merger.route_spec(), {"10.3.0.0/16" : ("3.3.3.3",)})
+
+        # With the 'union' rule, the hosts of all sources are combined
+        merger = watcher_multi.RouteSpecMerger(["a", "b"], "union")
+        merger.update("a", parse({"10.1.0.0/16" : ["1.1.1.1", "2.2.2.2"]}))
+        merger.update("b", parse({"10.1.0.0/16" : ["3.3.3.3", "2.2.2.2"]}))
+        self.assertEqual(merger.route_spec(),
+                         {"10.1.0.0/16" : ("1.1.1.1", "2.2.2.2", "3.3.3.3")})
+        self.assertFalse(merger.update("b", parse({
+                                "10.1.0.0/16" : ["3.3.3.3", "1.1.1.1"]})))
+
+    def test_plugin(self):
+        static  = _TestWatcherPlugin({})
+        dynamic = _TestWatcherPlugin({})
+        plugin  = watcher_multi.Multi(
+                        {"multi_watchers" : "static:dynamic"},
+                        TEST_PLUGINS=[("static", static),
+                                      ("dynamic", dynamic)])
+        plugin.start()
+        self.addCleanup(plugin.stop)
+        self.assertTrue(static.started and dynamic.started)
+        q = plugin.get_route_spec_queue()
+
+        static.send({"10.1.0.0/16" : ["1.1.1.1"]})
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.1.0.0/16" : ("1.1.1.1",)})
+        dynamic.send({"10.2.0.0/16" : ["2.2.2.2"],
+                      "10.1.0.0/16" : ["2.2.2.2"]})
+        self.assertEqual(q.get(timeout=1).payload,
+                         {"10.1.0.0/16" : ("1.1.1.1",),
+                          "10.2.0.0/16" : ("2.2.2.2",)})
+
+        # No change of the merged route spec, nothing is sent out
+        dynamic.send({"10.2.0.0/16" : ["2.2.2.2"],
+                      "10.1.0.0/16" : ["3.3.3.3"]})
+        self.assertRaises(Queue.Empty, q.get, timeout=0.2)
+
+        info = plugin.get_info()['multi_watcher']
+        self.assertEqual(info['stats']['conflicts'], ["10.1.0.0/16"])
+        self.assertEqual(info['stats']['sources'],
+                         {"static" : 1, "dynamic" : 2})
+        self.assertEqual(info['stats']['merged_updates'], 2)
+        self.assertEqual(info['sub-plugins'], {"test" : {}})
+        self.assertTrue(
+            ('root', 'WARNING',
+             "Multi watcher plugin: CIDR 10.1.0.0/16 is in more than one "
+             "route spec, using 'first' rule") in
+            [(r.name, r.levelname, r.msg) for r in self.lc.records])
+
+    def test_arguments(self):
+        pc = watcher_multi.Multi
+        for names, msg in [
+                ("", "A specification of watcher plugins is required "
+                     "(--multi_watchers)."),
+                ("configfile:multi", "The multi watcher plugin cannot be its "
+                                     "own sub-plugin."),
+                ("http:http", "Each watcher plugin can only be used once.")]:
+            with self.assertRaises(ArgsError) as ex:
+                pc.check_arguments({"multi_watchers" : names})
+            self.assertEqual(str(ex.exception), msg)
+
+        # The arguments of the sub-plugins are added and checked as well
+        args   = ["-m", "multi", "--multi_watchers", "fixedconf:url",
+                  "--fixed_cidr", "10.1.0.0/16", "--fixed_hosts", "1.1.1.1",
+                  "--url", "http://localhost/spec"]
+        parser = argparse.ArgumentParser()
+        self.assertEqual(pc.add_arguments(parser, args),
+                         ["multi_watchers", "multi_watcher_conflict",
+                          "fixed_cidr", "fixed_hosts",
+                          "url", "url_poll_interval", "url_timeout"])
+        conf = vars(parser.parse_args(args[2:]))
+        pc.check_arguments(conf)
+        conf['url'] = "foo"
+        self.assertRaises(ArgsError, pc.check_arguments, conf)
+
+
 if __name__ == '__main__':
     unittest.main()
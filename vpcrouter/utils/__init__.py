@@ -19,11 +19,16 @@ limitations under the License.
 # Utility functions, which are used by different modules.
 #
 
+import hashlib
 import ipaddress
+import json
 import netaddr
 import Queue
+import threading
+import time
+import zlib
 
-from vpcrouter.errors import ArgsError
+from vpcrouter.errors import ArgsError, PayloadTooLargeError
 
 
 def ip_check(ip, netmask_expected=False):
@@ -100,25 +105,273 @@ def is_cidr_in_cidr(small_cidr, big_cidr):
     return s.subnet_of(b)
 
 
-def read_last_msg_from_queue(q):
+_DIGITS = "0123456789"
+
+
+def ipv4_to_int(ip):
+    """
+    Convert an IPv4 address in dotted-quad notation to an integer.
+
+    This is much cheaper than creating an IP address object, and only accepts
+    the plain dotted-quad notation. Raises ArgsError if the address is not
+    valid.
+
+    """
+    try:
+        parts = ip.split(".")
+        if len(parts) == 4:
+            val = 0
+            for p in parts:
+                if not p or len(p) > 3 or p.strip(_DIGITS) or int(p) > 255:
+                    break
+                val = (val << 8) | int(p)
+            else:
+                return val
+    except AttributeError:
+        # Not a string
+        pass
+    raise ArgsError("Not a valid IP address (%s)" % ip)
+
+
+def int_to_ipv4(val):
+    """
+    Convert an integer to an IPv4 address in dotted-quad notation.
+
+    """
+    return "%d.%d.%d.%d" % (val >> 24, (val >> 16) & 0xff,
+                            (val >> 8) & 0xff, val & 0xff)
+
+
+def ipv4_cidr_to_int(cidr):
+    """
+    Convert an IPv4 CIDR to a (network address, prefix length) tuple of
+    integers. The host bits of the address are cleared.
+
+    Raises ArgsError if the CIDR is not valid.
+
+    """
+    try:
+        addr, prefix = cidr.split("/")
+        if prefix and len(prefix) <= 2 and not prefix.strip(_DIGITS) and \
+                                                        int(prefix) <= 32:
+            prefix = int(prefix)
+            mask   = (0xffffffff << (32 - prefix)) & 0xffffffff
+            return ipv4_to_int(addr) & mask, prefix
+    except (AttributeError, ValueError, ArgsError):
+        # Not a string, wrong number of slashes or malformed address
+        pass
+    raise ArgsError("Not a valid CIDR (%s)" % cidr)
+
+
+def content_hash(data):
+    """
+    Return a hash over the content of a JSON serializable data structure.
+
+    Dictionaries with the same content produce the same hash, independent of
+    the order of their keys.
+
+    """
+    return hashlib.sha1(json.dumps(data, sort_keys=True,
+                                   default=repr)).hexdigest()
+
+
+class Envelope(object):
+    """
+    A message in a Mailbox: The actual payload, together with its generation
+    (increasing with every message put into the mailbox), the time at which
+    it was sent and a hash over its content.
+
+    Hashing a large payload takes a moment. Unless the sender already had a
+    hash of the content (of the raw data the payload was parsed from, for
+    example), the hash is therefore only computed when a receiver asks for
+    it.
+
+    """
+    __slots__ = ("payload", "generation", "timestamp", "_content_hash")
+
+    def __init__(self, payload, generation, timestamp, content_hash=None):
+        self.payload       = payload
+        self.generation    = generation
+        self.timestamp     = timestamp
+        self._content_hash = content_hash
+
+    @property
+    def content_hash(self):
+        if self._content_hash is None:
+            self._content_hash = content_hash(self.payload)
+        return self._content_hash
+
+
+class Mailbox(object):
     """
-    Read all messages from a queue and return the last one.
+    A channel for messages that always contain the full state of things.
+
+    Only the latest message matters to the receiver, so a new message simply
+    replaces one that hasn't been read yet. Every message is wrapped into an
+    Envelope, which allows receivers to tell new messages from stale ones, or
+    identical messages from changed ones.
+
+    The interface is that of a Queue: get() raises Queue.Empty if there is no
+    message and task_done() is accepted (but does nothing).
+
+    Listeners can be added, which are called whenever a new message arrives.
+    This allows a receiver to wait for messages in several mailboxes at once.
+
+    """
+    def __init__(self):
+        self._cond      = threading.Condition()
+        self._msg       = None   # The latest message, if it wasn't read yet
+        self._listeners = []
+        self.version    = 0      # Generation of the latest message
+
+    def add_listener(self, listener):
+        """
+        Add a function, which is called (without arguments) after each new
+        message was stored. It must not block.
+
+        """
+        with self._cond:
+            self._listeners.append(listener)
+
+    def put(self, item, block=True, timeout=None, content_hash=None):
+        """
+        Wrap the item in an Envelope and store it in the mailbox, replacing
+        any unread message. Never blocks, the 'block' and 'timeout' arguments
+        are only accepted for compatibility with Queue.put().
+
+        A sender that already has a hash of the item's content can pass it
+        in, otherwise the hash is computed when it's needed. The same sender
+        should always hash the same way, since only hashes of messages in the
+        same mailbox are compared.
+
+        Returns the generation of the message.
+
+        """
+        with self._cond:
+            self.version += 1
+            self._msg = Envelope(item, self.version, time.time(),
+                                 content_hash)
+            self._cond.notify_all()
+            version   = self.version
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+        return version
+
+    def get(self, block=True, timeout=None):
+        """
+        Return the latest unread message.
+
+        If there is none, wait for up to 'timeout' seconds (or forever, if
+        timeout is None) for one to arrive. Raises Queue.Empty if there still
+        is no message, or if 'block' is False.
+
+        """
+        with self._cond:
+            if block:
+                if timeout is None:
+                    while self._msg is None:
+                        self._cond.wait()
+                else:
+                    end_time = time.time() + timeout
+                    while self._msg is None:
+                        remaining = end_time - time.time()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+            if self._msg is None:
+                raise Queue.Empty()
+            msg, self._msg = self._msg, None
+            return msg
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def task_done(self):
+        pass
+
+    def empty(self):
+        return self._msg is None
+
+
+def read_last_envelope_from_queue(q):
+    """
+    Return the latest message from a Mailbox.
 
     This is useful in many cases where all messages are always the complete
     state of things. Therefore, intermittent messages can be ignored.
 
-    Doesn't block, returns None if there is no message waiting in the queue.
+    Doesn't block, returns None if there is no message waiting.
+
+    """
+    try:
+        return q.get_nowait()
+    except Queue.Empty:
+        return None
+
+
+def read_last_msg_from_queue(q):
+    """
+    Return the payload of the latest message from a Mailbox.
+
+    Doesn't block, returns None if there is no message waiting.
+
+    """
+    msg = read_last_envelope_from_queue(q)
+    return msg.payload if msg is not None else None
+
+
+def gzip_compress(data, level=6):
+    """
+    Return the data compressed in gzip format.
 
     """
-    msg = None
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def read_stream(stream, max_size, gzipped=False, chunk_size=65536):
+    """
+    Read all data from a file-like stream and return it.
+
+    If 'gzipped' is set, the data is decompressed while it is read. Raises
+    PayloadTooLargeError as soon as the (decompressed) data exceeds max_size
+    bytes, so that we never hold more than that in memory. Raises ValueError
+    if the gzipped data is malformed.
+
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped \
+                                                           else None
+    buf  = []
+    size = 0
     while True:
-        try:
-            # The list of IPs is always a full list.
-            msg = q.get_nowait()
-            q.task_done()
-        except Queue.Empty:
-            # No more messages, all done for now
-            return msg
+        chunk = stream.read(chunk_size)
+        if decompressor:
+            try:
+                # Never decompress more than one byte over the limit, even if
+                # a small chunk of input would expand into much more.
+                data = decompressor.decompress(chunk, max_size - size + 1)
+                while decompressor.unconsumed_tail and \
+                                                size + len(data) <= max_size:
+                    buf.append(data)
+                    size += len(data)
+                    data  = decompressor.decompress(
+                                            decompressor.unconsumed_tail,
+                                            max_size - size + 1)
+                if not chunk:
+                    data += decompressor.flush()
+            except zlib.error as e:
+                raise ValueError("Malformed gzip data: %s" % str(e))
+        else:
+            data = chunk
+
+        size += len(data)
+        if size > max_size:
+            raise PayloadTooLargeError("Data exceeds maximum size of %d "
+                                       "bytes" % max_size)
+        buf.append(data)
+        if not chunk:
+            return "".join(buf)
 
 
 def param_extract(args, short_form, long_form, default=None):
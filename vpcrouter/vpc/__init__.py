@@ -19,15 +19,18 @@ limitations under the License.
 # Functions dealing with VPC.
 #
 
+import collections
 import datetime
 import logging
 import random
+import time
 
 import boto.vpc
 import boto.utils
 
 from vpcrouter.errors       import VpcRouteSetError
 from vpcrouter.currentstate import CURRENT_STATE
+from vpcrouter.events       import EVENTS, EventType
 from vpcrouter.utils        import is_cidr_in_cidr
 
 
@@ -167,6 +170,53 @@ def get_instance_private_ip_from_route(instance, route):
     return ipaddr, eni if ipaddr else None
 
 
+def _as_set(ips):
+    """
+    Return a list of IPs as a frozenset.
+
+    HostPools of a validated route spec have their set precomputed and sets
+    are used as they are.
+
+    """
+    if isinstance(ips, frozenset):
+        return ips
+    ip_set = getattr(ips, "ip_set", None)
+    return ip_set if ip_set is not None else frozenset(ips)
+
+
+# The candidates for routers in the distinct host pools, for the current
+# failed and questionable IPs. Cleared with every run over the route spec.
+_CANDIDATES = {}
+
+
+def _get_candidates(ip_list, failed_ips, questionable_ips):
+    """
+    Return the fully healthy IPs of a list of hosts (neither failed nor
+    questionable), as well as the set of questionable ones.
+
+    Many CIDRs share the same host pool, so the result for each pool is only
+    computed once per run.
+
+    """
+    ip_set     = _as_set(ip_list)
+    failed_set = _as_set(failed_ips)
+    quest_set  = _as_set(questionable_ips)
+    key        = (ip_set, failed_set, quest_set)
+    candidates = _CANDIDATES.get(key)
+    if candidates is None:
+        # Consider only those questionable IPs that aren't also failed and
+        # make sure all of the ones in the questionable list are at least also
+        # present in the overall IP list.
+        questionable_set = quest_set.intersection(ip_set). \
+                                                difference(failed_set)
+
+        # Get all healthy IPs that are neither failed, nor questionable
+        healthy_ips = list(ip_set.difference(failed_set, questionable_set))
+
+        candidates = _CANDIDATES[key] = (healthy_ips, questionable_set)
+    return candidates
+
+
 def _choose_different_host(old_ip, ip_list, failed_ips, questionable_ips):
     """
     Randomly choose a different host from a list of hosts.
@@ -186,16 +236,8 @@ def _choose_different_host(old_ip, ip_list, failed_ips, questionable_ips):
         # We don't have any hosts to choose from.
         return None
 
-    ip_set           = set(ip_list)
-    failed_set       = set(failed_ips)
-    # Consider only those questionable IPs that aren't also failed and make
-    # sure all of the ones in the questionable list are at least also present
-    # in the overall IP list.
-    questionable_set = set(questionable_ips).intersection(ip_set). \
-                                             difference(failed_set)
-
-    # Get all healthy IPs that are neither failed, nor questionable
-    healthy_ips = list(ip_set.difference(failed_set, questionable_set))
+    healthy_ips, questionable_set = \
+                _get_candidates(ip_list, failed_ips, questionable_ips)
 
     if healthy_ips:
         # Return one of the completely healthy IPs
@@ -216,17 +258,228 @@ def _choose_different_host(old_ip, ip_list, failed_ips, questionable_ips):
     return None
 
 
-def _rt_state_update(route_table_id, dcidr, router_ip="(none)",
-                     instance_id="(none)", eni_id="(none)",
-                     old_router_ip="(none)", msg="(none)"):
+class RouteStatus(object):
+    """
+    The possible states of a route in a route table, as recorded in the
+    current state.
+
+    """
+    CURRENT   = "current"     # route exists and is up to date
+    ADDED     = "added"       # route was missing and has been added
+    UPDATED   = "updated"     # route now points to a different router
+    IGNORED   = "ignored"     # route is not managed by us
+    NO_TARGET = "no_target"   # no healthy router available for the route
+    FAILED    = "failed"      # adding or updating the route failed
+    DELETED   = "deleted"     # route was not in the spec and was deleted
+
+
+class RouteReason(object):
+    """
+    Reason codes, which explain the status of a route.
+
     """
-    Store a message about a VPC route in the current state.
+    UP_TO_DATE         = "up_to_date"
+    MISSING            = "missing"
+    OTHER_RT_DIFFERENT = "other_rt_different_ip"
+    ROUTER_UNUSABLE    = "router_unusable"
+    NONE_HEALTHY       = "none_healthy"
+    PROTECTED_CIDR     = "protected_cidr"
+    NOT_INSTANCE_ROUTE = "not_instance_route"
+    NOT_IN_SPEC        = "not_in_spec"
+    ROUTE_GONE         = "route_gone"
+    ROUTE_TABLE_GONE   = "route_table_gone"
+
+
+# Human readable explanations of the reason codes, used for log messages and
+# when the state is rendered.
+_REASON_TEXT = {
+    RouteReason.UP_TO_DATE         : "route exists and is up to date",
+    RouteReason.MISSING            : "route was missing",
+    RouteReason.OTHER_RT_DIFFERENT : "other RT used different IP",
+    RouteReason.ROUTER_UNUSABLE    : "old IP failed/questionable or "
+                                     "not eligible anymore",
+    RouteReason.NONE_HEALTHY       : "none healthy, black hole",
+    RouteReason.PROTECTED_CIDR     : "protected CIDR",
+    RouteReason.NOT_INSTANCE_ROUTE : "not a route to an instance",
+    RouteReason.NOT_IN_SPEC        : "route not in spec",
+    RouteReason.ROUTE_GONE         : "route not seen anymore",
+    RouteReason.ROUTE_TABLE_GONE   : "route table not seen anymore",
+}
+
+
+class RouteState(collections.namedtuple(
+                        "RouteState",
+                        ["status", "reason", "router_ip", "instance_id",
+                         "eni_id", "old_router_ip", "detail", "timestamp"])):
+    """
+    A compact record about a route in a route table.
+
+    These records are created for every route during every processing of the
+    route spec, so they only hold references to values we have anyway. They
+    are only rendered into something human readable when the state is
+    requested.
+
+    The timestamp is the time at which the route got into this state: A
+    record that doesn't change during a run is kept (see
+    _keep_unchanged_records()).
+
+    """
+    __slots__ = ()
+
+    def as_dict(self):
+        """
+        Return a rendering of the record, suitable for JSON output.
+
+        """
+        return {
+            "status"        : self.status,
+            "reason"        : self.reason,
+            "msg"           : _REASON_TEXT.get(self.reason, self.reason),
+            "router_ip"     : self.router_ip,
+            "instance_id"   : self.instance_id,
+            "eni_id"        : self.eni_id,
+            "old_router_ip" : self.old_router_ip,
+            "detail"        : self.detail,
+            "time"          : datetime.datetime.fromtimestamp(
+                                            self.timestamp).isoformat()
+        }
+
+
+class RemovedRoute(collections.namedtuple(
+                        "RemovedRoute",
+                        ["route_table_id", "dcidr", "reason", "state",
+                         "timestamp"])):
+    """
+    A record about a route that was removed from the VPC state, kept in the
+    history of recently removed routes.
+
+    The last known state of the route is included.
+
+    """
+    __slots__ = ()
+
+    def as_dict(self):
+        """
+        Return a rendering of the record, suitable for JSON output.
+
+        """
+        return {
+            "route_table_id" : self.route_table_id,
+            "dcidr"          : self.dcidr,
+            "reason"         : self.reason,
+            "msg"            : _REASON_TEXT.get(self.reason, self.reason),
+            "last_state"     : self.state.as_dict(),
+            "time"           : datetime.datetime.fromtimestamp(
+                                            self.timestamp).isoformat()
+        }
+
+
+def _prune_rt_state(old_rt_state, new_rt_state):
+    """
+    Move routes, which are not part of the VPC state anymore, into the history
+    of recently removed routes.
+
+    Those are the routes that were deleted during this run, as well as routes
+    (or entire route tables) that we had seen before, but didn't see this
+    time around.
+
+    """
+    now     = time.time()
+    history = CURRENT_STATE.vpc_history
+    for rt_id, routes in new_rt_state.items():
+        for dcidr, rec in routes.items():
+            if rec.status == RouteStatus.DELETED:
+                history.append(RemovedRoute(rt_id, dcidr, rec.reason,
+                                            rec, now))
+                del routes[dcidr]
+
+    for rt_id, routes in old_rt_state.items():
+        new_routes = new_rt_state.get(rt_id)
+        reason     = RouteReason.ROUTE_GONE if new_routes is not None \
+                                            else RouteReason.ROUTE_TABLE_GONE
+        for dcidr, rec in routes.items():
+            if (new_routes is None or dcidr not in new_routes) and \
+                                        rec.status != RouteStatus.DELETED:
+                history.append(RemovedRoute(rt_id, dcidr, reason, rec, now))
+
+
+def _keep_unchanged_records(old_rt_state, new_rt_state):
+    """
+    Replace the new records of routes, whose state didn't change during this
+    run, with their previous records.
+
+    Only the timestamps of those records differ, so this keeps the time at
+    which the route got into its state, and the published VPC state only
+    changes if the state of a route did.
+
+    """
+    for rt_id, routes in new_rt_state.items():
+        old_routes = old_rt_state.get(rt_id)
+        if not old_routes:
+            continue
+        for dcidr, rec in routes.items():
+            old_rec = old_routes.get(dcidr)
+            if old_rec is not None and old_rec[:-1] == rec[:-1]:
+                routes[dcidr] = old_rec
+
+
+# Route records with these statuses mean that we changed the route
+_CHANGED_STATUSES = (RouteStatus.ADDED, RouteStatus.UPDATED,
+                     RouteStatus.DELETED)
+
+
+def _rt_state_update(route_table_id, dcidr, status, reason, router_ip=None,
+                     instance_id=None, eni_id=None, old_router_ip=None,
+                     detail=None):
+    """
+    Store a record about a VPC route in the current state.
+
+    Changes to the route are also emitted as events.
 
     """
-    buf = "inst: %s, eni: %s, r_ip: %-15s, o_r_ip: %-15s, msg: %s" % \
-          (instance_id, eni_id, router_ip, old_router_ip, msg)
     CURRENT_STATE.vpc_state.setdefault('route_tables', {}). \
-                            setdefault(route_table_id, {})[dcidr] = buf
+            setdefault(route_table_id, {})[dcidr] = \
+                RouteState(status, reason, router_ip, instance_id, eni_id,
+                           old_router_ip, detail, time.time())
+
+    if status in _CHANGED_STATUSES:
+        EVENTS.emit(EventType.ROUTE_CHANGED,
+                    route_table_id=route_table_id, dcidr=dcidr,
+                    status=status, reason=reason, router_ip=router_ip,
+                    instance_id=instance_id, eni_id=eni_id,
+                    old_router_ip=old_router_ip)
+
+
+def _new_reconcile_summary():
+    """
+    Return a dict in which the outcome of processing the route spec is
+    counted up.
+
+    This allows the caller to see whether routes had to be changed (drift) or
+    whether there were any problems while doing so.
+
+    """
+    return {
+        "added"     : 0,   # routes we had to add
+        "updated"   : 0,   # routes we had to point to a different router
+        "deleted"   : 0,   # routes we had to remove
+        "errors"    : 0,   # failed route operations
+        "no_target" : 0,   # routes without any healthy router
+        "api_error" : False
+    }
+
+
+def _count(summary, key, result=True):
+    """
+    Count an outcome in the summary, if a summary is maintained.
+
+    The result of a route operation may be passed in: If it is False, the
+    operation is counted as an error instead. If it is None, the route was not
+    touched and nothing is counted.
+
+    """
+    if summary is not None and result is not None:
+        summary[key if result else "errors"] += 1
 
 
 def _update_route(dcidr, router_ip, old_router_ip,
@@ -234,8 +487,13 @@ def _update_route(dcidr, router_ip, old_router_ip,
     """
     Update an existing route entry in the route table.
 
+    The update reason is one of the RouteReason codes.
+
+    Returns True if the route was updated, False if the update failed and None
+    if the route was not touched.
+
     """
-    instance = eni = None
+    instance = eni = detail = None
     try:
         instance, eni = find_instance_and_eni_by_ip(vpc_info, router_ip)
         # Only set the route if the ENI is associated with the same subnet as
@@ -247,12 +505,13 @@ def _update_route(dcidr, router_ip, old_router_ip,
                           "with same subnet as ENI (ENI subnet: %s, RTs: %s)" %
                           (route_table_id, dcidr, router_ip, instance.id,
                            eni.id, eni.subnet_id, rts_for_subnet))
-            return
+            return None
 
         logging.info("--- updating existing route in RT '%s' "
                      "%s -> %s (%s, %s) (old IP: %s, reason: %s)" %
                      (route_table_id, dcidr, router_ip,
-                      instance.id, eni.id, old_router_ip, update_reason))
+                      instance.id, eni.id, old_router_ip,
+                      _REASON_TEXT.get(update_reason, update_reason)))
         try:
             con.replace_route(
                         route_table_id         = route_table_id,
@@ -264,22 +523,30 @@ def _update_route(dcidr, router_ip, old_router_ip,
 
         CURRENT_STATE.routes[dcidr] = \
                                     (router_ip, str(instance.id), str(eni.id))
+        success = True
     except Exception as e:
         msg = "*** failed to update route in RT '%s' %s -> %s (%s)" % \
               (route_table_id, dcidr, old_router_ip, e.message)
-        update_reason += " [ERROR update route: %s]" % e.message
+        detail = "ERROR update route: %s" % e.message
         logging.error(msg)
+        success = False
 
-    _rt_state_update(route_table_id, dcidr, router_ip,
-                     instance.id if instance else "(none)",
-                     eni.id if eni else "(none)",
-                     old_router_ip, update_reason)
+    _rt_state_update(route_table_id, dcidr,
+                     RouteStatus.UPDATED if success else RouteStatus.FAILED,
+                     update_reason, router_ip,
+                     instance.id if instance else None,
+                     eni.id if eni else None,
+                     old_router_ip, detail)
+    return success
 
 
 def _add_new_route(dcidr, router_ip, vpc_info, con, route_table_id):
     """
     Add a new route to the route table.
 
+    Returns True if the route was added, False if adding it failed and None
+    if the route was not touched.
+
     """
     try:
         instance, eni = find_instance_and_eni_by_ip(vpc_info, router_ip)
@@ -292,7 +559,7 @@ def _add_new_route(dcidr, router_ip, vpc_info, con, route_table_id):
                           "with same subnet as ENI (ENI subnet: %s, RTs: %s)" %
                           (route_table_id, dcidr, router_ip, instance.id,
                            eni.id, eni.subnet_id, rts_for_subnet))
-            return
+            return None
 
         logging.info("--- adding route in RT '%s' "
                      "%s -> %s (%s, %s)" %
@@ -303,15 +570,19 @@ def _add_new_route(dcidr, router_ip, vpc_info, con, route_table_id):
                          interface_id           = eni.id)
         CURRENT_STATE.routes[dcidr] = \
                                     (router_ip, str(instance.id), str(eni.id))
-        _rt_state_update(route_table_id, dcidr, router_ip, instance.id, eni.id,
-                         msg="Added route")
+        _rt_state_update(route_table_id, dcidr,
+                         RouteStatus.ADDED, RouteReason.MISSING,
+                         router_ip, instance.id, eni.id)
+        return True
 
     except Exception as e:
         logging.error("*** failed to add route in RT '%s' "
                       "%s -> %s (%s)" %
                       (route_table_id, dcidr, router_ip, e.message))
         _rt_state_update(route_table_id, dcidr,
-                         msg="[ERROR add route: %s]" % e.message)
+                         RouteStatus.FAILED, RouteReason.MISSING,
+                         detail="ERROR add route: %s" % e.message)
+        return False
 
 
 def _get_real_instance_if_mismatch(vpc_info, ipaddr, instance, eni):
@@ -426,7 +697,7 @@ def _is_cidr_in_ignore_routes(cidr):
 
 
 def _update_existing_routes(route_spec, failed_ips, questionable_ips,
-                            vpc_info, con, routes_in_rts):
+                            vpc_info, con, routes_in_rts, summary=None):
     """
     Go over the existing routes and check whether they still match the spec.
 
@@ -435,7 +706,8 @@ def _update_existing_routes(route_spec, failed_ips, questionable_ips,
     at all anymore then it needs to be deleted.
 
     Keeps track of the routes we have seen in each RT and populates the
-    passed-in routes_in_rts dictionary with that info.
+    passed-in routes_in_rts dictionary with that info. If a summary dict is
+    passed in, the changes and problems are counted in it.
 
     Returns a dict with the routers chosen for the various routes we
     encountered.
@@ -456,8 +728,8 @@ def _update_existing_routes(route_spec, failed_ips, questionable_ips,
                 # then we will not touch or change this route. Often this is
                 # used to protect routes to special instances, such as
                 # proxies or NAT instances.
-                _rt_state_update(rt.id, dcidr,
-                                 msg="Ignored: Protected CIDR.")
+                _rt_state_update(rt.id, dcidr, RouteStatus.IGNORED,
+                                 RouteReason.PROTECTED_CIDR)
                 continue
 
             if r.instance_id is None and r.interface_id is None:
@@ -465,8 +737,8 @@ def _update_existing_routes(route_spec, failed_ips, questionable_ips,
                 # which we don't need to mess with. Specifically, routes that
                 # aren't attached to a particular instance or interface.
                 # We skip those.
-                _rt_state_update(rt.id, dcidr,
-                                 msg="Ignored: Not a route to an instance")
+                _rt_state_update(rt.id, dcidr, RouteStatus.IGNORED,
+                                 RouteReason.NOT_INSTANCE_ROUTE)
                 continue
 
             routes_in_rts[rt.id].append(dcidr)  # remember we've seen the route
@@ -487,6 +759,10 @@ def _update_existing_routes(route_spec, failed_ips, questionable_ips,
                                  destination_cidr_block = dcidr)
                 if dcidr in CURRENT_STATE.routes:
                     del CURRENT_STATE.routes[dcidr]
+                _rt_state_update(rt.id, dcidr, RouteStatus.DELETED,
+                                 RouteReason.NOT_IN_SPEC,
+                                 ipaddr, inst_id, eni_id)
+                _count(summary, "deleted")
 
                 continue
 
@@ -507,7 +783,7 @@ def _update_existing_routes(route_spec, failed_ips, questionable_ips,
                                         ipaddr in questionable_ips
 
             # Is the host not eligible anymore?
-            ipaddr_not_eligible = ipaddr not in hosts
+            ipaddr_not_eligible = ipaddr not in _as_set(hosts)
 
             shouldnt_use_ipaddr = \
                             ipaddr_should_be_replaced or ipaddr_not_eligible
@@ -524,8 +800,9 @@ def _update_existing_routes(route_spec, failed_ips, questionable_ips,
                              (rt.id, dcidr,
                               ipaddr, inst_id, eni_id))
                 CURRENT_STATE.routes[dcidr] = (ipaddr, inst_id, eni_id)
-                _rt_state_update(rt.id, dcidr, ipaddr, inst_id, eni_id,
-                                 msg="Current: Route exist and up to date")
+                _rt_state_update(rt.id, dcidr, RouteStatus.CURRENT,
+                                 RouteReason.UP_TO_DATE,
+                                 ipaddr, inst_id, eni_id)
                 continue
 
             if stored_router_ip == NONE_HEALTHY:
@@ -533,9 +810,10 @@ def _update_existing_routes(route_spec, failed_ips, questionable_ips,
                 # couldn't find any healthy hosts. Can't do anything and
                 # need to skip.
                 CURRENT_STATE.routes[dcidr] = (ipaddr, inst_id, eni_id)
-                _rt_state_update(rt.id, dcidr, ipaddr, inst_id, eni_id,
-                                 msg="None healthy, black hole: "
-                                     "Determined earlier")
+                _rt_state_update(rt.id, dcidr, RouteStatus.NO_TARGET,
+                                 RouteReason.NONE_HEALTHY,
+                                 ipaddr, inst_id, eni_id)
+                _count(summary, "no_target")
                 continue
 
             if stored_router_ip:
@@ -543,7 +821,7 @@ def _update_existing_routes(route_spec, failed_ips, questionable_ips,
                 # because only healthy hosts make it into the chosen_routers
                 # dict.
                 new_router_ip = stored_router_ip
-                update_reason = "other RT used different IP"
+                update_reason = RouteReason.OTHER_RT_DIFFERENT
             else:
                 # Haven't seen this route in another RT, so we'll
                 # choose a new router
@@ -558,20 +836,25 @@ def _update_existing_routes(route_spec, failed_ips, questionable_ips,
                     logging.warning("--- cannot find available target "
                                     "for route update %s! "
                                     "Nothing I can do..." % (dcidr))
+                    _rt_state_update(rt.id, dcidr, RouteStatus.NO_TARGET,
+                                     RouteReason.NONE_HEALTHY,
+                                     ipaddr, inst_id, eni_id)
+                    _count(summary, "no_target")
                     continue
 
                 chosen_routers[dcidr] = new_router_ip
-                update_reason = "old IP failed/questionable or " \
-                                "not eligible anymore"
+                update_reason = RouteReason.ROUTER_UNUSABLE
 
-            _update_route(dcidr, new_router_ip, ipaddr,
-                          vpc_info, con, rt.id, update_reason)
+            res = _update_route(dcidr, new_router_ip, ipaddr,
+                                vpc_info, con, rt.id, update_reason)
+            _count(summary, "updated", res)
 
     return chosen_routers
 
 
 def _add_missing_routes(route_spec, failed_ips, questionable_ips,
-                        chosen_routers, vpc_info, con, routes_in_rts):
+                        chosen_routers, vpc_info, con, routes_in_rts,
+                        summary=None):
     """
     Iterate over route spec and add all the routes we haven't set yet.
 
@@ -583,6 +866,9 @@ def _add_missing_routes(route_spec, failed_ips, questionable_ips,
     This information is passed in via the chosen_routers dict. We should choose
     routers that were used before.
 
+    If a summary dict is passed in, the changes and problems are counted in
+    it.
+
     """
     for dcidr, hosts in route_spec.items():
         new_router_ip = chosen_routers.get(dcidr)
@@ -598,10 +884,13 @@ def _add_missing_routes(route_spec, failed_ips, questionable_ips,
                         logging.warning("--- cannot find available target "
                                         "for route addition %s! "
                                         "Nothing I can do..." % (dcidr))
+                        _count(summary, "no_target")
                         # Skipping the check on any further RT, breaking out to
                         # outer most loop over route spec
                         break
-                _add_new_route(dcidr, new_router_ip, vpc_info, con, rt_id)
+                res = _add_new_route(dcidr, new_router_ip,
+                                     vpc_info, con, rt_id)
+                _count(summary, "added", res)
 
 
 def process_route_spec_config(con, vpc_info, route_spec,
@@ -618,10 +907,15 @@ def process_route_spec_config(con, vpc_info, route_spec,
     If a route points at a failed or questionable IP then a new candidate is
     chosen, if possible.
 
+    Returns a summary dict, which counts the changes that had to be made and
+    any problems we encountered.
+
     """
+    summary = _new_reconcile_summary()
+
     if CURRENT_STATE._stop_all:
         logging.debug("Routespec processing. Stop requested, abort operation")
-        return
+        return summary
 
     if failed_ips:
         logging.debug("Route spec processing. Failed IPs: %s" %
@@ -629,6 +923,12 @@ def process_route_spec_config(con, vpc_info, route_spec,
     else:
         logging.debug("Route spec processing. No failed IPs.")
 
+    # The same sets of failed and questionable IPs are used for all host
+    # pools during this run.
+    failed_ips       = frozenset(failed_ips)
+    questionable_ips = frozenset(questionable_ips)
+    _CANDIDATES.clear()
+
     # Iterate over all the routes in the VPC, check they are contained in
     # the spec, update the routes as needed.
 
@@ -636,48 +936,79 @@ def process_route_spec_config(con, vpc_info, route_spec,
     # add them, if needed.
     routes_in_rts  = {}
 
-    CURRENT_STATE.vpc_state.setdefault("time",
-                                       datetime.datetime.now().isoformat())
+    CURRENT_STATE.vpc_state["time"] = datetime.datetime.now().isoformat()
+
+    # The state of the route tables is rebuilt with every run, so that it only
+    # reflects the route tables and routes that currently exist. Anything we
+    # don't see anymore is moved into a bounded history when we are done.
+    old_rt_state = CURRENT_STATE.vpc_state.get('route_tables', {})
+    new_rt_state = {rt.id : {} for rt in vpc_info['route_tables']}
+    CURRENT_STATE.vpc_state['route_tables'] = new_rt_state
 
     # Passed through the functions and filled in, state accumulates information
     # about all the routes we encounted in the VPC and what we are doing with
     # them. This is then available in the CURRENT_STATE
     chosen_routers = _update_existing_routes(route_spec,
                                              failed_ips, questionable_ips,
-                                             vpc_info, con, routes_in_rts)
+                                             vpc_info, con, routes_in_rts,
+                                             summary)
 
     # Now go over all the routes in the spec and add those that aren't in VPC,
     # yet.
     _add_missing_routes(route_spec, failed_ips, questionable_ips,
                         chosen_routers,
-                        vpc_info, con, routes_in_rts)
+                        vpc_info, con, routes_in_rts, summary)
+
+    _prune_rt_state(old_rt_state, new_rt_state)
+    _keep_unchanged_records(old_rt_state, new_rt_state)
+
+    # Make the result of this run visible to readers of the state
+    CURRENT_STATE.publish_snapshot()
+
+    return summary
 
 
 def handle_spec(region_name, vpc_id, route_spec, failed_ips, questionable_ips):
     """
     Connect to region and update routes according to route spec.
 
+    Returns the summary of the route spec processing, or None if the route
+    spec was not processed at all.
+
+    An error while talking to the AWS API is not raised, but is flagged in the
+    returned summary instead, so that the caller can retry soon.
+
     """
     if CURRENT_STATE._stop_all:
         logging.debug("handle_spec: Stop requested, abort operation")
-        return
+        return None
 
     if not route_spec:
         logging.debug("handle_spec: No route spec provided")
-        return
+        return None
 
     logging.debug("Handle route spec")
 
+    start_time = time.time()
+    summary    = None
     try:
         con      = connect_to_region(region_name)
         vpc_info = get_vpc_overview(con, vpc_id, region_name)
-        process_route_spec_config(con, vpc_info, route_spec,
-                                  failed_ips, questionable_ips)
+        summary  = process_route_spec_config(con, vpc_info, route_spec,
+                                             failed_ips, questionable_ips)
         con.close()
     except boto.exception.StandardError as e:
         logging.warning("vpc-router could not set route: %s - %s" %
                         (e.message, e.args))
-        raise
+        summary = _new_reconcile_summary()
+        summary['api_error'] = True
 
     except boto.exception.NoAuthHandlerFound:
         logging.error("vpc-router could not authenticate")
+        summary = _new_reconcile_summary()
+        summary['api_error'] = True
+
+    EVENTS.emit(EventType.RECONCILE_FINISHED,
+                duration=round(time.time() - start_time, 3), **summary)
+
+    return summary
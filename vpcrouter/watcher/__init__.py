@@ -19,16 +19,22 @@ limitations under the License.
 # Functions for watching route spec in daemon mode
 #
 
-import itertools
+import datetime
 import logging
 import time
 
 from vpcrouter              import vpc, utils
 from vpcrouter.currentstate import CURRENT_STATE
+from vpcrouter.events       import EVENTS, EventType
+from vpcrouter.watcher      import common
 
 
 WATCHER_DEFAULT_PLUGIN_MODULE = "vpcrouter.watcher.plugins"
 
+# Number of overlapping CIDRs that are listed in the log, all of them are
+# shown on the /route_info page.
+MAX_LOGGED_OVERLAPS           = 3
+
 
 def _update_health_monitor_with_new_ips(route_spec, all_ips,
                                         q_monitor_ips):
@@ -41,8 +47,10 @@ def _update_health_monitor_with_new_ips(route_spec, all_ips,
 
     """
     # Extract all the IP addresses from the route spec, unique and sorted.
-    new_all_ips = \
-        sorted(set(itertools.chain.from_iterable(route_spec.values())))
+    # CIDRs with the same hosts share the same host pool in a validated route
+    # spec, so we only need to look at each distinct pool once.
+    pools       = {id(hosts) : hosts for hosts in route_spec.values()}
+    new_all_ips = sorted(set().union(*pools.values()))
     if new_all_ips != all_ips:
         logging.debug("New route spec detected. Updating "
                       "health-monitor with: %s" %
@@ -58,10 +66,191 @@ def _update_health_monitor_with_new_ips(route_spec, all_ips,
     return all_ips
 
 
+class _RouteCheckScheduler(object):
+    """
+    Decides when it is time for a regular re-check of the VPC routes.
+
+    As long as the re-checks don't find any drift in the route tables, the
+    interval between them is doubled, up to a maximum. As soon as a re-check
+    (or any other processing of the route spec) had to change routes, ran into
+    errors or could only partially apply the spec, we snap back to the
+    shortest interval.
+
+    An interval of 0 disables the regular re-checks.
+
+    """
+    BACKOFF_FACTOR = 2
+
+    def __init__(self, min_interval, max_interval=None):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval) \
+                                        if max_interval else min_interval
+        self.interval     = min_interval
+        self.last_check   = time.time()
+        self._publish()
+
+    def _publish(self):
+        """
+        Make the current interval visible in the current state.
+
+        """
+        CURRENT_STATE.route_recheck = {
+            "current_interval" : self.interval,
+            "min_interval"     : self.min_interval,
+            "max_interval"     : self.max_interval,
+            "last_check_time"  : datetime.datetime.fromtimestamp(
+                                            self.last_check).isoformat()
+        }
+
+    def is_due(self, now):
+        """
+        Return True if it is time for a regular re-check of the routes.
+
+        """
+        return bool(self.interval) and \
+                                (now - self.last_check) > self.interval
+
+    def checked(self, now, summary):
+        """
+        Take note that the routes were just processed, with the summary
+        returned by handle_spec(). A summary of None means that the routes
+        were not processed.
+
+        """
+        self.last_check = now
+        if summary and (summary['added'] or summary['updated'] or
+                        summary['deleted'] or summary['errors'] or
+                        summary['no_target'] or summary['api_error']):
+            if self.interval != self.min_interval:
+                logging.debug("Route drift or errors detected, re-checking "
+                              "routes in %s seconds" % self.min_interval)
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.BACKOFF_FACTOR,
+                                self.max_interval)
+        self._publish()
+
+
+def _log_cidr_overlaps(overlaps):
+    """
+    Log a summary of the overlapping CIDRs in a route spec: Their number and
+    the first few of them.
+
+    """
+    if not overlaps:
+        logging.info("Route spec has no more overlapping CIDRs")
+        return
+    listed = ["%s overlaps with %s%s" %
+              (o['cidr'], o['overlaps_with'],
+               "" if o['same_hosts'] else " (with different hosts)")
+              for o in overlaps[:MAX_LOGGED_OVERLAPS]]
+    more   = len(overlaps) - len(listed)
+    logging.warning("Route spec has %d overlapping CIDR%s: %s%s" %
+                    (len(overlaps), "" if len(overlaps) == 1 else "s",
+                     ", ".join(listed),
+                     " and %d more (see /route_info)" % more if more else ""))
+
+
+def _store_new_input(failed_ips, questnbl_ips, new_route_spec):
+    """
+    Store any newly received failed or questionable IPs and route spec in the
+    shared state.
+
+    Readers of the state see the new input right away, even before (or if it
+    fails, without) the routes being processed. Overlapping CIDRs in a new
+    route spec are recorded in the state as well, and logged if they differ
+    from those of the last route spec.
+
+    """
+    if failed_ips:
+        CURRENT_STATE.failed_ips = failed_ips
+
+    if questnbl_ips:
+        CURRENT_STATE.questionable_ips = questnbl_ips
+
+    if new_route_spec:
+        overlaps = common.find_overlapping_cidrs(new_route_spec)
+        if overlaps != CURRENT_STATE.cidr_overlaps:
+            _log_cidr_overlaps(overlaps)
+        CURRENT_STATE.route_spec    = new_route_spec
+        CURRENT_STATE.cidr_overlaps = overlaps
+
+    if failed_ips or questnbl_ips or new_route_spec:
+        CURRENT_STATE.publish_snapshot(["ips", "route_info"])
+
+
+def _read_new_route_spec(q_route_spec, last_spec_msg):
+    """
+    Return the message with the latest route spec from the queue, or None if
+    there is none or if it's identical to the last route spec message we have
+    seen.
+
+    An identical route spec doesn't need to be processed again. It is still
+    reported as applied, though, since it is in effect.
+
+    """
+    spec_msg = utils.read_last_envelope_from_queue(q_route_spec)
+    if spec_msg is None or last_spec_msg is None or \
+                    spec_msg.content_hash != last_spec_msg.content_hash:
+        return spec_msg
+
+    logging.debug("Received route spec is identical to current one, "
+                  "ignoring it")
+    EVENTS.emit(EventType.SPEC_APPLIED,
+                num_routes = len(spec_msg.payload),
+                version    = spec_msg.generation,
+                latency    = round(time.time() - spec_msg.timestamp, 3),
+                applied    = True,
+                unchanged  = True,
+                summary    = None)
+    return None
+
+
+def _emit_events(spec_msg, failed_ips, summary, reported_failed_ips):
+    """
+    Emit events about the outcome of processing the route spec.
+
+    A router is reported as failed when it is first excluded from the routes
+    because of a failed health check, and as recovered when it is eligible
+    for routes again. Only a new message from the health monitor can tell us
+    that: If failed_ips is None (no message, for example in a regular route
+    check), the reported failed IPs remain as they are.
+
+    If a new route spec message was processed, this is reported as well.
+    The event includes the version (the generation of the message) and the
+    latency from sending the spec to being done with applying it. The
+    'applied' flag is False if the spec wasn't processed at all.
+
+    Return the set of failed IPs, which should be passed in as
+    reported_failed_ips next time.
+
+    """
+    if failed_ips is None:
+        failed_ips = reported_failed_ips
+    else:
+        failed_ips = set(failed_ips)
+        for ip in sorted(failed_ips - reported_failed_ips):
+            EVENTS.emit(EventType.ROUTER_FAILED, ip=ip)
+        for ip in sorted(reported_failed_ips - failed_ips):
+            EVENTS.emit(EventType.ROUTER_RECOVERED, ip=ip)
+
+    if spec_msg and spec_msg.payload:
+        EVENTS.emit(EventType.SPEC_APPLIED,
+                    num_routes = len(spec_msg.payload),
+                    version    = spec_msg.generation,
+                    latency    = round(time.time() - spec_msg.timestamp, 3),
+                    applied    = summary is not None,
+                    unchanged  = False,
+                    summary    = summary)
+
+    return failed_ips
+
+
 def _event_monitor_loop(region_name, vpc_id,
                         watcher_plugin, health_plugin,
                         iterations, sleep_time,
-                        route_check_time_interval=30):
+                        route_check_time_interval=30,
+                        route_check_max_interval=None):
     """
     Monitor queues to receive updates about new route specs or any detected
     failed IPs.
@@ -76,7 +265,9 @@ def _event_monitor_loop(region_name, vpc_id,
     The 'route_check_time_interval' arguments specifies the number of seconds
     we allow to elapse before forcing a re-check of the VPC routes. This is so
     that accidentally deleted routes or manually broken route tables can be
-    fixed back up again on their own.
+    fixed back up again on their own. If 'route_check_max_interval' is
+    specified, this interval grows up to that maximum while no drift in the
+    routes is detected.
 
     """
     q_route_spec = watcher_plugin.get_route_spec_queue()
@@ -85,33 +276,32 @@ def _event_monitor_loop(region_name, vpc_id,
     time.sleep(sleep_time)   # Wait to allow monitor to report results
 
     current_route_spec = {}  # The last route spec we have seen
+    last_spec_msg = None     # ... and the message in which we received it
     all_ips = []             # Cache of IP addresses we currently know about
+    reported_failed_ips = set()  # Failed IPs we have emitted events for
 
     # Occasionally we want to recheck VPC routes even without other updates.
     # That way, if a route is manually deleted by someone, it will be
     # re-created on its own.
-    last_route_check_time    = time.time()
+    route_check = _RouteCheckScheduler(route_check_time_interval,
+                                       route_check_max_interval)
     while not CURRENT_STATE._stop_all:
         try:
             # Get the latest messages from the route-spec monitor and the
             # health-check monitor. At system start the route-spec queue should
             # immediately have been initialized with a first message.
+            # Route specs that are identical to the current one are dropped.
             failed_ips     = utils.read_last_msg_from_queue(q_failed_ips)
             questnbl_ips   = utils.read_last_msg_from_queue(q_questionable_ips)
-            new_route_spec = utils.read_last_msg_from_queue(q_route_spec)
+            spec_msg       = _read_new_route_spec(q_route_spec, last_spec_msg)
+            new_route_spec = spec_msg.payload if spec_msg else None
 
-            if failed_ips:
-                # Store the failed IPs in the shared state
-                CURRENT_STATE.failed_ips = failed_ips
-
-            if questnbl_ips:
-                # Store the questionable IPs in the shared state
-                CURRENT_STATE.questionble_ips = questnbl_ips
+            # Store the new input in the shared state
+            _store_new_input(failed_ips, questnbl_ips, new_route_spec)
 
             if new_route_spec:
-                # Store the new route spec in the shared state
-                CURRENT_STATE.route_spec = new_route_spec
                 current_route_spec = new_route_spec
+                last_spec_msg      = spec_msg
                 # Need to communicate a new set of IPs to the health
                 # monitoring thread, in case the list changed. The list of
                 # addresses is extracted from the route spec. Pass in the old
@@ -128,8 +318,7 @@ def _event_monitor_loop(region_name, vpc_id,
             # route spec. This is also called occasionally on its own, so that
             # we can repair any damaged route tables in VPC.
             now = time.time()
-            time_for_regular_recheck = \
-                    (now - last_route_check_time) > route_check_time_interval
+            time_for_regular_recheck = route_check.is_due(now)
 
             if new_route_spec or failed_ips or questnbl_ips or \
                                                 time_for_regular_recheck:
@@ -137,10 +326,16 @@ def _event_monitor_loop(region_name, vpc_id,
                     # Only reason we are here is due to expired timer.
                     logging.debug("Time for regular route check")
 
-                last_route_check_time = now
-                vpc.handle_spec(region_name, vpc_id, current_route_spec,
-                                failed_ips if failed_ips else [],
-                                questnbl_ips if questnbl_ips else [])
+                summary = vpc.handle_spec(region_name, vpc_id,
+                                          current_route_spec,
+                                          failed_ips if failed_ips else [],
+                                          questnbl_ips if questnbl_ips else [])
+                # Any drift or errors make us check again soon, otherwise
+                # the regular checks become less frequent.
+                route_check.checked(now, summary)
+                reported_failed_ips = _emit_events(spec_msg,
+                                                   failed_ips, summary,
+                                                   reported_failed_ips)
 
             # If iterations are provided, count down and exit
             if iterations is not None:
@@ -238,7 +433,9 @@ def start_watcher(conf, watcher_plugin_class, health_plugin_class,
     # threads about any failed IP addresses or updated route specs.
     _event_monitor_loop(conf['region_name'], conf['vpc_id'],
                         watcher_plugin, health_plugin,
-                        iterations, sleep_time, conf['route_recheck_interval'])
+                        iterations, sleep_time,
+                        conf['route_recheck_interval'],
+                        conf.get('route_recheck_max_interval'))
 
     # Stopping plugins and collecting all worker threads when we are done
     stop_plugins(watcher_plugin, health_plugin)
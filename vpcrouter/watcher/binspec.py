@@ -0,0 +1,228 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# A compact binary format for route specs, which can be loaded much faster
+# than JSON, together with a converter from JSON.
+#
+# Layout (all integers are unsigned 32 bit, little endian):
+#
+#   magic      8 bytes, "VPCRSPEC"
+#   header     format version, number of host pools, number of hosts,
+#              number of routes
+#   pools      (offset, count) for each host pool, into the hosts table
+#   hosts      the IP addresses of all host pools
+#   routes     (address, prefix length, pool index) for each CIDR
+#
+# Routes with the same hosts share a single entry in the host pool table.
+#
+
+import argparse
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+from vpcrouter         import utils
+from vpcrouter.errors  import ArgsError
+from vpcrouter.watcher import common
+
+
+MAGIC   = "VPCRSPEC"
+VERSION = 1
+
+_HEADER = struct.Struct("<8sIIII")
+
+# The array typecode for unsigned 32 bit integers on this platform
+_UINT32 = "I" if array.array("I").itemsize == 4 else "L"
+
+
+def is_binary_spec(f):
+    """
+    Return True if the open file starts with the magic bytes of a binary route
+    spec. The file is left positioned at its start.
+
+    Raises IOError if the file can't be read.
+
+    """
+    magic = f.read(len(MAGIC))
+    f.seek(0)
+    return magic == MAGIC
+
+
+def _uint32_array(buf, offset, count):
+    """
+    Return an array of 'count' little endian unsigned 32 bit integers from
+    the buffer, starting at 'offset'.
+
+    """
+    a = array.array(_UINT32)
+    a.fromstring(buffer(buf, offset, count * 4))
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+def parse_binary_spec(buf):
+    """
+    Parse a route spec in binary format from a buffer (a string or mmap).
+
+    Only the offsets, prefix lengths and pool indices need to be checked, the
+    addresses can't be invalid. Each host pool is converted just once,
+    regardless of how many routes share it.
+
+    Returns the route spec. Raises ValueError in case of problems.
+
+    """
+    if len(buf) < _HEADER.size:
+        raise ValueError("Binary route spec: Truncated header")
+    magic, version, num_pools, num_hosts, num_routes = \
+                                            _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("Binary route spec: Invalid magic bytes")
+    if version != VERSION:
+        raise ValueError("Binary route spec: Unsupported version %d" %
+                         version)
+    size = _HEADER.size + 4 * (2 * num_pools + num_hosts + 3 * num_routes)
+    if len(buf) != size:
+        raise ValueError("Binary route spec: Expected %d bytes, got %d" %
+                         (size, len(buf)))
+
+    offset = _HEADER.size
+    pools  = _uint32_array(buf, offset, 2 * num_pools)
+    offset += 8 * num_pools
+    hosts  = _uint32_array(buf, offset, num_hosts)
+    offset += 4 * num_hosts
+    routes = _uint32_array(buf, offset, 3 * num_routes)
+
+    host_pools = []
+    for i in xrange(0, len(pools), 2):
+        start, count = pools[i], pools[i + 1]
+        if start + count > num_hosts:
+            raise ValueError("Binary route spec: Host pool %d out of range" %
+                             (i // 2))
+        host_pools.append(common.get_host_pool(
+                [utils.int_to_ipv4(ip) for ip in hosts[start:start + count]]))
+
+    entries = []
+    for i in xrange(0, len(routes), 3):
+        addr, prefix, pool_index = routes[i], routes[i + 1], routes[i + 2]
+        if prefix > 32 or pool_index >= num_pools:
+            raise ValueError("Binary route spec: Invalid route %d" % (i // 3))
+        entries.append(("%s/%d" % (utils.int_to_ipv4(addr), prefix),
+                        host_pools[pool_index]))
+
+    route_spec = common.RouteSpec(entries)
+    if len(route_spec) != num_routes:
+        raise ValueError("Binary route spec: Duplicate CIDR")
+    return route_spec
+
+
+def map_binary_spec(f):
+    """
+    Return a read-only memory map of an open binary route spec file, which
+    can be given to parse_binary_spec(). The caller has to close it.
+
+    Raises EnvironmentError (mmap.error) if the file can't be mapped.
+
+    """
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def dump_binary_spec(route_spec):
+    """
+    Return the binary representation of a (validated) route spec.
+
+    Raises ValueError if the route spec contains anything that isn't an IPv4
+    address or CIDR.
+
+    """
+    pool_index = {}
+    pools      = array.array(_UINT32)
+    hosts      = array.array(_UINT32)
+    routes     = array.array(_UINT32)
+    try:
+        for cidr, pool in sorted(route_spec.items()):
+            key = tuple(pool)
+            if key not in pool_index:
+                pool_index[key] = len(pool_index)
+                pools.extend([len(hosts), len(key)])
+                hosts.extend(utils.ipv4_to_int(ip) for ip in key)
+            addr, prefix = cidr.split("/")
+            routes.extend([utils.ipv4_to_int(addr), int(prefix),
+                           pool_index[key]])
+    except (ArgsError, ValueError) as e:
+        raise ValueError("Cannot convert route spec: %s" % str(e))
+
+    header = _HEADER.pack(MAGIC, VERSION, len(pool_index), len(hosts),
+                          len(route_spec))
+    for a in [pools, hosts, routes]:
+        if sys.byteorder == "big":
+            a.byteswap()
+    return header + pools.tostring() + hosts.tostring() + routes.tostring()
+
+
+def write_binary_spec(route_spec, fname):
+    """
+    Write a route spec in binary format to a file.
+
+    The file is written under a temporary name first and then renamed into
+    place, so that a watcher of the file never sees it half written.
+
+    """
+    data     = dump_binary_spec(route_spec)
+    tmp_name = "%s.tmp%d" % (fname, os.getpid())
+    with open(tmp_name, "wb") as f:
+        f.write(data)
+    os.rename(tmp_name, fname)
+
+
+def main(args=None):
+    """
+    Command line tool to convert a route spec file in JSON (or JSON Lines)
+    format to the binary format.
+
+    """
+    parser = argparse.ArgumentParser(
+                description="Convert a vpc-router route spec file from JSON "
+                            "to the compact binary format.")
+    parser.add_argument("infile",
+                        help="route spec file in JSON format (JSON Lines "
+                             "if the extension is '.jsonl' or '.ndjson')")
+    parser.add_argument("outfile", help="name of the binary route spec file")
+    conf = parser.parse_args(args)
+
+    # Imported here, since the configfile plugin itself uses this module.
+    from vpcrouter.watcher.plugins import configfile
+
+    try:
+        with open(conf.infile, "r") as f:
+            ext = os.path.splitext(conf.infile)[1].lower()
+            if ext in configfile.JSON_LINES_EXTENSIONS:
+                route_spec = common.parse_route_spec_lines(f)
+            else:
+                route_spec = common.parse_route_spec_config(
+                                                        json.loads(f.read()))
+        write_binary_spec(route_spec, conf.outfile)
+    except (IOError, OSError, ValueError) as e:
+        sys.stderr.write("*** Error: %s\n" % str(e))
+        return 1
+
+    print("Wrote %d routes to %s" % (len(route_spec), conf.outfile))
+    return 0
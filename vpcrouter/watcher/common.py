@@ -19,7 +19,7 @@ limitations under the License.
 # Generally useful functions for the watcher module
 #
 
-import Queue
+import json
 
 from vpcrouter        import utils
 from vpcrouter.errors import ArgsError
@@ -57,9 +57,13 @@ class WatcherPlugin(object):
         Also creates the queue that each plugin needs to use to communicate
         updated route specs out.
 
+        The multi plugin marks its sub-plugins with 'is_sub_plugin': Their
+        route specs are merged with others before they are applied.
+
         """
-        self.conf         = conf
-        self.q_route_spec = Queue.Queue()
+        self.conf          = conf
+        self.q_route_spec  = utils.Mailbox()
+        self.is_sub_plugin = False
 
     def get_plugin_name(self):
         return type(self).__name__.lower()
@@ -137,6 +141,125 @@ class WatcherPlugin(object):
         return
 
 
+class HostPool(tuple):
+    """
+    A sorted, immutable list of hosts, which are eligible as routers for the
+    CIDRs of a route spec.
+
+    Many CIDRs tend to share the same hosts. Validated route specs contain
+    only one HostPool object for each distinct set of hosts, which all those
+    CIDRs refer to. The set of IPs is computed only once, as well.
+
+    """
+    def __new__(cls, hosts):
+        pool        = tuple.__new__(cls, hosts)
+        pool.ip_set = frozenset(pool)
+        return pool
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (HostPool, (tuple(self),))
+
+
+class RouteSpec(dict):
+    """
+    A validated route spec, which can't be modified.
+
+    The host lists are shared HostPool tuples. Since nothing can change a
+    route spec after it was validated, it can be shared between threads and
+    doesn't need to be copied. To change a route spec, create a new one from
+    a (mutable) copy: dict(route_spec).
+
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Route spec can't be modified")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (RouteSpec, (dict(self),))
+
+
+# Route specs are pushed frequently, but mostly only a few entries change from
+# one version to the next. Therefore, we remember the CIDRs and host lists
+# that passed validation before, as well as the distinct host pools. Each
+# cache is cleared when it grows beyond its maximum size.
+_VALIDATION_CACHE_SIZE = 100000
+_VALID_CIDRS           = set()
+_VALID_HOST_LISTS      = {}
+_HOST_POOLS            = {}
+
+
+def get_host_pool(hosts):
+    """
+    Return the shared HostPool for a list of validated hosts.
+
+    The IP address strings are interned, duplicates are removed.
+
+    """
+    # Validated addresses are plain ASCII, so they can be interned as str.
+    key  = tuple(sorted(set(intern(str(ip)) for ip in hosts)))
+    pool = _HOST_POOLS.get(key)
+    if pool is None:
+        if len(_HOST_POOLS) >= _VALIDATION_CACHE_SIZE:
+            _HOST_POOLS.clear()
+        pool = _HOST_POOLS[key] = HostPool(key)
+    return pool
+
+
+def parse_route_spec_entry(cidr, hosts):
+    """
+    Sanity check a single entry of the route spec: A CIDR and the list of
+    hosts for it.
+
+    Returns the validated hosts as a shared HostPool, sorted and with
+    duplicates removed. The input is not modified.
+
+    Raises ValueError exception in case of problems.
+
+    """
+    try:
+        if not isinstance(cidr, basestring) or cidr not in _VALID_CIDRS:
+            utils.ipv4_cidr_to_int(cidr)
+            if len(_VALID_CIDRS) >= _VALIDATION_CACHE_SIZE:
+                _VALID_CIDRS.clear()
+            _VALID_CIDRS.add(cidr)
+
+        if type(hosts) not in [list, tuple]:
+            raise ValueError("Expect list of IPs as values in dict")
+        try:
+            key         = tuple(hosts)
+            valid_hosts = _VALID_HOST_LISTS.get(key)
+        except TypeError:
+            # Something unhashable in the list, will fail the checks below
+            key = valid_hosts = None
+
+        if valid_hosts is None:
+            for ip in hosts:
+                utils.ipv4_to_int(ip)
+            valid_hosts = get_host_pool(hosts)
+            if len(_VALID_HOST_LISTS) >= _VALIDATION_CACHE_SIZE:
+                _VALID_HOST_LISTS.clear()
+            _VALID_HOST_LISTS[key] = valid_hosts
+
+    except ArgsError as e:
+        raise ValueError(e.message)
+
+    return valid_hosts
+
+
 def parse_route_spec_config(data):
     """
     Parse and sanity check the route spec config.
@@ -149,8 +272,9 @@ def parse_route_spec_config(data):
         "<CIDR-3>" : [ "host-6-ip", "host-7-ip", "host-8-ip", "host-9-ip" ]
     }
 
-    Returns the validated route config. This validation is performed on any
-    route-spec pushed out by the config watcher plugin.
+    Returns the validated route config as a new RouteSpec, the input is not
+    modified. This validation is performed on any route-spec pushed out by
+    the config watcher plugin.
 
     Duplicate hosts in the host lists are removed.
 
@@ -158,20 +282,98 @@ def parse_route_spec_config(data):
 
     """
     # Sanity checking on the data object
+    if type(data) is RouteSpec:
+        # Already validated
+        return data
     if type(data) is not dict:
         raise ValueError("Expected dictionary at top level")
-    try:
-        for k, v in data.items():
-            utils.ip_check(k, netmask_expected=True)
-            if type(v) is not list:
-                raise ValueError("Expect list of IPs as values in dict")
-            hosts = set(v)   # remove duplicates
-            for ip in hosts:
-                utils.ip_check(ip)
-            clean_host_list = sorted(list(hosts))
-            data[k] = clean_host_list
 
-    except ArgsError as e:
-        raise ValueError(e.message)
+    return RouteSpec((k, parse_route_spec_entry(k, v))
+                     for k, v in data.items())
+
+
+def parse_route_spec_lines(lines):
+    """
+    Parse and sanity check a route spec in JSON Lines format.
+
+    Each line is a JSON dictionary with one (or a few) entries of the route
+    spec:
+
+    { "<CIDR-1>" : [ "host-1-ip", "host-2-ip", "host-3-ip" ] }
+    { "<CIDR-2>" : [ "host-4-ip", "host-5-ip" ] }
+
+    Empty lines and lines starting with '#' are ignored. The lines can be
+    any iterable (an open file, for example), so that very large route specs
+    can be parsed and validated line by line, without holding the entire text
+    in memory.
+
+    Returns the validated route config as a RouteSpec.
 
-    return data
+    Raises ValueError exception in case of problems, with the line number of
+    the offending line.
+
+    """
+    data = {}
+    for line_num, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            entries = json.loads(line)
+            if type(entries) is not dict:
+                raise ValueError("Expected dictionary")
+            for k, v in entries.items():
+                if k in data:
+                    raise ValueError("Duplicate CIDR '%s'" % k)
+                data[k] = parse_route_spec_entry(k, v)
+        except ValueError as e:
+            raise ValueError("Line %d: %s" % (line_num, str(e)))
+
+    return RouteSpec(data)
+
+
+def find_overlapping_cidrs(route_spec):
+    """
+    Find CIDRs in a validated route spec, which overlap with other CIDRs.
+
+    Two CIDRs either don't overlap at all, or one contains the other (or they
+    are the same network, written differently). Each CIDR is turned into an
+    integer interval of addresses. Sorted by start address (and larger
+    networks first), every CIDR that overlaps with a previous one falls into
+    the interval of the innermost enclosing CIDR, which is on top of a stack
+    of the intervals that are still open. This takes O(n log n) for sorting,
+    without comparing all pairs of CIDRs.
+
+    Returns a list of dicts, one for each CIDR that overlaps with an
+    enclosing one, sorted by CIDR.
+
+    """
+    intervals = []
+    for cidr in route_spec:
+        try:
+            addr, prefix = utils.ipv4_cidr_to_int(cidr)
+        except ArgsError:
+            # Not validated by the plugin, vpc-router will complain about
+            # it when processing the routes.
+            continue
+        intervals.append((addr, addr + (1 << (32 - prefix)) - 1, cidr))
+    intervals.sort(key=lambda i: (i[0], -i[1], i[2]))
+
+    overlaps = []
+    stack    = []   # Enclosing intervals, innermost on top
+    for start, end, cidr in intervals:
+        while stack and stack[-1][1] < start:
+            stack.pop()
+        if stack:
+            outer_start, outer_end, outer_cidr = stack[-1]
+            same_hosts = sorted(route_spec[cidr]) == \
+                                            sorted(route_spec[outer_cidr])
+            overlaps.append({
+                "cidr"          : cidr,
+                "overlaps_with" : outer_cidr,
+                "same_network"  : (outer_start, outer_end) == (start, end),
+                "same_hosts"    : same_hosts
+            })
+        stack.append((start, end, cidr))
+
+    return sorted(overlaps, key=lambda o: o['cidr'])
@@ -0,0 +1,258 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# A lightweight watcher for changes to a single file.
+#
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+
+
+# Events of the inotify API (see inotify(7)), which we are interested in.
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_IGNORED     = 0x00008000
+
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+_WATCH_MASK    = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | \
+                 IN_MOVE_SELF | IN_DELETE_SELF
+
+# While the file doesn't exist, we watch its directory for the file to appear.
+_DIR_MASK      = IN_CREATE | IN_MOVED_TO
+
+# After these events, the watch may not refer to the file at the path anymore
+# (it was deleted, renamed or replaced), so the watch is set up again.
+_REWATCH_MASK  = IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF | IN_IGNORED
+
+_EVENT_HEADER  = struct.Struct("iIII")
+
+
+def _load_inotify():
+    """
+    Return the C library with the inotify functions, or None if inotify is
+    not available on this system.
+
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        for func in ["inotify_init1", "inotify_add_watch",
+                     "inotify_rm_watch"]:
+            getattr(libc, func)
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def stat_signature(path):
+    """
+    Return a tuple of device, inode, size and modification time of a file,
+    which changes whenever the file is modified or replaced. Returns None if
+    the file doesn't exist.
+
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+class FileWatcher(threading.Thread):
+    """
+    A thread, which watches a single file and calls a callback function
+    whenever the file was changed or replaced (for example by renaming a new
+    file into place).
+
+    Where available, inotify is used to watch just the file itself, so that
+    we are not woken up by changes to other files in the same directory. Only
+    while the file doesn't exist, its directory is watched for it to appear.
+    In addition, the file's stat signature (inode, size, modification time)
+    is checked every 'poll_interval' seconds. This is the only mechanism if
+    inotify is not available, and catches changes on file systems on which
+    inotify events don't fire (network file systems, for example).
+
+    The callback is not called for a deleted file, only once the file exists
+    again.
+
+    """
+    def __init__(self, path, callback, poll_interval=5, use_inotify=True):
+        super(FileWatcher, self).__init__()
+        self.daemon         = True
+        self.path           = os.path.abspath(path)
+        self._dir, self._name = os.path.split(self.path)
+        self.callback       = callback
+        self.poll_interval  = poll_interval
+        self._signature     = stat_signature(self.path)
+        self._stop_event    = threading.Event()
+        self._lock          = threading.Lock()
+        self._closed        = False
+        self._wake_r, self._wake_w = os.pipe()
+
+        self._libc          = _load_inotify() if use_inotify else None
+        self._inotify_fd    = None
+        self._wd            = None
+        self._dir_wd        = None
+        if self._libc:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                logging.warning("File watcher: Cannot use inotify (%s), "
+                                "polling file for changes" %
+                                os.strerror(ctypes.get_errno()))
+            else:
+                self._inotify_fd = fd
+
+    @property
+    def uses_inotify(self):
+        return self._inotify_fd is not None
+
+    def _add_watch(self):
+        """
+        Set up the inotify watch for the file, if it exists. Otherwise, watch
+        the directory for the file to be created.
+
+        """
+        wd = self._libc.inotify_add_watch(self._inotify_fd, self.path,
+                                          _WATCH_MASK)
+        if wd >= 0:
+            self._wd = wd
+            self._remove_dir_watch()
+        elif self._dir_wd is None:
+            wd = self._libc.inotify_add_watch(self._inotify_fd, self._dir,
+                                              _DIR_MASK)
+            self._dir_wd = wd if wd >= 0 else None
+
+    def _remove_watch(self):
+        if self._wd is not None:
+            # The watch may already be gone, in which case this fails
+            # harmlessly.
+            self._libc.inotify_rm_watch(self._inotify_fd, self._wd)
+            self._wd = None
+
+    def _remove_dir_watch(self):
+        if self._dir_wd is not None:
+            self._libc.inotify_rm_watch(self._inotify_fd, self._dir_wd)
+            self._dir_wd = None
+
+    def _read_events(self):
+        """
+        Read all pending inotify events.
+
+        Returns True if there were any events for the file.
+
+        """
+        got_events = False
+        while True:
+            try:
+                buf = os.read(self._inotify_fd, 4096)
+            except OSError as e:
+                if e.errno in [errno.EAGAIN, errno.EINTR]:
+                    break
+                raise
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(buf):
+                wd, mask, cookie, name_len = \
+                            _EVENT_HEADER.unpack_from(buf, offset)
+                name    = buf[offset + _EVENT_HEADER.size:
+                              offset + _EVENT_HEADER.size + name_len]
+                offset += _EVENT_HEADER.size + name_len
+                if wd == self._dir_wd and self._dir_wd is not None:
+                    if name.rstrip("\0") == self._name:
+                        # The file appeared, watch the file itself again
+                        got_events = True
+                        self._remove_dir_watch()
+                    continue
+                if wd != self._wd:
+                    # Left over from a previous watch
+                    continue
+                got_events = True
+                if mask & _REWATCH_MASK:
+                    if not mask & IN_IGNORED:
+                        self._remove_watch()
+                    self._wd = None
+        return got_events
+
+    def _wait(self):
+        """
+        Wait until there are inotify events for the file or the poll interval
+        has passed.
+
+        Returns True if there were inotify events for the file.
+
+        """
+        fds = [self._wake_r]
+        if self._inotify_fd is not None:
+            if self._wd is None:
+                self._add_watch()
+            fds.append(self._inotify_fd)
+        try:
+            ready, _, _ = select.select(fds, [], [], self.poll_interval)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        if self._inotify_fd in ready:
+            return self._read_events()
+        return False
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                had_events = self._wait()
+                if self._stop_event.is_set():
+                    break
+                signature = stat_signature(self.path)
+                if signature is None:
+                    # The file was deleted, maybe it will be back soon.
+                    self._signature = None
+                    continue
+                if had_events or signature != self._signature:
+                    self._signature = signature
+                    self.callback()
+        finally:
+            with self._lock:
+                if self._inotify_fd is not None:
+                    os.close(self._inotify_fd)
+                    self._inotify_fd = None
+                os.close(self._wake_r)
+                os.close(self._wake_w)
+                self._closed = True
+
+    def stop(self):
+        """
+        Tell the watcher thread to stop.
+
+        """
+        with self._lock:
+            self._stop_event.set()
+            if not self._closed:
+                # Wake up the thread, if it's waiting
+                os.write(self._wake_w, "x")
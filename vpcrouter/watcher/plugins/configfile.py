@@ -20,52 +20,177 @@ limitations under the License.
 #
 
 import datetime
+import hashlib
 import json
 import logging
 import os
-
-import watchdog.events
-import watchdog.observers
+import threading
 
 from vpcrouter.errors  import ArgsError
+from vpcrouter.watcher import binspec
 from vpcrouter.watcher import common
+from vpcrouter.watcher import filewatch
+
+
+# Seconds between checks of the route spec file's stat signature
+FILE_POLL_INTERVAL_DEFAULT = 5
+
+# Route spec files with these extensions are in JSON Lines format
+JSON_LINES_EXTENSIONS = [".jsonl", ".ndjson"]
 
 
-class RouteSpecChangeEventHandler(watchdog.events.FileSystemEventHandler):
+class RouteSpecChangeEventHandler(object):
     """
-    Our own event handler class, to be used to process events on the route-spec
-    file.
+    Our own event handler class, to be used to process change events of the
+    route-spec file.
+
+    Editors and config management tools often cause several events when they
+    save a file, or write a new file and then rename it into place. We wait
+    until no more events arrived for the debounce time before we read the
+    file. A new route spec is only sent out if the content of the file has
+    changed since the last route spec we sent.
 
     """
-    def __init__(self, *args, **kwargs):
-        self._route_spec_fname   = kwargs['route_spec_fname']
-        self._route_spec_abspath = kwargs['route_spec_abspath']
-        self._q_route_spec       = kwargs['q_route_spec']
-        self._plugin             = kwargs['plugin']
-
-        del kwargs['route_spec_fname']
-        del kwargs['route_spec_abspath']
-        del kwargs['q_route_spec']
-        del kwargs['plugin']
-
-        super(RouteSpecChangeEventHandler, self).__init__(*args, **kwargs)
-
-    def on_modified(self, event):
-        if type(event) is watchdog.events.FileModifiedEvent and \
-                                    event.src_path == self._route_spec_abspath:
-            logging.info("Detected file change event for %s" %
-                          self._route_spec_abspath)
-            try:
-                route_spec = read_route_spec_config(self._route_spec_fname)
-                self._q_route_spec.put(route_spec)
-                if self._plugin:
-                    self._plugin.last_route_spec_update = \
-                                            datetime.datetime.now()
-            except ValueError as e:
-                # In case of error in the config file, we don't send out a
-                # message with a broken or empty list. Probably just temporary,
-                # shouldn't stop operation of the system.
-                logging.warning("Cannot parse route spec: %s" % str(e))
+    # Seconds without new events before we read the file
+    DEBOUNCE_TIME = 0.5
+
+    def __init__(self, route_spec_fname, route_spec_abspath, q_route_spec,
+                 plugin, debounce_time=None):
+        self._route_spec_fname   = route_spec_fname
+        self._route_spec_abspath = route_spec_abspath
+        self._q_route_spec       = q_route_spec
+        self._plugin             = plugin
+        self._debounce_time      = debounce_time \
+                                        if debounce_time is not None \
+                                        else self.DEBOUNCE_TIME
+        self._content_hash       = None   # Hash of the last sent route spec
+        self._timer              = None
+        self._lock               = threading.Lock()
+
+    def file_changed(self):
+        """
+        (Re)start the debounce timer after a change of the file was detected.
+
+        """
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer        = threading.Timer(self._debounce_time,
+                                                 self._process_change)
+            self._timer.name   = "ConfMonDebounce"
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _process_change(self):
+        logging.info("Detected file change event for %s" %
+                     self._route_spec_abspath)
+        self.load_route_spec()
+
+    def cancel(self):
+        """
+        Cancel a pending read of the file.
+
+        """
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+    def load_route_spec(self):
+        """
+        Read the route spec file and send out the route spec, if its content
+        has changed.
+
+        In case of error in the config file, we don't send out a message with
+        a broken or empty list. Probably just temporary, shouldn't stop
+        operation of the system.
+
+        """
+        try:
+            # The file is read just once: The content we parse is the content
+            # we remember the hash of, even if the file is written meanwhile.
+            route_spec, content_hash = _load_route_spec_file(
+                                                self._route_spec_fname,
+                                                self._content_hash)
+        except ValueError as e:
+            logging.error("Config ignored: %s" % str(e))
+            return
+
+        if content_hash == self._content_hash:
+            logging.debug("Route spec file content unchanged, ignoring it")
+            return
+
+        self._content_hash = content_hash
+        self._q_route_spec.put(route_spec, content_hash=content_hash)
+        if self._plugin:
+            self._plugin.last_route_spec_update = datetime.datetime.now()
+
+
+def _is_json_lines(fname):
+    """
+    Return True if the route spec file is in JSON Lines format, which is
+    indicated by its extension.
+
+    """
+    return os.path.splitext(fname)[1].lower() in JSON_LINES_EXTENSIONS
+
+
+def _hashed_lines(f, content_hash):
+    """
+    Yield the lines of the open file, updating the running hash with each line
+    before it is handed out.
+
+    """
+    for line in f:
+        content_hash.update(line)
+        yield line
+
+
+def _load_route_spec_file(fname, last_hash=None):
+    """
+    Read, parse and sanity check the route spec file, which is read only once.
+
+    Files in JSON Lines format are parsed and validated line by line while
+    they are read, so that the entire text is never held in memory. Files in
+    the binary format (see binspec) are recognized by their magic bytes,
+    regardless of their extension, and are memory mapped.
+
+    Returns a tuple with the route spec and the SHA1 hash of the content it
+    was parsed from. If the content can be hashed before it's parsed and the
+    hash is the last_hash, the file isn't parsed again and None is returned
+    as route spec.
+
+    Raises ValueError in case of problems.
+
+    """
+    try:
+        with open(fname, "rb") as f:
+            if binspec.is_binary_spec(f):
+                # The hash is computed over the very buffer that is parsed
+                buf = binspec.map_binary_spec(f)
+                try:
+                    content_hash = hashlib.sha1(buf).hexdigest()
+                    if content_hash == last_hash:
+                        return None, content_hash
+                    return binspec.parse_binary_spec(buf), content_hash
+                finally:
+                    buf.close()
+
+            if _is_json_lines(fname):
+                content_hash = hashlib.sha1()
+                route_spec   = common.parse_route_spec_lines(
+                                            _hashed_lines(f, content_hash))
+                return route_spec, content_hash.hexdigest()
+
+            content      = f.read()
+            content_hash = hashlib.sha1(content).hexdigest()
+            if content_hash == last_hash:
+                return None, content_hash
+            return (common.parse_route_spec_config(json.loads(content)),
+                    content_hash)
+    except EnvironmentError as e:
+        # Cannot open file? Doesn't exist? Also covers mmap.error.
+        raise ValueError("Cannot open file: " + str(e))
 
 
 def read_route_spec_config(fname):
@@ -80,19 +205,15 @@ def read_route_spec_config(fname):
         "<CIDR-3>" : [ "host-6-ip", "host-7-ip", "host-8-ip", "host-9-ip" ]
     }
 
+    Files with a '.jsonl' or '.ndjson' extension are in JSON Lines format
+    instead (see common.parse_route_spec_lines()). Binary route spec files
+    (see binspec) are detected by their content.
+
     Returns the validated route config.
 
     """
     try:
-        try:
-            f = open(fname, "r")
-        except IOError as e:
-            # Cannot open file? Doesn't exist?
-            raise ValueError("Cannot open file: " + str(e))
-        data = json.loads(f.read())
-        f.close()
-        # Sanity checking on the data object
-        data = common.parse_route_spec_config(data)
+        data, _ = _load_route_spec_file(fname)
 
     except ValueError as e:
         logging.error("Config ignored: %s" % str(e))
@@ -106,11 +227,14 @@ class Configfile(common.WatcherPlugin):
     Implements the WatcherPlugin interface for the 'configfile' plugin.
 
     Establishes a watcher thread, which detectes any changes to the config
-    file and re-reads it.
+    file and re-reads it. Only the file itself is watched, not its entire
+    directory.
 
-    The plugin adds a command line argument to vpc-router:
+    The plugin adds command line arguments to vpc-router:
 
     -f / --file: The name of the config file, which should be monitored.
+    --file_poll_interval: Seconds between checks of the config file (in
+                          addition to inotify events, where available).
 
     """
     def __init__(self, *args, **kwargs):
@@ -126,42 +250,38 @@ class Configfile(common.WatcherPlugin):
         logging.info("Configfile watcher plugin: Starting to watch route spec "
                      "file '%s' for changes..." % fname)
 
-        # Initial content of file needs to be processed at least once, before
-        # we start watching for any changes to it. Therefore, we will write it
-        # out on the queue right away.
-        route_spec = {}
-        try:
-            route_spec = read_route_spec_config(fname)
-            if route_spec:
-                self.last_route_spec_update = datetime.datetime.now()
-                self.q_route_spec.put(route_spec)
-        except ValueError as e:
-            logging.warning("Cannot parse route spec: %s" % str(e))
-
-        # Now prepare to watch for any changes in that file.  Find the parent
-        # directory of the config file, since this is where we will attach a
-        # watcher to.
-        abspath    = os.path.abspath(fname)
-        parent_dir = os.path.dirname(abspath)
+        abspath = os.path.abspath(fname)
 
-        # Create the file watcher and run in endless loop
-        handler = RouteSpecChangeEventHandler(
+        # Create the file watcher, which runs in its own thread. It's created
+        # before the file is read for the first time, so that no change to
+        # the file is missed.
+        self.handler = RouteSpecChangeEventHandler(
                                     route_spec_fname   = fname,
                                     route_spec_abspath = abspath,
                                     q_route_spec       = self.q_route_spec,
                                     plugin             = self)
-        self.observer_thread = watchdog.observers.Observer()
-        self.observer_thread.name = "ConfMon"
-        self.observer_thread.schedule(handler, parent_dir)
-        self.observer_thread.start()
+        self.file_watcher = filewatch.FileWatcher(
+                        abspath, self.handler.file_changed,
+                        poll_interval=self.conf.get(
+                                            'file_poll_interval',
+                                            FILE_POLL_INTERVAL_DEFAULT))
+        self.file_watcher.name = "ConfMon"
+
+        # Initial content of file needs to be processed at least once, before
+        # we start watching for any changes to it. Therefore, we will write it
+        # out on the queue right away.
+        self.handler.load_route_spec()
+
+        self.file_watcher.start()
 
     def stop(self):
         """
         Stop the config change monitoring thread.
 
         """
-        self.observer_thread.stop()
-        self.observer_thread.join()
+        self.file_watcher.stop()
+        self.file_watcher.join()
+        self.handler.cancel()
         logging.info("Configfile watcher plugin: Stopped")
 
     def get_info(self):
@@ -173,9 +293,13 @@ class Configfile(common.WatcherPlugin):
             self.get_plugin_name() : {
                 "version" : self.get_version(),
                 "params" : {
-                    "file" : self.conf['file']
+                    "file"               : self.conf['file'],
+                    "file_poll_interval" : self.file_watcher.poll_interval
                 },
                 "stats" : {
+                    "watch_mode" :
+                        "inotify" if self.file_watcher.uses_inotify
+                        else "polling",
                     "last_route_spec_update" :
                         self.last_route_spec_update.isoformat()
                         if self.last_route_spec_update else "(no update, yet)"
@@ -192,7 +316,15 @@ class Configfile(common.WatcherPlugin):
         parser.add_argument('-f', '--file', dest='file', required=True,
                             help="config file for routing groups "
                                  "(only in configfile mode)")
-        return ["file"]
+        parser.add_argument('--file_poll_interval',
+                            dest='file_poll_interval',
+                            default=FILE_POLL_INTERVAL_DEFAULT, type=float,
+                            help="seconds between checks of the config "
+                                 "file for changes, in addition to inotify "
+                                 "events where available, default: %s "
+                                 "(only in configfile mode)" %
+                                 FILE_POLL_INTERVAL_DEFAULT)
+        return ["file", "file_poll_interval"]
 
     @classmethod
     def check_arguments(cls, conf):
@@ -207,3 +339,6 @@ class Configfile(common.WatcherPlugin):
         except IOError as e:
             raise ArgsError("Cannot open config file '%s': %s" %
                             (conf['file'], e))
+
+        if conf['file_poll_interval'] <= 0:
+            raise ArgsError("File poll interval must be greater than 0")
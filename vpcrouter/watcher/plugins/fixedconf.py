@@ -57,7 +57,7 @@ class Fixedconf(common.WatcherPlugin):
             # Probably don't really have to parse the route spec (sanity check)
             # one more time, since we already sanity checked the command line
             # options.
-            common.parse_route_spec_config(route_spec)
+            route_spec = common.parse_route_spec_config(route_spec)
             self.q_route_spec.put(route_spec)
         except Exception as e:
             logging.warning("Fixedconf watcher plugin: "
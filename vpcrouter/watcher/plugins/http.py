@@ -24,9 +24,14 @@ limitations under the License.
 import bottle
 import json
 import logging
+import threading
+import time
 
+from vpcrouter                  import utils
+from vpcrouter.errors           import ArgsError, PayloadTooLargeError
 from vpcrouter.watcher          import common
 from vpcrouter.currentstate     import CURRENT_STATE
+from vpcrouter.events           import EVENTS, EventType
 from vpcrouter.main.http_server import APP   # The bottle app of the vpc-router
 
 
@@ -35,17 +40,263 @@ from vpcrouter.main.http_server import APP   # The bottle app of the vpc-router
 # request handlers, so we made this one global.
 _Q_ROUTE_SPEC = None
 
+# Default for the maximum size of a posted route spec (after decompression)
+MAX_ROUTE_SPEC_SIZE_DEFAULT = 16 * 1024 * 1024
+_MAX_ROUTE_SPEC_SIZE        = MAX_ROUTE_SPEC_SIZE_DEFAULT
+
+# The last route spec we received and its version, which is incremented with
+# every new route spec (posted or patched). The lock serializes updates, so
+# that patches are applied to the latest spec and versions are queued in
+# order.
+_SPEC_LOCK    = threading.Lock()
+_SPEC_VERSION = 0
+_ROUTE_SPEC   = {}
+
+# Longest time (in seconds) a client may wait for a route spec to be applied
+MAX_WAIT_TIME = 300
+
+# Whether the versions of our route specs are the versions that are applied.
+# They are not if we are a sub-plugin of the multi plugin, which sends out
+# merged route specs under its own versions (a posted route spec may not even
+# change the merged route spec). Clients can't wait for a route spec to be
+# applied then, and don't get the X-Route-Spec-Version header.
+_VERSIONED    = True
+
+
+class PreconditionFailed(ValueError):
+    """
+    The expected version of a route spec patch didn't match.
+
+    """
+    pass
+
+
+def _push_route_spec(new_route_spec):
+    """
+    Record a new route spec under a new version and send it to the watcher.
+
+    The version is the generation of the message on the route spec queue.
+
+    Needs to be called with the spec lock held. Returns the new version.
+
+    """
+    global _SPEC_VERSION, _ROUTE_SPEC
+    _SPEC_VERSION = _Q_ROUTE_SPEC.put(new_route_spec)
+    _ROUTE_SPEC   = new_route_spec
+    if _VERSIONED:
+        bottle.response.set_header("X-Route-Spec-Version",
+                                   str(_SPEC_VERSION))
+    return _SPEC_VERSION
+
+
+def _apply_patch_op(route_spec, op):
+    """
+    Apply a single patch operation to a route spec (in place).
+
+    Operations have this format:
+
+        {"op" : "add" | "remove" | "replace",
+         "cidr" : "<CIDR>", "hosts" : [ "host-1-ip", ... ]}
+
+    'add' adds the hosts to the CIDR (the CIDR is added if it's not in the
+    route spec), 'remove' removes the hosts from the CIDR (or the entire CIDR
+    if no hosts are specified) and 'replace' sets the hosts of the CIDR.
+
+    Only the changed entry is validated. Raises ValueError in case of problems.
+
+    """
+    if type(op) is not dict or "cidr" not in op:
+        raise ValueError("Expected dictionary with 'op' and 'cidr' for patch "
+                         "operation")
+    kind  = op.get("op")
+    cidr  = op["cidr"]
+    hosts = op.get("hosts")
+
+    if kind == "remove":
+        if cidr not in route_spec:
+            raise ValueError("CIDR '%s' not in route spec" % cidr)
+        if hosts is None:
+            del route_spec[cidr]
+        else:
+            hosts = common.parse_route_spec_entry(cidr, hosts)
+            route_spec[cidr] = common.parse_route_spec_entry(
+                        cidr, [h for h in route_spec[cidr]
+                               if h not in hosts.ip_set])
+
+    elif kind == "add":
+        hosts = common.parse_route_spec_entry(cidr, hosts)
+        route_spec[cidr] = common.parse_route_spec_entry(
+                                    cidr, route_spec.get(cidr, ()) + hosts)
+
+    elif kind == "replace":
+        route_spec[cidr] = common.parse_route_spec_entry(cidr, hosts)
+
+    else:
+        raise ValueError("Unknown patch operation '%s'" % kind)
+
+
+def _patch_route_spec(patch):
+    """
+    Apply a patch to the last received route spec and send out the result as
+    a new route spec version.
+
+    The patch has this format:
+
+        {"expected_version" : <version>,    # optional
+         "ops" : [ <operation>, ... ]}
+
+    If an expected version is given and it isn't the current version of the
+    route spec, PreconditionFailed is raised and nothing is changed.
+
+    Returns the new version and the new route spec.
+
+    """
+    if type(patch) is not dict or type(patch.get("ops")) is not list:
+        raise ValueError("Expected dictionary with list of 'ops' at top "
+                         "level")
+
+    with _SPEC_LOCK:
+        expected = patch.get("expected_version")
+        if expected is not None and expected != _SPEC_VERSION:
+            raise PreconditionFailed("Expected route spec version %s, but "
+                                     "current version is %d" %
+                                     (expected, _SPEC_VERSION))
+        # The host pools of the current spec are immutable and are replaced,
+        # never modified, so a shallow copy is sufficient.
+        new_route_spec = dict(_ROUTE_SPEC)
+        for op in patch['ops']:
+            _apply_patch_op(new_route_spec, op)
+        new_route_spec = common.RouteSpec(new_route_spec)
+        return _push_route_spec(new_route_spec), new_route_spec
+
+
+def _read_route_spec_body():
+    """
+    Read the body of a posted route spec.
+
+    Bodies with 'Content-Encoding: gzip' are decompressed while they are
+    read. The (decompressed) size of the body is limited.
+
+    """
+    encoding = bottle.request.get_header("Content-Encoding",
+                                         default="identity").strip().lower()
+    if encoding not in ["identity", "gzip"]:
+        raise ValueError("Unsupported content encoding '%s'" % encoding)
+
+    max_size = _MAX_ROUTE_SPEC_SIZE
+    if bottle.request.content_length > max_size and encoding == "identity":
+        raise PayloadTooLargeError("Data exceeds maximum size of %d bytes" %
+                                   max_size)
+
+    # Bottle spools large request bodies to a temporary file, so they are not
+    # held in memory before we read them.
+    return utils.read_stream(bottle.request.body, max_size,
+                             gzipped=(encoding == "gzip"))
+
+
+def _get_wait_time():
+    """
+    Return the number of seconds the client wants to wait for the route spec
+    to be applied (the 'wait' query parameter), or None.
+
+    """
+    wait = bottle.request.query.get("wait")
+    if wait is None:
+        return None
+    if not _VERSIONED:
+        raise ValueError("Cannot wait for the route spec to be applied when "
+                         "used with the multi watcher plugin")
+    try:
+        wait = float(wait)
+    except ValueError:
+        raise ValueError("Malformed wait time '%s'" % wait)
+    if not 0 <= wait <= MAX_WAIT_TIME:
+        raise ValueError("Wait time must be between 0 and %d seconds" %
+                         MAX_WAIT_TIME)
+    return wait
+
+
+def _route_results(route_spec):
+    """
+    Return the state of the routes for the CIDRs in the route spec, in all
+    route tables, as last published.
+
+    """
+    route_tables = CURRENT_STATE.get_state_repr("vpc").get('route_tables', {})
+    results = {}
+    for rt_id, routes in route_tables.items():
+        for dcidr, rec in routes.items():
+            if dcidr in route_spec:
+                results.setdefault(dcidr, {})[rt_id] = {
+                    "status"    : rec['status'],
+                    "reason"    : rec['reason'],
+                    "router_ip" : rec['router_ip'],
+                    "detail"    : rec['detail']
+                }
+    return results
+
+
+def _wait_for_spec_applied(version, route_spec, last_event_id, wait):
+    """
+    Wait for the route spec with the given version to be applied.
+
+    A later version being applied means that this version was superseded. We
+    only look at events after last_event_id, which was taken before the spec
+    was sent out.
+
+    Returns the response message. If the spec wasn't applied within the wait
+    time, the response status is 202.
+
+    """
+    deadline = time.time() + wait
+    while True:
+        remaining = deadline - time.time()
+        events    = EVENTS.get_since(last_event_id, timeout=remaining) \
+                                            if remaining > 0 else []
+        for e in events:
+            last_event_id = e['id']
+            data          = e['data']
+            if e['type'] == EventType.SPEC_APPLIED and \
+                                    data.get('version') >= version:
+                return {
+                    "version"         : version,
+                    "applied_version" : data['version'],
+                    "applied"         : data['applied'],
+                    "latency"         : data['latency'],
+                    "summary"         : data['summary'],
+                    "routes"          : _route_results(route_spec)
+                }
+        if remaining <= 0:
+            bottle.response.status = 202
+            return {"version" : version, "applied" : False,
+                    "msg" : "Route spec not applied yet"}
+
+
+def _respond(version, route_spec, last_event_id, wait, msg):
+    """
+    Return the response message for a new route spec version: Either the
+    given message, or the result of waiting for the spec to be applied.
+
+    """
+    bottle.response.status = 200
+    if wait is None:
+        return msg
+    return json.dumps(_wait_for_spec_applied(version, route_spec,
+                                             last_event_id, wait))
+
 
 # The http plugin is only imported on demand. Since there is only one Bottle
 # app in the entire system, we can just add to the app when we are imported.
 
 @APP.route('/route_spec', method='GET')
 @APP.route('/route_spec', method='POST')
+@APP.route('/route_spec', method='PATCH')
 def handle_route_spec_request():
     """
     Process request for route spec.
 
-    Either a new one is posted or the current one is to be retrieved.
+    Either a new one is posted, the current one is patched or the current one
+    is to be retrieved.
 
     """
     try:
@@ -58,15 +309,36 @@ def handle_route_spec_request():
             else:
                 bottle.response.status = 200
                 msg = json.dumps(data)
+        elif bottle.request.method == 'PATCH':
+            # Changes to the current route spec are sent
+            wait          = _get_wait_time()
+            patch         = json.loads(_read_route_spec_body())
+            last_event_id = EVENTS.last_id()
+            version, new_route_spec = _patch_route_spec(patch)
+            logging.info("Route spec patched (version %d)" % version)
+            msg = _respond(version, new_route_spec, last_event_id, wait,
+                           json.dumps({"version" : version}))
         else:
             # A new route spec is posted
-            raw_data = bottle.request.body.read()
-            new_route_spec = json.loads(raw_data)
+            wait = _get_wait_time()
+            raw_data = _read_route_spec_body()
             logging.info("New route spec posted")
-            common.parse_route_spec_config(new_route_spec)
-            _Q_ROUTE_SPEC.put(new_route_spec)
-            bottle.response.status = 200
-            msg = "Ok"
+            new_route_spec = common.parse_route_spec_config(
+                                                    json.loads(raw_data))
+            last_event_id = EVENTS.last_id()
+            with _SPEC_LOCK:
+                version = _push_route_spec(new_route_spec)
+            msg = _respond(version, new_route_spec, last_event_id, wait, "Ok")
+
+    except PayloadTooLargeError as e:
+        logging.error("Config ignored: %s" % str(e))
+        bottle.response.status = 413
+        msg = "Config ignored: %s" % str(e)
+
+    except PreconditionFailed as e:
+        logging.error("Config ignored: %s" % str(e))
+        bottle.response.status = 412
+        msg = "Config ignored: %s" % str(e)
 
     except ValueError as e:
         logging.error("Config ignored: %s" % str(e))
@@ -95,10 +367,18 @@ class Http(common.WatcherPlugin):
         Start the HTTP change monitoring thread.
 
         """
-        # Store reference to message queue in module global variable, so that
-        # our Bottle app handler functions have easy access to it.
-        global _Q_ROUTE_SPEC
-        _Q_ROUTE_SPEC = self.q_route_spec
+        # Store reference to message queue and the size limit in module global
+        # variables, so that our Bottle app handler functions have easy access
+        # to them.
+        global _Q_ROUTE_SPEC, _MAX_ROUTE_SPEC_SIZE, _SPEC_VERSION, \
+               _ROUTE_SPEC, _VERSIONED
+        _Q_ROUTE_SPEC        = self.q_route_spec
+        _VERSIONED           = not self.is_sub_plugin
+        _MAX_ROUTE_SPEC_SIZE = self.conf.get('http_max_route_spec_size',
+                                             MAX_ROUTE_SPEC_SIZE_DEFAULT)
+        with _SPEC_LOCK:
+            _SPEC_VERSION = 0
+            _ROUTE_SPEC   = {}
 
         logging.info("Http watcher plugin: "
                      "Starting to watch for route spec on "
@@ -121,6 +401,38 @@ class Http(common.WatcherPlugin):
             self.get_plugin_name() : {
                 "version" : self.get_version(),
                 "params" : {
+                    "http_max_route_spec_size" :
+                        self.conf.get('http_max_route_spec_size',
+                                      MAX_ROUTE_SPEC_SIZE_DEFAULT)
+                },
+                "stats" : {
+                    "route_spec_version" : _SPEC_VERSION
                 }
             }
         }
+
+    @classmethod
+    def add_arguments(cls, parser, sys_arg_list=None):
+        """
+        Arguments for the http plugin.
+
+        """
+        parser.add_argument('--http_max_route_spec_size',
+                            dest='http_max_route_spec_size',
+                            required=False,
+                            default=MAX_ROUTE_SPEC_SIZE_DEFAULT, type=int,
+                            help="maximum size in bytes of a posted route "
+                                 "spec, after decompression, default %d "
+                                 "(only for 'http' watcher plugin)" %
+                                 MAX_ROUTE_SPEC_SIZE_DEFAULT)
+        return ["http_max_route_spec_size"]
+
+    @classmethod
+    def check_arguments(cls, conf):
+        """
+        Sanity check plugin options values.
+
+        """
+        if conf['http_max_route_spec_size'] < 1:
+            raise ArgsError("Maximum route spec size must be at least 1 "
+                            "byte")
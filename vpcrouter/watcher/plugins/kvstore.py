@@ -0,0 +1,480 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# A watcher plugin, which watches the route spec entries in a key-value store.
+#
+
+import collections
+import datetime
+import httplib
+import json
+import logging
+import socket
+import threading
+import urllib
+import urlparse
+
+from vpcrouter.errors  import ArgsError, KVStoreError, KVIndexExpiredError
+from vpcrouter.watcher import common
+
+
+KV_PREFIX_DEFAULT         = "/vpcrouter/route_spec"
+
+# Seconds a watch request blocks before it is issued again
+KV_WATCH_TIMEOUT_DEFAULT  = 60
+
+# Seconds to wait before we try again after an error
+KV_RETRY_INTERVAL_DEFAULT = 5
+
+
+# A change of a key in the store. The key is relative to the watched prefix.
+# The value is None if the key (or a directory of keys) was deleted.
+KVChange = collections.namedtuple("KVChange",
+                                  ["key", "value", "index", "is_dir"])
+
+
+class KVClient(object):
+    """
+    The interface to a key-value store, which the plugin uses.
+
+    Each change in the store has an index, which increases with every change.
+    A watch returns the changes after a given index, so that a client can
+    resume watching where it left off, without having to read all the keys
+    again.
+
+    """
+    def list(self, prefix):
+        """
+        Return the current index of the store and a dictionary with all the
+        keys (relative to the prefix) and their values.
+
+        Raises KVStoreError in case of problems.
+
+        """
+        raise NotImplementedError()
+
+    def watch(self, prefix, index, timeout):
+        """
+        Wait for up to 'timeout' seconds for changes of keys under the prefix
+        after 'index'.
+
+        Returns a (possibly empty) list of KVChange tuples and the index to
+        resume watching from.
+
+        Raises KVIndexExpiredError if the store doesn't remember the changes
+        since 'index' anymore and KVStoreError in case of other problems.
+
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        Close the connection to the store. Interrupts a watch, which is
+        waiting in a different thread.
+
+        """
+        pass
+
+
+class EtcdV2Client(KVClient):
+    """
+    A client for the etcd v2 API.
+
+    The keys are read with a recursive GET, changes are received with
+    'wait=true' requests (long polling), which return one change at a time.
+    The connection is kept open between requests.
+
+    """
+    # The etcd error code for "the requested index is outdated and cleared"
+    EVENT_INDEX_CLEARED = 401
+
+    # The etcd error code for "key not found"
+    KEY_NOT_FOUND       = 100
+
+    DELETE_ACTIONS      = ["delete", "expire", "compareAndDelete"]
+
+    def __init__(self, url, timeout=10):
+        parts         = urlparse.urlsplit(url)
+        self._scheme  = parts.scheme
+        self._netloc  = parts.netloc
+        self._timeout = timeout
+        self._conn    = None
+        self._lock    = threading.Lock()
+
+    def _request(self, path, params, timeout):
+        """
+        Send a GET request for a key and return HTTP status, etcd index and
+        the decoded JSON response.
+
+        Raises socket.timeout if there was no response within the timeout.
+
+        """
+        with self._lock:
+            if self._conn is None:
+                conn_class = httplib.HTTPSConnection \
+                                if self._scheme == "https" \
+                                else httplib.HTTPConnection
+                self._conn = conn_class(self._netloc)
+            conn = self._conn
+        try:
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            conn.request("GET", "/v2/keys%s?%s" %
+                         (urllib.quote(path), urllib.urlencode(params)))
+            resp = conn.getresponse()
+            body = resp.read()
+            if resp.will_close:
+                self.close()
+            index = resp.getheader("X-Etcd-Index")
+            return resp.status, int(index) if index else None, \
+                json.loads(body) if body else {}
+        except (httplib.HTTPException, socket.error, ValueError) as e:
+            self.close()
+            if isinstance(e, socket.timeout):
+                raise
+            raise KVStoreError("etcd request failed: %s" %
+                               (str(e) or type(e).__name__))
+
+    def _relative_key(self, prefix, key):
+        return key[len(prefix):].lstrip("/")
+
+    def list(self, prefix):
+        try:
+            status, index, data = self._request(prefix,
+                                                {"recursive" : "true"},
+                                                self._timeout)
+        except socket.timeout:
+            raise KVStoreError("etcd list failed: Timeout")
+        if status == 404 and data.get("errorCode") == self.KEY_NOT_FOUND:
+            # No keys, yet
+            return data.get("index", index), {}
+        if status != 200:
+            raise KVStoreError("etcd list failed: %s" %
+                               data.get("message", "HTTP status %d" % status))
+
+        keys  = {}
+        nodes = [data['node']]
+        while nodes:
+            node = nodes.pop()
+            if node.get("dir"):
+                nodes.extend(node.get("nodes", []))
+            else:
+                keys[self._relative_key(prefix, node['key'])] = node['value']
+        return index, keys
+
+    def watch(self, prefix, index, timeout):
+        try:
+            status, _, data = self._request(prefix,
+                                            {"wait"      : "true",
+                                             "recursive" : "true",
+                                             "waitIndex" : index + 1},
+                                            timeout)
+        except socket.timeout:
+            # Nothing happened while we were waiting
+            return [], index
+        if data.get("errorCode") == self.EVENT_INDEX_CLEARED:
+            raise KVIndexExpiredError(data.get("message",
+                                               "Event index cleared"))
+        if status != 200:
+            raise KVStoreError("etcd watch failed: %s" %
+                               data.get("message", "HTTP status %d" % status))
+
+        node    = data['node']
+        deleted = data['action'] in self.DELETE_ACTIONS
+        change  = KVChange(key    = self._relative_key(prefix, node['key']),
+                           value  = None if deleted else node.get("value"),
+                           index  = node['modifiedIndex'],
+                           is_dir = bool(node.get("dir")))
+        if change.is_dir and not deleted:
+            # A new, empty directory doesn't change anything
+            return [], change.index
+        return [change], change.index
+
+    def close(self):
+        with self._lock:
+            conn, self._conn = self._conn, None
+        if conn is not None:
+            if conn.sock:
+                # Interrupt a watch, which may be waiting in another thread
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            conn.close()
+
+
+class KVRouteSpec(object):
+    """
+    Maintains the route spec from the entries in the key-value store.
+
+    Each key (relative to the watched prefix) is a CIDR, its value is a JSON
+    list of the host IPs for the CIDR. Changes are applied to the current
+    entries one key at a time: Only the changed entries are validated again.
+
+    An invalid entry is logged and ignored, the previous hosts for the CIDR
+    (if any) remain in effect.
+
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def _parse(self, key, value):
+        try:
+            return common.parse_route_spec_entry(key, json.loads(value))
+        except ValueError as e:
+            logging.error("Kvstore watcher plugin: Ignoring invalid entry "
+                          "'%s': %s" % (key, str(e)))
+            return None
+
+    def load(self, keys):
+        """
+        Replace all entries with the keys read from the store.
+
+        """
+        entries = {}
+        for key, value in keys.items():
+            hosts = self._parse(key, value)
+            if hosts is not None:
+                entries[key] = hosts
+        changed      = entries != self.entries
+        self.entries = entries
+        return changed
+
+    def apply(self, change):
+        """
+        Apply a single change of a key to the entries.
+
+        Returns True if the entries have changed.
+
+        """
+        if change.value is None:
+            if change.is_dir:
+                # The key is empty if the entire prefix was deleted
+                dir_prefix = change.key + "/" if change.key else ""
+                keys = [k for k in self.entries if k.startswith(dir_prefix)]
+            else:
+                keys = [change.key] if change.key in self.entries else []
+            for k in keys:
+                del self.entries[k]
+            return bool(keys)
+
+        hosts = self._parse(change.key, change.value)
+        if hosts is None or self.entries.get(change.key) is hosts:
+            return False
+        self.entries[change.key] = hosts
+        return True
+
+    def route_spec(self):
+        return common.RouteSpec(self.entries)
+
+
+class Kvstore(common.WatcherPlugin):
+    """
+    Implements the WatcherPlugin interface for the 'kvstore' plugin.
+
+    Reads all route spec entries under a key prefix once and then watches the
+    prefix for changes, which are applied incrementally. After connection
+    problems, the watch resumes after the last change we saw. Only if the
+    store doesn't remember that far back, all entries are read again.
+
+    The plugin adds command line arguments to vpc-router:
+
+    --kv_url:            The URL of the etcd server.
+    --kv_prefix:         The key prefix of the route spec entries.
+    --kv_watch_timeout:  Seconds after which a watch request is renewed.
+    --kv_retry_interval: Seconds to wait after errors.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super(Kvstore, self).__init__(*args, **kwargs)
+        self.client = None
+        self.last_route_spec_update = None
+        self.stats  = {
+            "changes"     : 0,
+            "updates"     : 0,
+            "full_reads"  : 0,
+            "errors"      : 0,
+            "index"       : None
+        }
+
+    def get_client(self):
+        """
+        Return the client for the key-value store.
+
+        """
+        return EtcdV2Client(self.conf['kv_url'])
+
+    def start(self):
+        """
+        Start the thread, which watches the key-value store.
+
+        """
+        self.prefix         = "/" + self.conf.get('kv_prefix',
+                                                  KV_PREFIX_DEFAULT).strip("/")
+        self.watch_timeout  = self.conf.get('kv_watch_timeout',
+                                            KV_WATCH_TIMEOUT_DEFAULT)
+        self.retry_interval = self.conf.get('kv_retry_interval',
+                                            KV_RETRY_INTERVAL_DEFAULT)
+        logging.info("Kvstore watcher plugin: Starting to watch '%s' under "
+                     "prefix '%s'..." % (self.conf['kv_url'], self.prefix))
+        self.client       = self.get_client()
+        self.kv_spec      = KVRouteSpec()
+        self._index       = None
+        self._stop_event  = threading.Event()
+        self.watch_thread = threading.Thread(target=self._watch_loop,
+                                             name="KVMon")
+        self.watch_thread.daemon = True
+        self.watch_thread.start()
+
+    def _send(self):
+        self.stats['updates'] += 1
+        self.last_route_spec_update = datetime.datetime.now()
+        self.q_route_spec.put(self.kv_spec.route_spec())
+
+    def _read_all(self):
+        """
+        Read all the entries under the prefix.
+
+        The route spec is sent out after the first read, even if it is empty,
+        and after later reads only if it has changed.
+
+        """
+        index, keys = self.client.list(self.prefix)
+        self.stats['full_reads'] += 1
+        first_read  = self.stats['updates'] == 0
+        if self.kv_spec.load(keys) or first_read:
+            self._send()
+        self._index = self.stats['index'] = index
+
+    def _watch_once(self):
+        if self._index is None:
+            self._read_all()
+        changes, self._index = self.client.watch(self.prefix, self._index,
+                                                 self.watch_timeout)
+        self.stats['index'] = self._index
+        changed = False
+        for change in changes:
+            self.stats['changes'] += 1
+            changed = self.kv_spec.apply(change) or changed
+        if changed:
+            self._send()
+
+    def _watch_loop(self):
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    self._watch_once()
+                except KVIndexExpiredError as e:
+                    logging.warning("Kvstore watcher plugin: %s, reading all "
+                                    "entries again" % e.message)
+                    self._index = None
+                except KVStoreError as e:
+                    if self._stop_event.is_set():
+                        break
+                    self.stats['errors'] += 1
+                    logging.error("Kvstore watcher plugin: %s" % e.message)
+                    self._stop_event.wait(self.retry_interval)
+        finally:
+            self.client.close()
+
+    def stop(self):
+        """
+        Stop the watch thread.
+
+        """
+        self._stop_event.set()
+        # Interrupt a watch request, which may be waiting for changes
+        self.client.close()
+        self.watch_thread.join()
+        logging.info("Kvstore watcher plugin: Stopped")
+
+    def get_info(self):
+        """
+        Return plugin information.
+
+        """
+        stats = dict(self.stats)
+        stats['entries'] = len(self.kv_spec.entries) if self.client else 0
+        stats['last_route_spec_update'] = \
+                self.last_route_spec_update.isoformat() \
+                if self.last_route_spec_update else "(no update, yet)"
+        return {
+            self.get_plugin_name() : {
+                "version" : self.get_version(),
+                "params" : {
+                    "kv_url"            : self.conf['kv_url'],
+                    "kv_prefix"         : self.conf.get('kv_prefix',
+                                                        KV_PREFIX_DEFAULT),
+                    "kv_watch_timeout"  : self.conf.get(
+                                                'kv_watch_timeout',
+                                                KV_WATCH_TIMEOUT_DEFAULT),
+                    "kv_retry_interval" : self.conf.get(
+                                                'kv_retry_interval',
+                                                KV_RETRY_INTERVAL_DEFAULT)
+                },
+                "stats" : stats
+            }
+        }
+
+    @classmethod
+    def add_arguments(cls, parser, sys_arg_list=None):
+        """
+        Arguments for the kvstore mode.
+
+        """
+        parser.add_argument('--kv_url', dest='kv_url', required=True,
+                            help="URL of the etcd server, for example "
+                                 "http://localhost:2379 "
+                                 "(only in kvstore mode)")
+        parser.add_argument('--kv_prefix', dest='kv_prefix',
+                            default=KV_PREFIX_DEFAULT,
+                            help="key prefix of the route spec entries, "
+                                 "default: %s (only in kvstore mode)" %
+                                 KV_PREFIX_DEFAULT)
+        parser.add_argument('--kv_watch_timeout', dest='kv_watch_timeout',
+                            default=KV_WATCH_TIMEOUT_DEFAULT, type=float,
+                            help="seconds after which a watch request is "
+                                 "renewed, default: %s "
+                                 "(only in kvstore mode)" %
+                                 KV_WATCH_TIMEOUT_DEFAULT)
+        parser.add_argument('--kv_retry_interval', dest='kv_retry_interval',
+                            default=KV_RETRY_INTERVAL_DEFAULT, type=float,
+                            help="seconds to wait before trying again after "
+                                 "an error, default: %s "
+                                 "(only in kvstore mode)" %
+                                 KV_RETRY_INTERVAL_DEFAULT)
+        return ["kv_url", "kv_prefix", "kv_watch_timeout",
+                "kv_retry_interval"]
+
+    @classmethod
+    def check_arguments(cls, conf):
+        """
+        Sanity checks for options needed for kvstore mode.
+
+        """
+        parts = urlparse.urlsplit(conf['kv_url'])
+        if parts.scheme not in ["http", "https"] or not parts.netloc:
+            raise ArgsError("Not a valid http or https URL: '%s'" %
+                            conf['kv_url'])
+        if not conf['kv_prefix'].strip("/"):
+            raise ArgsError("The key prefix cannot be empty")
+        if conf['kv_watch_timeout'] <= 0:
+            raise ArgsError("Watch timeout must be greater than 0")
+        if conf['kv_retry_interval'] <= 0:
+            raise ArgsError("Retry interval must be greater than 0")
@@ -0,0 +1,329 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# A watcher plugin that combines the route specs from multiple watcher
+# plugins (sub-plugins).
+#
+# This allows static routes from one source (a config file, for example) to
+# be combined with dynamic routes from another (for example, HTTP).
+#
+
+import datetime
+import logging
+import threading
+
+from vpcrouter                  import utils
+from vpcrouter.errors           import ArgsError
+from vpcrouter.plugin_framework import load_plugin
+from vpcrouter.watcher          import common
+
+
+WATCHER_PLUGIN_MODULE = "vpcrouter.watcher.plugins"
+
+# How to resolve a CIDR, which appears in the route specs of several
+# sub-plugins: Either the sub-plugin listed first wins, or the hosts of all
+# sub-plugins are combined.
+CONFLICT_RULES        = ["first", "union"]
+
+
+class RouteSpecMerger(object):
+    """
+    Merges the route specs of several sources into a single route spec.
+
+    The merged route spec is updated incrementally: When a source sends a new
+    route spec, only the CIDRs that changed in that source are merged again.
+    Since host pools are shared between validated route specs, unchanged
+    entries are recognized by identity.
+
+    Sources, which haven't sent a route spec yet, don't contribute any routes.
+
+    """
+    def __init__(self, source_names, conflict_rule="first"):
+        self.source_names  = source_names
+        self.conflict_rule = conflict_rule
+        self.specs         = {}
+        self.merged        = {}
+        self.conflicts     = set()
+
+    def _merge_cidr(self, cidr):
+        """
+        Merge the entries of all sources for a CIDR.
+
+        Returns the merged hosts, or None if no source has the CIDR.
+
+        """
+        pools = [self.specs[name][cidr] for name in self.source_names
+                 if cidr in self.specs.get(name, {})]
+        if len(pools) > 1:
+            self.conflicts.add(cidr)
+        else:
+            self.conflicts.discard(cidr)
+        if not pools:
+            return None
+        if len(pools) == 1 or self.conflict_rule == "first":
+            return pools[0]
+        return common.get_host_pool(set().union(*pools))
+
+    def update(self, name, route_spec):
+        """
+        Store the new route spec of a source and merge its changes.
+
+        Returns True if the merged route spec has changed.
+
+        """
+        old_spec         = self.specs.get(name, {})
+        self.specs[name] = route_spec
+        changed_cidrs    = [cidr for cidr, hosts in route_spec.items()
+                            if old_spec.get(cidr) is not hosts]
+        changed_cidrs.extend(cidr for cidr in old_spec
+                             if cidr not in route_spec)
+        changed = False
+        for cidr in changed_cidrs:
+            hosts = self._merge_cidr(cidr)
+            old   = self.merged.get(cidr)
+            if hosts is None:
+                if old is not None:
+                    del self.merged[cidr]
+                    changed = True
+            elif old is None or (old is not hosts and old != hosts):
+                self.merged[cidr] = hosts
+                changed = True
+        return changed
+
+    def route_spec(self):
+        return common.RouteSpec(self.merged)
+
+
+class Multi(common.WatcherPlugin):
+    """
+    A watcher plugin, which combines the route specs of multiple other
+    watcher plugins.
+
+    The sub-plugins are started and stopped together with this plugin. As
+    soon as any sub-plugin sends a new route spec, its changes are merged
+    with the latest route specs of the other sub-plugins. The combined route
+    spec is only sent out if it has changed.
+
+    The plugin adds command line arguments to vpc-router:
+
+    --multi_watchers:         List of watcher plugins, separated by ':'.
+    --multi_watcher_conflict: Conflict rule for CIDRs in more than one
+                              route spec.
+
+    """
+    # The classes of the sub-plugins, found while adding their arguments
+    multi_plugin_classes = []
+
+    def __init__(self, conf, **kwargs):
+        super(Multi, self).__init__(conf)
+
+        # For testing, already created plugin instances can be provided as a
+        # list of (name, instance) tuples in the TEST_PLUGINS parameter.
+        test_plugins = kwargs.get("TEST_PLUGINS")
+        if test_plugins:
+            plugins_and_names = test_plugins
+        else:
+            logging.info("Multi watcher plugin: Loading plugins %s" %
+                         self.conf['multi_watchers'])
+            plugins_and_names = [
+                (name, pc(self.conf)) for name, pc in
+                self.load_sub_plugins_from_str(self.conf['multi_watchers'])]
+
+        self.plugins     = [p for _, p in plugins_and_names]
+        self.merger      = RouteSpecMerger(
+                                [name for name, _ in plugins_and_names],
+                                self.conf.get('multi_watcher_conflict',
+                                              "first"))
+        self._wakeup     = threading.Event()
+        self._stop_event = threading.Event()
+        self._sub_queues = []
+        for name, plugin in plugins_and_names:
+            plugin.is_sub_plugin = True
+            q = plugin.get_route_spec_queue()
+            q.add_listener(self._wakeup.set)
+            self._sub_queues.append((name, q))
+
+        self.last_route_spec_update = None
+        self.stats = {
+            "sub_updates"    : 0,
+            "merged_updates" : 0
+        }
+
+    def get_plugin_name(self):
+        # Different from the name of the multi health monitor plugin, which
+        # may be used at the same time.
+        return "multi_watcher"
+
+    def _merge_loop(self):
+        """
+        Wait for new route specs from the sub-plugins and send out the merged
+        route spec.
+
+        """
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._stop_event.is_set():
+                break
+            changed = got_spec = False
+            for name, q in self._sub_queues:
+                route_spec = utils.read_last_msg_from_queue(q)
+                if route_spec is None:
+                    continue
+                got_spec = True
+                self.stats['sub_updates'] += 1
+                logging.debug("Multi watcher plugin: New route spec from "
+                              "'%s'" % name)
+                old_conflicts = set(self.merger.conflicts)
+                changed       = self.merger.update(name, route_spec) or \
+                                                                    changed
+                for cidr in sorted(self.merger.conflicts - old_conflicts):
+                    logging.warning("Multi watcher plugin: CIDR %s is in "
+                                    "more than one route spec, using '%s' "
+                                    "rule" %
+                                    (cidr, self.merger.conflict_rule))
+            # The first merged route spec is sent out even if it's empty.
+            if changed or got_spec and self.stats['merged_updates'] == 0:
+                self.stats['merged_updates'] += 1
+                self.last_route_spec_update = datetime.datetime.now()
+                self.q_route_spec.put(self.merger.route_spec())
+
+    def start(self):
+        """
+        Start the sub-plugins and the merge thread.
+
+        """
+        logging.info("Multi watcher plugin: Starting")
+        self.merge_thread = threading.Thread(target=self._merge_loop,
+                                             name="MultiWatch")
+        self.merge_thread.daemon = True
+        self.merge_thread.start()
+        for p in self.plugins:
+            p.start()
+
+    def stop(self):
+        """
+        Stop the merge thread and the sub-plugins.
+
+        """
+        self._stop_event.set()
+        self._wakeup.set()
+        self.merge_thread.join()
+        logging.info("Multi watcher plugin: Stopping plugins")
+        for p in self.plugins:
+            p.stop()
+        logging.info("Multi watcher plugin: Stopped")
+
+    def get_info(self):
+        """
+        Return plugin information.
+
+        """
+        plugin_infos = {}
+        for p in self.plugins:
+            plugin_infos.update(p.get_info())
+        stats = dict(self.stats)
+        stats['conflicts'] = sorted(self.merger.conflicts)
+        stats['sources']   = {name : len(spec) for name, spec in
+                              self.merger.specs.items()}
+        stats['last_route_spec_update'] = \
+                self.last_route_spec_update.isoformat() \
+                if self.last_route_spec_update else "(no update, yet)"
+        return {
+            self.get_plugin_name() : {
+                "version"     : self.get_version(),
+                "sub-plugins" : plugin_infos,
+                "params"      : {
+                    "multi_watchers"         : self.conf['multi_watchers'],
+                    "multi_watcher_conflict" : self.merger.conflict_rule
+                },
+                "stats"       : stats
+            }
+        }
+
+    @classmethod
+    def load_sub_plugins_from_str(cls, plugins_str):
+        """
+        Load plugin classes based on a ':' separated list of plugin names.
+
+        Returns a list of (name, class) tuples, in the order of the list.
+
+        """
+        plugin_classes = []
+        if plugins_str:
+            for plugin_name in plugins_str.split(":"):
+                pc = load_plugin(plugin_name, WATCHER_PLUGIN_MODULE)
+                plugin_classes.append((plugin_name, pc))
+        return plugin_classes
+
+    @classmethod
+    def add_arguments(cls, parser, sys_arg_list=None):
+        """
+        Arguments for the multi watcher plugin.
+
+        """
+        parser.add_argument('--multi_watchers',
+                            dest='multi_watchers', required=True,
+                            help="list of watcher plugins, separated by ':', "
+                                 "in order of priority (only in multi mode)")
+        parser.add_argument('--multi_watcher_conflict',
+                            dest='multi_watcher_conflict', default="first",
+                            choices=CONFLICT_RULES,
+                            help="for CIDRs in more than one route spec: use "
+                                 "the hosts of the first plugin, or the "
+                                 "union of all hosts, default: first "
+                                 "(only in multi mode)")
+        arglist = ["multi_watchers", "multi_watcher_conflict"]
+
+        # Read the list of the specified sub-plugins ahead of time, so we can
+        # get their classes and add their parameters.
+        sub_plugin_names_str = \
+                utils.param_extract(sys_arg_list, None, "--multi_watchers")
+        names = sub_plugin_names_str.split(":") if sub_plugin_names_str \
+                else []
+        if "multi" in names or len(set(names)) != len(names):
+            # Reported by check_arguments(), don't try to load those
+            cls.multi_plugin_classes = []
+            return arglist
+
+        cls.multi_plugin_classes = [
+                pc for _, pc in
+                cls.load_sub_plugins_from_str(sub_plugin_names_str)]
+        for pc in cls.multi_plugin_classes:
+            arglist.extend(pc.add_arguments(parser, sys_arg_list))
+
+        return arglist
+
+    @classmethod
+    def check_arguments(cls, conf):
+        """
+        Sanity check plugin options values.
+
+        """
+        if not conf.get('multi_watchers'):
+            raise ArgsError("A specification of watcher plugins "
+                            "is required (--multi_watchers).")
+        names = conf['multi_watchers'].split(":")
+        if "multi" in names:
+            raise ArgsError("The multi watcher plugin cannot be its own "
+                            "sub-plugin.")
+        if len(set(names)) != len(names):
+            raise ArgsError("Each watcher plugin can only be used once.")
+
+        for pc in cls.multi_plugin_classes:
+            pc.check_arguments(conf)
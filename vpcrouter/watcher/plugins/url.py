@@ -0,0 +1,366 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# A watcher plugin, which polls a URL for a centrally published route spec.
+#
+
+import datetime
+import errno
+import hashlib
+import httplib
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import urlparse
+
+from vpcrouter.errors           import ArgsError
+from vpcrouter.watcher          import binspec
+from vpcrouter.watcher          import common
+from vpcrouter.watcher.plugins  import configfile
+
+
+# Seconds between polls of the URL
+URL_POLL_INTERVAL_DEFAULT = 10
+
+# Each interval is randomly varied by up to this fraction, so that many
+# routers don't all poll the server at the same moment.
+URL_POLL_JITTER           = 0.1
+
+# Seconds to wait for the server to respond
+URL_TIMEOUT_DEFAULT       = 10
+
+# Socket errors, which mean that the server has closed the connection
+_DROPPED_CONNECTION_ERRNOS = [errno.ECONNRESET, errno.ECONNABORTED,
+                              errno.EPIPE]
+
+
+def _parse_route_spec(body, path):
+    """
+    Parse and sanity check a route spec, which was fetched from the URL.
+
+    The route spec may be in JSON format, in JSON Lines format (if the path
+    of the URL ends with one of the JSON Lines extensions) or in the binary
+    route spec format (recognized by its magic bytes).
+
+    Raises ValueError in case of problems.
+
+    """
+    if body.startswith(binspec.MAGIC):
+        return binspec.parse_binary_spec(body)
+    if os.path.splitext(path)[1].lower() in configfile.JSON_LINES_EXTENSIONS:
+        return common.parse_route_spec_lines(body.splitlines())
+    return common.parse_route_spec_config(json.loads(body))
+
+
+def _is_dropped_connection(e):
+    """
+    Return True if the exception means that the server has closed the
+    connection before sending any part of a response.
+
+    """
+    if isinstance(e, httplib.BadStatusLine):
+        # Also raised for a garbled status line, which is a real error
+        return not e.line or e.line.startswith("No status line received")
+    return not isinstance(e, socket.timeout) and \
+                            e.errno in _DROPPED_CONNECTION_ERRNOS
+
+
+class RouteSpecFetcher(object):
+    """
+    Fetches the route spec from the URL with conditional GET requests.
+
+    The ETag and Last-Modified headers of the last response are sent back to
+    the server, which can then simply answer with '304 Not Modified'. The
+    connection to the server is kept open and reused for the next request,
+    until an error occurs.
+
+    A new route spec is only sent out if the content of a '200' response has
+    changed since the last route spec we sent. Servers, which don't support
+    conditional requests, therefore cost us only the download.
+
+    """
+    def __init__(self, url, q_route_spec, timeout=URL_TIMEOUT_DEFAULT):
+        self.url           = url
+        self._q_route_spec = q_route_spec
+        self._timeout      = timeout
+        parts              = urlparse.urlsplit(url)
+        self._scheme       = parts.scheme
+        self._netloc       = parts.netloc
+        self._path         = parts.path or "/"
+        self._request_path = self._path + \
+                                ("?" + parts.query if parts.query else "")
+        self._conn         = None
+        self._etag         = None
+        self._last_mod     = None
+        self._content_hash = None
+
+        self.last_route_spec_update = None
+        self.stats = {
+            "requests"     : 0,
+            "not_modified" : 0,
+            "unchanged"    : 0,
+            "updates"      : 0,
+            "errors"       : 0,
+            "connections"  : 0,
+            "last_error"   : None
+        }
+
+    def _connection(self):
+        """
+        Return the connection to the server, open a new one if needed.
+
+        """
+        if self._conn is None:
+            conn_class = httplib.HTTPSConnection \
+                            if self._scheme == "https" \
+                            else httplib.HTTPConnection
+            self._conn = conn_class(self._netloc, timeout=self._timeout)
+            self.stats['connections'] += 1
+        return self._conn
+
+    def close(self):
+        """
+        Close the connection to the server, if there is one.
+
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _send(self, headers):
+        """
+        Send a GET request and return the response, as soon as its status
+        line and headers have arrived.
+
+        """
+        conn = self._connection()
+        conn.request("GET", self._request_path, headers=headers)
+        return conn.getresponse()
+
+    def _get(self):
+        """
+        Send a conditional GET request and return status, headers and body of
+        the response.
+
+        If a kept-alive connection turns out to be closed before any part of
+        the response arrived, the request is sent once more on a new
+        connection.
+
+        """
+        headers = {"Accept" : "application/json"}
+        if self._etag:
+            headers["If-None-Match"] = self._etag
+        if self._last_mod:
+            headers["If-Modified-Since"] = self._last_mod
+
+        reused = self._conn is not None
+        try:
+            resp = self._send(headers)
+        except (httplib.BadStatusLine, socket.error) as e:
+            # The server may have closed an idle keep-alive connection before
+            # it got our request. That's not an error, so we try once more on
+            # a new connection.
+            if not reused or not _is_dropped_connection(e):
+                raise
+            logging.debug("Url watcher plugin: Connection was closed by the "
+                          "server, sending request on a new connection")
+            self.close()
+            resp = self._send(headers)
+        # Reading the complete body is required before the connection can be
+        # used for the next request.
+        body = resp.read()
+        if resp.will_close:
+            self.close()
+        return resp.status, resp, body
+
+    def _error(self, msg):
+        self.stats['errors']     += 1
+        self.stats['last_error']  = msg
+        logging.error("Url watcher plugin: %s" % msg)
+
+    def fetch(self):
+        """
+        Fetch the route spec from the URL and send it out, if it has changed.
+
+        Errors are logged, they don't stop the operation of the system and we
+        don't send out an empty route spec.
+
+        """
+        self.stats['requests'] += 1
+        try:
+            status, resp, body = self._get()
+        except (httplib.HTTPException, socket.error) as e:
+            # We start with a new connection next time.
+            self.close()
+            self._error("Cannot fetch route spec from '%s': %s" %
+                        (self.url, str(e) or type(e).__name__))
+            return
+
+        if status == 304:
+            self.stats['not_modified'] += 1
+            return
+        if status != 200:
+            self._error("Cannot fetch route spec from '%s': HTTP status %d" %
+                        (self.url, status))
+            return
+
+        # Even if the content turns out to be broken, we remember the
+        # validators: Asking for the same content again won't fix it.
+        self._etag     = resp.getheader("ETag")
+        self._last_mod = resp.getheader("Last-Modified")
+
+        content_hash = hashlib.sha1(body).hexdigest()
+        if content_hash == self._content_hash:
+            self.stats['unchanged'] += 1
+            logging.debug("Url watcher plugin: Route spec content unchanged, "
+                          "ignoring it")
+            return
+        try:
+            route_spec = _parse_route_spec(body, self._path)
+        except ValueError as e:
+            self._error("Config ignored: %s" % str(e))
+            return
+
+        self._content_hash = content_hash
+        self.stats['updates'] += 1
+        self.last_route_spec_update = datetime.datetime.now()
+        logging.info("Url watcher plugin: New route spec fetched")
+        self._q_route_spec.put(route_spec, content_hash=content_hash)
+
+
+class Url(common.WatcherPlugin):
+    """
+    Implements the WatcherPlugin interface for the 'url' plugin.
+
+    Regularly polls a URL for the route spec, which may be published by a
+    central system on any HTTP server or object store. The intervals between
+    the polls are slightly randomized.
+
+    The plugin adds command line arguments to vpc-router:
+
+    --url:               The URL of the route spec.
+    --url_poll_interval: Seconds between polls of the URL.
+    --url_timeout:       Seconds to wait for the server to respond.
+
+    """
+    def start(self):
+        """
+        Start the URL polling thread.
+
+        """
+        logging.info("Url watcher plugin: Starting to poll '%s' for route "
+                     "spec..." % self.conf['url'])
+        self.fetcher = RouteSpecFetcher(
+                            self.conf['url'], self.q_route_spec,
+                            timeout=self.conf.get('url_timeout',
+                                                  URL_TIMEOUT_DEFAULT))
+        self.poll_interval = self.conf.get('url_poll_interval',
+                                           URL_POLL_INTERVAL_DEFAULT)
+        self._stop_event   = threading.Event()
+        self.poll_thread   = threading.Thread(target=self._poll_loop,
+                                              name="UrlMon")
+        self.poll_thread.daemon = True
+        self.poll_thread.start()
+
+    def _next_interval(self):
+        """
+        Return the time until the next poll, randomly varied by up to the
+        jitter fraction.
+
+        """
+        return self.poll_interval * \
+                    random.uniform(1 - URL_POLL_JITTER, 1 + URL_POLL_JITTER)
+
+    def _poll_loop(self):
+        # The route spec is fetched right away, then after each interval.
+        try:
+            while not self._stop_event.is_set():
+                self.fetcher.fetch()
+                self._stop_event.wait(self._next_interval())
+        finally:
+            self.fetcher.close()
+
+    def stop(self):
+        """
+        Stop the URL polling thread.
+
+        """
+        self._stop_event.set()
+        self.poll_thread.join()
+        logging.info("Url watcher plugin: Stopped")
+
+    def get_info(self):
+        """
+        Return plugin information.
+
+        """
+        stats = dict(self.fetcher.stats)
+        stats['last_route_spec_update'] = \
+                self.fetcher.last_route_spec_update.isoformat() \
+                if self.fetcher.last_route_spec_update else "(no update, yet)"
+        return {
+            self.get_plugin_name() : {
+                "version" : self.get_version(),
+                "params" : {
+                    "url"               : self.conf['url'],
+                    "url_poll_interval" : self.poll_interval,
+                    "url_timeout"       : self.conf.get('url_timeout',
+                                                        URL_TIMEOUT_DEFAULT)
+                },
+                "stats" : stats
+            }
+        }
+
+    @classmethod
+    def add_arguments(cls, parser, sys_arg_list=None):
+        """
+        Arguments for the url mode.
+
+        """
+        parser.add_argument('--url', dest='url', required=True,
+                            help="URL of the route spec "
+                                 "(only in url mode)")
+        parser.add_argument('--url_poll_interval', dest='url_poll_interval',
+                            default=URL_POLL_INTERVAL_DEFAULT, type=float,
+                            help="seconds between polls of the URL, "
+                                 "default: %s (only in url mode)" %
+                                 URL_POLL_INTERVAL_DEFAULT)
+        parser.add_argument('--url_timeout', dest='url_timeout',
+                            default=URL_TIMEOUT_DEFAULT, type=float,
+                            help="seconds to wait for a response from the "
+                                 "server, default: %s (only in url mode)" %
+                                 URL_TIMEOUT_DEFAULT)
+        return ["url", "url_poll_interval", "url_timeout"]
+
+    @classmethod
+    def check_arguments(cls, conf):
+        """
+        Sanity checks for options needed for url mode.
+
+        """
+        parts = urlparse.urlsplit(conf['url'])
+        if parts.scheme not in ["http", "https"] or not parts.netloc:
+            raise ArgsError("Not a valid http or https URL: '%s'" %
+                            conf['url'])
+        if conf['url_poll_interval'] <= 0:
+            raise ArgsError("URL poll interval must be greater than 0")
+        if conf['url_timeout'] <= 0:
+            raise ArgsError("URL timeout must be greater than 0")